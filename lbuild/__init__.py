@@ -7,26 +7,38 @@
 # 2-clause BSD license. See the file `LICENSE.txt` for the full license
 # governing this code.
 
+from . import archive
 from . import builder
+from . import buildcache
 from . import buildlog
 from . import environment
 from . import exception
 from . import module
 from . import option
 from . import parser
+from . import plan
+from . import profiler
 from . import repository
+from . import server
 from . import utils
+from . import watch
 from . import main
 
 __all__ = [
+    'archive',
     'builder',
+    'buildcache',
     'buildlog',
     'environment',
     'exception',
     'module',
     'option',
     'parser',
+    'plan',
+    'profiler',
     'repository',
+    'server',
     'utils',
+    'watch',
     'main'
 ]
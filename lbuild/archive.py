@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+"""
+Write the outputs of a build directly into an archive.
+
+The generated files are never written into the output path. Copied files
+are streamed from the repositories into the archive, rendered templates
+are kept in memory until the archive is written.
+
+The archive is reproducible: the members are sorted by name, and all
+members share the same timestamp, owner and permissions. The timestamp is
+taken from the `SOURCE_DATE_EPOCH` environment variable if it is set.
+"""
+
+import io
+import os
+import sys
+import bz2
+import gzip
+import lzma
+import shutil
+import stat
+import time
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+from .exception import BlobException
+
+# 1980-01-01 00:00:00 UTC, the earliest timestamp of a zip file
+DEFAULT_TIMESTAMP = 315532800
+
+# `ZipFile.open()` supports writing since Python 3.6. Older versions read
+# the whole file into memory.
+_ZIP_STREAMING = sys.version_info >= (3, 6)
+
+FORMATS = {
+    ".zip": "zip",
+    ".tar": "tar",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tar.xz": "xz",
+    ".tar.zst": "zst",
+    ".tzst": "zst",
+}
+
+
+def get_format(filename):
+    """
+    Archive format selected by the file extension.
+    """
+    for suffix, archive_format in FORMATS.items():
+        if filename.endswith(suffix):
+            return archive_format
+    raise BlobException("Unknown archive format of '{}'. Supported extensions: "
+                        "{}".format(filename, ", ".join(sorted(FORMATS))))
+
+
+def get_timestamp():
+    try:
+        return max(int(os.environ["SOURCE_DATE_EPOCH"]), DEFAULT_TIMESTAMP)
+    except (KeyError, ValueError):
+        return DEFAULT_TIMESTAMP
+
+
+def _get_zstd_writer():
+    """
+    Factory of a zstd compressing writer, from the standard library of
+    Python 3.14 or the `zstandard` package.
+    """
+    try:
+        from compression import zstd
+        return lambda fileobj: zstd.ZstdFile(fileobj, "wb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise BlobException("Writing '.tar.zst' archives requires the 'zstandard' package")
+    return lambda fileobj: zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+
+
+def check_format(filename):
+    """
+    Check that the archive format is supported before building.
+    """
+    if get_format(filename) == "zst":
+        _get_zstd_writer()
+
+
+def _get_mode(sourcepath):
+    """
+    Only the executable bit of the source file is kept.
+    """
+    if sourcepath is not None and os.stat(sourcepath).st_mode & stat.S_IXUSR:
+        return 0o755
+    return 0o644
+
+
+class OutputArchive:
+    """
+    Collect the outputs of a build and write them into an archive at the
+    end of the build.
+
+    The member names are the paths of the outputs relative to the output
+    path. Outputs outside of the output path can not be added.
+    """
+
+    def __init__(self, filename, outpath):
+        self.filename = filename
+        self.outpath = os.path.abspath(outpath)
+        self.format = get_format(filename)
+        self.timestamp = get_timestamp()
+        # Fail before the build if the compression is not available
+        self._zstd_writer = _get_zstd_writer() if self.format == "zst" else None
+
+        # Member name -> (Source filename, content of a generated file)
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def get_member(self, destpath):
+        """
+        Member name of an output file.
+        """
+        path = os.path.relpath(os.path.abspath(destpath), self.outpath)
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise BlobException("Cannot write '{}' into the archive, the file is "
+                                "outside of the output path '{}'".format(destpath, self.outpath))
+        return path.replace(os.sep, "/")
+
+    def add_file(self, sourcepath, destpath):
+        """
+        Add a copy of the source file. The file is read when the archive
+        is written.
+
+        Returns:
+            Member name.
+        """
+        member = self.get_member(destpath)
+        with self._lock:
+            self._members[member] = (sourcepath, None)
+        return member
+
+    def add_content(self, destpath, content):
+        """
+        Add a generated file.
+
+        Returns:
+            Member name.
+        """
+        member = self.get_member(destpath)
+        with self._lock:
+            self._members[member] = (None, content.encode("utf-8"))
+        return member
+
+    def write(self):
+        """
+        Write all members into the archive.
+
+        The archive is written to a temporary file first and replaces an
+        existing archive only if it has been written completely.
+        """
+        with self._lock:
+            folder = os.path.dirname(os.path.abspath(self.filename))
+            os.makedirs(folder, exist_ok=True)
+            fd, tempname = tempfile.mkstemp(prefix=".lbuild_archive_", dir=folder)
+            try:
+                with os.fdopen(fd, "wb") as rawfile:
+                    if self.format == "zip":
+                        self._write_zip(rawfile)
+                    else:
+                        self._write_tar(rawfile)
+                # mkstemp() creates the file only readable by the user
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tempname, 0o666 & ~umask)
+                os.replace(tempname, self.filename)
+            except BaseException:
+                os.remove(tempname)
+                raise
+            self._members.clear()
+
+    def discard(self):
+        with self._lock:
+            self._members.clear()
+
+    def _get_members(self):
+        for member, (sourcepath, content) in sorted(self._members.items()):
+            size = len(content) if sourcepath is None else os.path.getsize(sourcepath)
+            yield member, sourcepath, content, size
+
+    def _write_zip(self, rawfile):
+        date_time = time.gmtime(self.timestamp)[:6]
+        with zipfile.ZipFile(rawfile, "w", zipfile.ZIP_DEFLATED) as archive:
+            for member, sourcepath, content, size in self._get_members():
+                info = zipfile.ZipInfo(member, date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = (stat.S_IFREG | _get_mode(sourcepath)) << 16
+                info.file_size = size
+                if sourcepath is None:
+                    archive.writestr(info, content)
+                elif _ZIP_STREAMING:
+                    with open(sourcepath, "rb") as infile, \
+                            archive.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as outfile:
+                        shutil.copyfileobj(infile, outfile)
+                else:
+                    with open(sourcepath, "rb") as infile:
+                        archive.writestr(info, infile.read())
+
+    def _open_compressor(self, rawfile):
+        if self.format == "gz":
+            # The gzip header contains a timestamp and the filename
+            return gzip.GzipFile(filename="", mode="wb", fileobj=rawfile, mtime=self.timestamp)
+        elif self.format == "bz2":
+            return bz2.BZ2File(rawfile, "wb")
+        elif self.format == "xz":
+            return lzma.LZMAFile(rawfile, "wb")
+        elif self.format == "zst":
+            return self._zstd_writer(rawfile)
+        return None
+
+    def _write_tar(self, rawfile):
+        compressor = self._open_compressor(rawfile)
+        fileobj = rawfile if compressor is None else compressor
+        try:
+            with tarfile.open(fileobj=fileobj, mode="w", format=tarfile.PAX_FORMAT) as archive:
+                for member, sourcepath, content, size in self._get_members():
+                    info = tarfile.TarInfo(member)
+                    info.size = size
+                    info.mtime = self.timestamp
+                    info.mode = _get_mode(sourcepath)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    if sourcepath is None:
+                        archive.addfile(info, io.BytesIO(content))
+                    else:
+                        with open(sourcepath, "rb") as infile:
+                            archive.addfile(info, infile)
+        finally:
+            if compressor is not None:
+                compressor.close()
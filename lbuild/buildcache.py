@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+"""
+Content-addressed cache of the outputs of the module build steps.
+
+The cache is a plain folder which can be shared between projects, users
+and machines (e.g. over NFS):
+
+    objects/<xx>/<sha256>                 Content of an output file
+    entries/<xx>/<key>/<sha256>.json      Outputs of one build step
+
+The key of a module is calculated before its build step from the lbuild
+version, the module file, the full module name, the names of all modules
+of the build, the outputs of its submodules and the values of the options
+read in its prepare step. Every entry of a key
+additionally records the values of the options read by the build step and
+the hashes of the used source files and templates (including templates
+used through `include` or `extends`). An entry is only used if these still
+match.
+
+Files read or written by a module without using the environment are not
+detected. Entries are written atomically, concurrent builds may write the
+same entry.
+"""
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from .exception import BlobException
+
+LOGGER = logging.getLogger('lbuild.buildcache')
+
+# Digest of the lbuild sources, see `get_lbuild_digest()`
+_lbuild_digest = None
+
+
+def get_lbuild_digest():
+    """
+    Digest of the source files of lbuild.
+
+    Changes with every lbuild version, also for development versions. The
+    sources are only read once per process.
+    """
+    global _lbuild_digest
+    if _lbuild_digest is None:
+        basepath = os.path.dirname(os.path.abspath(__file__))
+        filenames = []
+        for root, folders, files in os.walk(basepath):
+            folders[:] = [folder for folder in folders
+                          if not folder.startswith(".") and folder != "__pycache__"]
+            filenames.extend(os.path.join(root, filename)
+                             for filename in files if filename.endswith(".py"))
+
+        digest = hashlib.sha256()
+        for filename in sorted(filenames):
+            digest.update(os.path.relpath(filename, basepath).encode("utf-8"))
+            with open(filename, "rb") as sourcefile:
+                digest.update(sourcefile.read())
+        _lbuild_digest = digest.hexdigest()
+    return _lbuild_digest
+
+
+def parse_size(size):
+    """
+    Parse a size with an optional 'K', 'M', 'G' or 'T' suffix (powers of
+    1024).
+    """
+    size = str(size).strip().upper().rstrip("B")
+    factor = 1
+    for index, suffix in enumerate("KMGT"):
+        if size.endswith(suffix):
+            factor = 1024 ** (index + 1)
+            size = size[:-1]
+            break
+    try:
+        value = int(float(size) * factor)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise BlobException("Invalid size '{}'".format(size))
+    return value
+
+
+def _write_atomic(filename, write):
+    folder = os.path.dirname(filename)
+    os.makedirs(folder, exist_ok=True)
+    fd, tempname = tempfile.mkstemp(prefix=".tmp_", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            write(outfile)
+        os.chmod(tempname, 0o644)
+        os.replace(tempname, filename)
+    except BaseException:
+        os.remove(tempname)
+        raise
+
+
+class BuildCache:
+    """
+    Folder with the cached outputs of module build steps.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+
+        # Filename -> SHA-256 of the content. Source files are only hashed
+        # once per build.
+        self._hashes = {}
+
+    def hash_file(self, filename):
+        digest = self._hashes.get(filename, None)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(filename, "rb") as infile:
+                for block in iter(lambda: infile.read(1 << 16), b""):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            self._hashes[filename] = digest
+        return digest
+
+    def get_object_filename(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def get_entry_folder(self, key):
+        return os.path.join(self.path, "entries", key[:2], key)
+
+    def add_file(self, filename):
+        """
+        Add the content of a file.
+
+        Returns:
+            SHA-256 of the content.
+        """
+        digest = self.hash_file(filename)
+        objectfile = self.get_object_filename(digest)
+        if not os.path.exists(objectfile):
+            def write(outfile):
+                with open(filename, "rb") as infile:
+                    shutil.copyfileobj(infile, outfile)
+            _write_atomic(objectfile, write)
+        return digest
+
+    def add_content(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        objectfile = self.get_object_filename(digest)
+        if not os.path.exists(objectfile):
+            _write_atomic(objectfile, lambda outfile: outfile.write(content))
+        return digest
+
+    def get_entries(self, key):
+        """
+        Entries stored for the key, the most recently used first.
+        """
+        entries = []
+        for filename in glob.glob(os.path.join(self.get_entry_folder(key), "*.json")):
+            try:
+                with open(filename) as entryfile:
+                    entry = json.load(entryfile)
+                entries.append((os.stat(filename).st_mtime, filename, entry))
+            except (OSError, ValueError):
+                continue
+        entries.sort(key=lambda item: item[0], reverse=True)
+        return [(filename, entry) for _, filename, entry in entries]
+
+    def add_entry(self, key, entry):
+        content = json.dumps(entry, indent=1, sort_keys=True).encode("utf-8")
+        filename = os.path.join(self.get_entry_folder(key),
+                                hashlib.sha256(content).hexdigest() + ".json")
+        _write_atomic(filename, lambda outfile: outfile.write(content))
+        return filename
+
+    def start(self, outpath, build_modules, repo_options, module_options):
+        """
+        Use the cache for a build.
+
+        Returns:
+            CachedBuild object.
+        """
+        return CachedBuild(self, outpath, build_modules, repo_options, module_options)
+
+    def evict(self, max_size):
+        """
+        Remove the least recently used entries until the size of the
+        cache is below the given limit in bytes.
+
+        Objects are shared between entries and are only removed once they
+        are not used by any remaining entry.
+
+        Returns:
+            (Number of removed entries, Number of removed bytes)
+        """
+        entries = []
+        for filename in glob.glob(os.path.join(self.path, "entries", "*", "*", "*.json")):
+            try:
+                with open(filename) as entryfile:
+                    objects = set(operation["object"] for operation in json.load(entryfile)["operations"])
+                stat = os.stat(filename)
+            except (OSError, ValueError, KeyError, TypeError):
+                objects = set()
+                stat = None
+            entries.append((0 if stat is None else stat.st_mtime, filename,
+                            0 if stat is None else stat.st_size, objects))
+        entries.sort(key=lambda entry: entry[0])
+
+        sizes = {}
+        for filename in glob.glob(os.path.join(self.path, "objects", "*", "*")):
+            try:
+                sizes[os.path.basename(filename)] = os.path.getsize(filename)
+            except OSError:
+                pass
+
+        references = {}
+        for _, _, _, objects in entries:
+            for digest in objects:
+                references[digest] = references.get(digest, 0) + 1
+        size = sum(entrysize for _, _, entrysize, _ in entries)
+        size += sum(sizes.get(digest, 0) for digest in references)
+
+        removed_entries = 0
+        removed_size = 0
+        for _, filename, entrysize, objects in entries:
+            if size <= max_size:
+                break
+            LOGGER.debug("Remove cache entry '%s'", filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            removed_entries += 1
+            size -= entrysize
+            removed_size += entrysize
+            for digest in objects:
+                references[digest] -= 1
+                if references[digest] == 0:
+                    size -= sizes.get(digest, 0)
+
+            folder = os.path.dirname(filename)
+            if not os.listdir(folder):
+                os.rmdir(folder)
+
+        # Remove all unused objects, including the objects of incomplete
+        # entries
+        for digest, objectsize in sizes.items():
+            if references.get(digest, 0) == 0:
+                try:
+                    os.remove(self.get_object_filename(digest))
+                    removed_size += objectsize
+                except OSError:
+                    pass
+        return removed_entries, removed_size
+
+
+class CachedBuild:
+    """
+    Restore and store the build steps of the modules of one build.
+    """
+
+    def __init__(self, cache, outpath, build_modules, repo_options, module_options):
+        self.cache = cache
+        self.outpath = os.path.abspath(outpath)
+        self.modulenames = sorted(module.fullname for module in build_modules)
+        self.options = dict(repo_options)
+        self.options.update(module_options)
+
+        # Full module name -> Key
+        self._keys = {}
+
+    def _get_key(self, module, buildlog):
+        submodule_outputs = sorted(self._get_relative_path(operation.filename_out, self.outpath)
+                                   for operation in buildlog.operations
+                                   if operation.modulename.startswith(module.fullname + ":"))
+        digest = hashlib.sha256()
+        digest.update(json.dumps([
+            BuildCache.VERSION,
+            get_lbuild_digest(),
+            module.fullname,
+            self.cache.hash_file(module.filename),
+            self.modulenames,
+            submodule_outputs,
+            # The build step may depend on state captured in the prepare step
+            {name: self._get_option_value(name) for name in sorted(module.prepare_accessed_options)},
+        ], sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _get_option_value(self, name):
+        option = self.options.get(name, None)
+        if option is None or option.value is None:
+            return None
+        return str(option.value)
+
+    @staticmethod
+    def _get_relative_path(filename, basepath):
+        """
+        Path relative to the base path, `None` for files outside of it.
+        """
+        path = os.path.relpath(os.path.abspath(filename), basepath)
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            return None
+        return path.replace(os.sep, "/")
+
+    def _is_valid(self, entry, repopath):
+        for name, value in entry["options"].items():
+            if self._get_option_value(name) != value:
+                return False
+        for path, digest in entry["inputs"].items():
+            try:
+                if self.cache.hash_file(os.path.join(repopath, path)) != digest:
+                    return False
+            except OSError:
+                return False
+        for operation in entry["operations"]:
+            if not os.path.exists(self.cache.get_object_filename(operation["object"])):
+                return False
+        return True
+
+    def restore(self, module, env, buildlog):
+        """
+        Restore the outputs of the build step of the module.
+
+        The outputs are written through the environment and the operations
+        are added to the build log.
+
+        Returns:
+            List of operations, `None` if the module is not cached.
+        """
+        key = self._get_key(module, buildlog)
+        self._keys[module.fullname] = key
+
+        repopath = module.repository.path
+        for filename, entry in self.cache.get_entries(key):
+            try:
+                if not self._is_valid(entry, repopath):
+                    continue
+            except (KeyError, AttributeError, TypeError):
+                continue
+
+            LOGGER.info("Restore %s from the build cache", module.fullname)
+            operations = []
+            for operation in entry["operations"]:
+                sourcepath = os.path.normpath(os.path.join(repopath, operation["source"]))
+                destpath = os.path.normpath(os.path.join(self.outpath, operation["destination"]))
+                env._restorefile(self.cache.get_object_filename(operation["object"]), destpath)
+                operations.append(env._log(sourcepath, destpath, 0))
+            for name, value, unique in entry["metadata"]:
+                if unique:
+                    env.append_metadata_unique(name, value)
+                else:
+                    env.append_metadata(name, value)
+            module.build_accessed_options = set(entry["options"])
+
+            try:
+                # Mark the entry as recently used for `evict()`
+                os.utime(filename)
+            except OSError:
+                pass
+            return operations
+        return None
+
+    def store(self, module, env, operations):
+        """
+        Add the outputs of the build step of the module.
+
+        Modules with outputs outside of the output path, sources outside
+        of the repository or metadata which can not be stored as JSON are
+        not cached.
+        """
+        repopath = module.repository.path
+        rendered, metadata, templates = env._rendered, env._metadata, env.template_files
+
+        entry = {
+            "options": {name: self._get_option_value(name)
+                        for name in sorted(module.build_accessed_options)},
+            "inputs": {},
+            "operations": [],
+            "metadata": metadata,
+        }
+        try:
+            json.dumps(metadata)
+        except (TypeError, ValueError):
+            LOGGER.debug("Not caching %s: metadata can not be stored", module.fullname)
+            return
+
+        for filename in set(operation.filename_in for operation in operations) | templates:
+            path = self._get_relative_path(filename, repopath)
+            if path is None:
+                LOGGER.debug("Not caching %s: '%s' is outside of the repository",
+                             module.fullname, filename)
+                return
+            entry["inputs"][path] = self.cache.hash_file(filename)
+
+        for operation in operations:
+            destination = self._get_relative_path(operation.filename_out, self.outpath)
+            if destination is None or operation.modulename != module.fullname:
+                LOGGER.debug("Not caching %s: '%s' is outside of the output path",
+                             module.fullname, operation.filename_out)
+                return
+
+            content = rendered.get(operation.filename_out, None)
+            if content is None:
+                digest = self.cache.add_file(operation.filename_in)
+            else:
+                digest = self.cache.add_content(content.encode("utf-8"))
+            entry["operations"].append({
+                "source": self._get_relative_path(operation.filename_in, repopath),
+                "destination": destination,
+                "object": digest,
+            })
+
+        try:
+            self.cache.add_entry(self._keys.pop(module.fullname), entry)
+        except OSError as error:
+            LOGGER.warning("Unable to write the build cache entry of %s: %s",
+                           module.fullname, error)
@@ -27,7 +27,8 @@ class Operation:
     from within it was generated.
     """
 
-    def __init__(self, module, filename_in: str, filename_out: str, time=None):
+    def __init__(self, module, filename_in: str, filename_out: str, time=None, size=None,
+                 member=None):
         self.modulename = module.fullname
         self.modulepath = module.path
 
@@ -35,6 +36,11 @@ class Operation:
         self.filename_out = filename_out
 
         self.time = time
+        # Size of the source file, only recorded by a dry run
+        self.size = size
+        # Name of the archive member, only if the outputs are written into
+        # an archive
+        self.member = member
 
     @property
     def filename_local_in(self):
@@ -63,29 +69,69 @@ class BuildLog:
         self.operations = []
         self.metadata = collections.defaultdict(list)
 
+        # Module name -> (Options read in the prepare step,
+        #                 Options read in the build steps)
+        self.accessed_options = {}
+
+        # Resolved configuration of the build, see `log_configuration()`
+        self.configuration = None
+
         self._build_files = {}
         self.__lock = threading.Lock()
 
-    def log(self, module, filename_in: str, filename_out: str, time=None):
+    def log(self, module, filename_in: str, filename_out: str, time=None, size=None,
+            member=None):
+        return self.log_operation(Operation(module, filename_in, filename_out, time, size,
+                                            member))
+
+    def log_operation(self, operation):
+        """
+        Add an existing operation, e.g. from the log of a previous build.
+        """
         with self.__lock:
-            operation = Operation(module, filename_in, filename_out, time)
             LOGGER.debug(str(operation))
 
-            previous = self._build_files.get(filename_out, None)
+            previous = self._build_files.get(operation.filename_out, None)
             if previous is not None:
                 raise BlobBuildException("Overwrite file '{}' from '{}' (module '{}'). Previously "
                                          "generated from '{}' (module '{}')."
-                                         .format(filename_out,
-                                                 filename_in,
-                                                 module.fullname,
+                                         .format(operation.filename_out,
+                                                 operation.filename_in,
+                                                 operation.modulename,
                                                  previous.filename_in,
                                                  previous.modulename))
 
-            self._build_files[filename_out] = operation
+            self._build_files[operation.filename_out] = operation
             self.operations.append(operation)
 
         return operation
 
+    def log_accessed_options(self, module):
+        """
+        Record the repository and module options the module has read.
+        """
+        with self.__lock:
+            self.accessed_options[module.fullname] = (sorted(module.prepare_accessed_options),
+                                                      sorted(module.build_accessed_options))
+
+    def log_configuration(self, repo_options, build_modules, module_options):
+        """
+        Record the option values and the modules of the build.
+
+        Allows comparing a later configuration with this build without
+        parsing the previous configuration file again (see `lbuild.plan`).
+        """
+        options = {}
+        for name, option in list(repo_options.items()) + list(module_options.items()):
+            options[name] = None if option.value is None else str(option.value)
+
+        modules = {}
+        for module in build_modules:
+            modules[module.fullname] = sorted(dependency.fullname for dependency in module.dependencies)
+
+        with self.__lock:
+            self.configuration = (options, modules)
+
     def get_operations_per_module(self, modulename: str):
         """
         Get all operations which have been performed for the given module and
@@ -119,6 +165,33 @@ class BuildLog:
                 if operation.time is not None:
                     timenode = lxml.etree.SubElement(operationnode, "time")
                     timenode.text = "{:.3f} ms".format(operation.time * 1000)
+                if operation.size is not None:
+                    sizenode = lxml.etree.SubElement(operationnode, "size")
+                    sizenode.text = str(operation.size)
+                if operation.member is not None:
+                    membernode = lxml.etree.SubElement(operationnode, "member")
+                    membernode.text = operation.member
+
+            for modulename, (prepare, build) in sorted(self.accessed_options.items()):
+                optionsnode = lxml.etree.SubElement(rootnode, "options")
+
+                modulenode = lxml.etree.SubElement(optionsnode, "module")
+                modulenode.text = modulename
+                for name in prepare:
+                    lxml.etree.SubElement(optionsnode, "prepare").text = name
+                for name in build:
+                    lxml.etree.SubElement(optionsnode, "build").text = name
+
+            if self.configuration is not None:
+                options, modules = self.configuration
+                confignode = lxml.etree.SubElement(rootnode, "configuration")
+                for name, value in sorted(options.items()):
+                    optionnode = lxml.etree.SubElement(confignode, "option", name=name)
+                    optionnode.text = value
+                for modulename, dependencies in sorted(modules.items()):
+                    modulenode = lxml.etree.SubElement(confignode, "module", name=modulename)
+                    for dependency in dependencies:
+                        lxml.etree.SubElement(modulenode, "dependency").text = dependency
 
         if to_string:
             return lxml.etree.tostring(rootnode,
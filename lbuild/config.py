@@ -9,18 +9,186 @@
 # governing this code.
 
 import os
+import json
+import time
+import pickle
+import hashlib
 import pkgutil
 import logging
+import tempfile
 import collections
 import lxml.etree
 
 from .exception import BlobException
 
+import lbuild.utils
 import lbuild.module
+import lbuild.profiler
+import lbuild.buildcache
 
 LOGGER = logging.getLogger('lbuild.config')
 DEFAULT_CACHE_FOLDER = ".lbuild_cache"
 
+# Compiled XML schema of the configuration files, see `get_schema()`
+_schema = None
+
+
+def get_schema():
+    """
+    Load and compile the XML schema of the configuration files.
+
+    The schema is compiled only once per process.
+
+    Returns:
+        (lxml.etree.XMLSchema, str): Compiled schema and hash of the schema
+            file.
+    """
+    global _schema
+    if _schema is None:
+        data = pkgutil.get_data('lbuild', 'resources/configuration.xsd')
+        _schema = (lxml.etree.XMLSchema(lxml.etree.fromstring(data)),
+                   hashlib.sha1(data).hexdigest())
+    return _schema
+
+
+def _get_file_hash(filename):
+    with open(filename, "rb") as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+
+class ConfigurationCache:
+    """
+    On-disk cache of the parsed configurations.
+
+    An entry contains a merged configuration, including all files of the
+    `<extends>` chain. It is reused as long as the modification times of
+    the files are unchanged. Files with a new modification time are
+    compared by their content hash. Touching a file therefore does not
+    require parsing and validating the XML again.
+
+    Entries are only valid for the lbuild version which has written them.
+    Entries which have not been used for `MAX_AGE` seconds are removed
+    when a new entry is added.
+    """
+
+    MAX_AGE = 30 * 24 * 60 * 60
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path: Cache folder. Defaults to `$XDG_CACHE_HOME/lbuild/config`.
+        """
+        self.path = lbuild.utils.get_user_cache_folder("config") if path is None else path
+
+    def get_entry_filename(self, configfile):
+        # Relative paths in the configuration depend on the working directory
+        key = json.dumps([os.getcwd(), configfile])
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle")
+
+    @staticmethod
+    def _get_stamps(filenames):
+        stamps = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            stamps.append([filename, stat.st_mtime_ns, stat.st_size, _get_file_hash(filename)])
+        return stamps
+
+    def get(self, configfile):
+        """
+        Returns:
+            Cached Configuration object or `None` if the cache entry is
+            missing or outdated.
+        """
+        entryfile = self.get_entry_filename(configfile)
+        try:
+            with open(entryfile, "rb") as infile:
+                entry = pickle.load(infile)
+            if (entry["lbuild"] != lbuild.buildcache.get_lbuild_digest() or
+                    entry["schema"] != get_schema()[1]):
+                return None
+
+            modified = False
+            for stamp in entry["files"]:
+                filename, mtime, size, digest = stamp
+                stat = os.stat(filename)
+                if (stat.st_mtime_ns, stat.st_size) == (mtime, size):
+                    continue
+                if stat.st_size != size or _get_file_hash(filename) != digest:
+                    LOGGER.debug("Configuration cache outdated by '%s'", filename)
+                    return None
+                stamp[1] = stat.st_mtime_ns
+                modified = True
+        except (OSError, EOFError, KeyError, ValueError, TypeError,
+                AttributeError, ImportError, pickle.UnpicklingError):
+            return None
+
+        if modified:
+            self._write(entryfile, entry)
+        else:
+            try:
+                # Mark the entry as recently used for `prune()`
+                os.utime(entryfile)
+            except OSError:
+                pass
+        LOGGER.debug("Use cached configuration '%s'", configfile)
+        return entry["configuration"]
+
+    def add(self, configfile, configuration):
+        entry = {
+            "lbuild": lbuild.buildcache.get_lbuild_digest(),
+            "schema": get_schema()[1],
+            "files": self._get_stamps(configuration.files),
+            "configuration": configuration,
+        }
+        self.prune()
+        self._write(self.get_entry_filename(configfile), entry)
+
+    def prune(self, max_age=None):
+        """
+        Remove the entries which have not been used for the given number
+        of seconds, `MAX_AGE` by default.
+
+        Returns:
+            Number of removed entries.
+        """
+        if max_age is None:
+            max_age = self.MAX_AGE
+        try:
+            filenames = os.listdir(self.path)
+        except OSError:
+            return 0
+
+        removed = 0
+        threshold = time.time() - max_age
+        for filename in filenames:
+            if not filename.endswith((".pickle", ".tmp")):
+                continue
+            filename = os.path.join(self.path, filename)
+            try:
+                if os.stat(filename).st_mtime < threshold:
+                    os.remove(filename)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _write(self, entryfile, entry):
+        """
+        Write the entry atomically, parallel processes may read it.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            descriptor, tempname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            try:
+                with os.fdopen(descriptor, "wb") as outfile:
+                    pickle.dump(entry, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tempname, entryfile)
+            except BaseException:
+                os.remove(tempname)
+                raise
+        except OSError as error:
+            LOGGER.debug("Unable to write configuration cache: %s", error)
+
 
 class Option:
     """
@@ -48,6 +216,25 @@ class Option:
         return "<Option: {}={}>".format(self.name, self.value)
 
 
+class _ParserState:
+    """
+    Ordered mappings used while parsing the `<extends>` chain.
+
+    Keys with a `None` value are used as ordered sets.
+    """
+
+    def __init__(self, configuration):
+        self.options = collections.OrderedDict((option.name, option)
+                                               for option in configuration.options)
+        self.selected_modules = collections.OrderedDict.fromkeys(configuration.selected_modules)
+        self.repositories = collections.OrderedDict.fromkeys(configuration.repositories)
+
+    def store(self, configuration):
+        configuration.options = list(self.options.values())
+        configuration.selected_modules = list(self.selected_modules)
+        configuration.repositories = list(self.repositories)
+
+
 class Configuration:
 
     def __init__(self):
@@ -61,6 +248,12 @@ class Configuration:
         self.repositories = []
         self.cachefolder = None
         self.vcs = []
+        # Folder of the shared build cache, see `lbuild.buildcache`
+        self.buildcache = None
+
+        # All parsed configuration files, including the files referenced
+        # through `<extends>`.
+        self.files = []
 
     @staticmethod
     def load_and_verify(configfile):
@@ -71,9 +264,7 @@ class Configuration:
             LOGGER.debug("Parse configuration '%s'", configfile)
             xmlroot = lxml.etree.parse(configfile)
 
-            xmlschema = lxml.etree.fromstring(pkgutil.get_data('lbuild', 'resources/configuration.xsd'))
-
-            schema = lxml.etree.XMLSchema(xmlschema)
+            schema, _ = get_schema()
             schema.assertValid(xmlroot)
 
             xmltree = xmlroot.getroot()
@@ -89,28 +280,55 @@ class Configuration:
         return xmltree
 
     @staticmethod
-    def parse_configuration(configfile, childconfig=None):
+    def parse_configuration(configfile, childconfig=None, cache=None):
         """
         Parse the configuration file.
 
         This file contains information about which modules should be included
         and how they are configured.
 
+        Args:
+            configfile: Filename of the configuration.
+            childconfig: Configuration which is extended by the file. Used
+                internally to parse the `<extends>` chain.
+            cache: ConfigurationCache() to reuse the configuration parsed
+                by a previous process. Optional.
+
         Returns:
             Populated Configuration object.
         """
         if childconfig is None:
-            childconfig = Configuration()
+            with lbuild.profiler.phase("config"):
+                if cache is not None:
+                    configuration = cache.get(configfile)
+                    if configuration is not None:
+                        return configuration
+
+                configuration = Configuration.parse_configuration(configfile, Configuration())
+                if cache is not None:
+                    cache.add(configfile, configuration)
+                return configuration
+
+        # The options, modules and repositories are merged in ordered
+        # mappings to keep the parsing linear in the number of entries.
+        # A redefined option is moved to the end, like when appended to
+        # the list.
+        state = _ParserState(childconfig)
+        Configuration._parse_file(configfile, childconfig, state)
+        state.store(childconfig)
+        return childconfig
 
+    @staticmethod
+    def _parse_file(configfile, configuration, state):
         xmltree = Configuration.load_and_verify(configfile)
         configpath = os.path.dirname(configfile)
 
         for basenode in xmltree.iterfind("extends"):
             basefile = Configuration.__get_path(basenode.text, configpath)
-            Configuration.parse_configuration(basefile, childconfig)
+            Configuration._parse_file(basefile, configuration, state)
 
-        configuration = childconfig
         configuration.filename = configfile
+        configuration.files.append(os.path.realpath(configfile))
         configuration.configpath = configpath
 
         # Load cachefolder
@@ -122,6 +340,11 @@ class Configuration:
             cachefolder = os.path.join(configuration.configpath, default)
         configuration.cachefolder = cachefolder
 
+        buildcache_node = xmltree.find("build-cache")
+        if buildcache_node is not None:
+            configuration.buildcache = Configuration.__get_path(buildcache_node.text,
+                                                                configuration.configpath)
+
         # Load version control nodes
         for vcs_node in xmltree.iterfind("repositories/repository/vcs"):
             for vcs in vcs_node.iterchildren():
@@ -134,9 +357,7 @@ class Configuration:
 
             repository_filename = os.path.realpath(os.path.join(configuration.configpath,
                                                                 repository_path))
-
-            if repository_filename not in configuration.repositories:
-                configuration.repositories.append(repository_filename)
+            state.repositories[repository_filename] = None
 
         # Load all requested modules
         for modules_node in xmltree.findall('modules'):
@@ -145,8 +366,7 @@ class Configuration:
                 lbuild.module.verify_module_name(modulename)
 
                 LOGGER.debug("- require module '%s'", modulename)
-                if modulename not in configuration.selected_modules:
-                    configuration.selected_modules.append(modulename)
+                state.selected_modules[modulename] = None
 
         # Load options
         for option_node in xmltree.find('options').findall('option'):
@@ -156,12 +376,8 @@ class Configuration:
             except KeyError:
                 value = option_node.text
 
-            for index, option in enumerate(configuration.options):
-                if option.name == name:
-                    del configuration.options[index]
-            configuration.options.append(Option(name=name, value=value))
-
-        return configuration
+            state.options.pop(name, None)
+            state.options[name] = Option(name=name, value=value)
 
     @staticmethod
     def __get_path(path, configpath):
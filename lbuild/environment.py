@@ -8,17 +8,50 @@
 # governing this code.
 
 import os
+import glob
 import time
+import stat
+import errno
 import shutil
+import filecmp
 import fnmatch
+import hashlib
 import jinja2
 import logging
+import collections
+import tempfile
+import threading
 
+import lbuild.utils
 import lbuild.filter
+import lbuild.profiler
 
 from .exception import BlobException, BlobTemplateException, BlobForwardException
 
 
+def _is_outdated(sourcepath, destpath):
+    """
+    Check if the destination file is missing or older than the source file.
+    """
+    if not os.path.exists(destpath):
+        return True
+    time_diff = os.stat(sourcepath).st_mtime - os.stat(destpath).st_mtime
+    return time_diff > 1
+
+
+def _unlink(destpath):
+    """
+    Remove an existing destination file before writing a new one.
+
+    The file may be a read-only hardlink into a `ContentStore`, writing
+    into it would change the stored file and all other hardlinks to it.
+    """
+    try:
+        os.remove(destpath)
+    except FileNotFoundError:
+        pass
+
+
 def _copyfile(sourcepath, destpath):
     """
     Copy a file if the source file time stamp is newer than the destination
@@ -26,11 +59,86 @@ def _copyfile(sourcepath, destpath):
     """
     if not os.path.exists(destpath):
         shutil.copy2(sourcepath, destpath)
+    elif _is_outdated(sourcepath, destpath):
+        print(destpath, "override")
+        _unlink(destpath)
+        shutil.copy2(sourcepath, destpath)
+
+
+def _walktree(src, dst, ignore=None):
+    """
+    Iterate over all files of a directory tree which are not ignored.
+
+    Yields:
+        Pairs of the source and the destination filename.
+    """
+    files = os.listdir(src)
+    ignored = set() if ignore is None else ignore(src, files)
+
+    for filename in files:
+        if filename not in ignored:
+            sourcepath = os.path.join(src, filename)
+            destpath = os.path.join(dst, filename)
+            if os.path.isdir(sourcepath):
+                yield from _walktree(sourcepath, destpath, ignore)
+            else:
+                yield sourcepath, destpath
+
+
+def _split_glob(pattern):
+    """
+    Split a glob pattern into the leading folders without wildcards and
+    the remaining parts.
+    """
+    parts = pattern.split(os.sep)
+    for index, part in enumerate(parts):
+        if glob.has_magic(part):
+            return os.sep.join(parts[:index]) or os.sep, parts[index:]
+    return os.path.dirname(pattern), [os.path.basename(pattern)]
+
+
+def _iglob(path, parts):
+    """
+    Iterate over the files and folders below the path matching the parts
+    of a glob pattern. `**` matches any number of folders.
+
+    Names starting with a dot are only matched by a pattern starting with
+    a dot, like in the glob module.
+    """
+    if not parts:
+        yield path
+        return
+
+    part, rest = parts[0], parts[1:]
+    if not glob.has_magic(part):
+        if os.path.lexists(os.path.join(path, part)):
+            yield from _iglob(os.path.join(path, part), rest)
+        return
+
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return
+    if not part.startswith("."):
+        names = [name for name in names if not name.startswith(".")]
+
+    if part == "**":
+        yield from _iglob(path, rest)
+        for name in names:
+            if os.path.isdir(os.path.join(path, name)):
+                yield from _iglob(os.path.join(path, name), parts)
     else:
-        time_diff = os.stat(sourcepath).st_mtime - os.stat(destpath).st_mtime
-        if time_diff > 1:
-            print(destpath, "override")
-            shutil.copy2(sourcepath, destpath)
+        for name in fnmatch.filter(names, part):
+            yield from _iglob(os.path.join(path, name), rest)
+
+
+def _makedirs(files):
+    """
+    Create the destination folders of a list of source and destination
+    filenames.
+    """
+    for folder in set(os.path.dirname(destpath) for _, destpath in files):
+        os.makedirs(folder, exist_ok=True)
 
 
 def _copytree(logger, src, dst, ignore=None):
@@ -60,6 +168,22 @@ def _copytree(logger, src, dst, ignore=None):
                 logger(sourcepath, destpath, total)
 
 
+class _FileSystemLoader(jinja2.FileSystemLoader):
+    """
+    Template loader which records the filenames of all loaded templates,
+    including templates used through `include` or `extends`.
+    """
+
+    def __init__(self, searchpath, filenames):
+        jinja2.FileSystemLoader.__init__(self, searchpath)
+        self.filenames = filenames
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = jinja2.FileSystemLoader.get_source(self, environment, template)
+        self.filenames.add(filename)
+        return source, filename, uptodate
+
+
 class Environment:
 
     def __init__(self, options, modules, module, outpath, buildlog):
@@ -82,6 +206,16 @@ class Environment:
         self.outbasepath = None
         self.substitutions = {}
 
+        # Templates are only skipped by a dry run
+        self._render_templates = True
+
+        # Filenames of all templates loaded by the module
+        self.template_files = set()
+        # Rendered templates by output filename and appended metadata,
+        # only recorded for the build cache (see `_start_recording()`)
+        self._rendered = None
+        self._metadata = None
+
     def copy(self, src, dest=None, ignore=None):
         """
         Copy file or directory from the modulepath to the buildpath.
@@ -92,6 +226,10 @@ class Environment:
         If dest is empty the same name as src is used (relocated to
         the output path).
         """
+        with lbuild.profiler.span("copy", self.modulepath(src), self.__module):
+            self.__copy(src, dest, ignore)
+
+    def __copy(self, src, dest, ignore):
         if dest is None:
             dest = src
 
@@ -106,18 +244,114 @@ class Environment:
                                 "'{}'".format(srcrelpath))
 
         if os.path.isdir(srcpath):
-            _copytree(lambda src, dest, time: self.__buildlog.log(self.__module, src, dest, time),
-                      srcpath,
-                      destpath,
-                      ignore)
+            self._copytree(srcpath, destpath, ignore)
         else:
-            if not os.path.exists(os.path.dirname(destpath)):
-                os.makedirs(os.path.dirname(destpath))
-            _copyfile(srcpath, destpath)
+            self._copyfile(srcpath, destpath)
 
             endtime = time.time()
             total = endtime - starttime
-            self.__buildlog.log(self.__module, srcpath, destpath, total)
+            self._log(srcpath, destpath, total)
+
+    def copy_many(self, patterns, dest="", ignore=None):
+        """
+        Copy all files matching the glob patterns from the modulepath to
+        the buildpath.
+
+        Relative patterns are relocated to the module path, `**` matches
+        any number of folders. The path of a file below the leading
+        folders of its pattern without wildcards is kept below `dest`.
+        Matched folders are copied with all their files. Files matched by
+        multiple patterns are copied once.
+
+        Example: the following code copies `src/a/b.h` to `include/a/b.h`:
+        ```
+        env.copy_many(["src/**/*.h", "src/**/*.hpp"], "include",
+                      ignore=env.ignore_files("*_impl.h"))
+        ```
+        """
+        patterns = lbuild.utils.listify(patterns)
+        with lbuild.profiler.span("copy", ", ".join(patterns), self.__module):
+            self._copyfiles(self.__glob(patterns, dest, ignore))
+
+    def __glob(self, patterns, dest, ignore):
+        destpath = os.path.normpath(dest if os.path.isabs(dest) else self.outpath(dest))
+
+        # Source filename -> Destination filename
+        files = collections.OrderedDict()
+        for pattern in patterns:
+            pattern = os.path.normpath(pattern if os.path.isabs(pattern) else self.modulepath(pattern))
+            basepath, parts = _split_glob(pattern)
+            for srcpath in _iglob(basepath, parts):
+                target = os.path.join(destpath, os.path.relpath(srcpath, basepath))
+                if ignore is not None:
+                    folder, filename = os.path.split(srcpath)
+                    if filename in ignore(folder, [filename]):
+                        continue
+                if os.path.isdir(srcpath):
+                    for sourcefile, destfile in _walktree(srcpath, target, ignore):
+                        files.setdefault(sourcefile, destfile)
+                else:
+                    files.setdefault(srcpath, target)
+
+        # All matches are below the pattern, a plain prefix check is
+        # sufficient for the normalized paths
+        repopath = os.path.join(os.path.normpath(self.__repopath), "")
+        for srcpath in files:
+            if not srcpath.startswith(repopath):
+                raise BlobException("Cannot access files outside of the repository!\n"
+                                    "'{}'".format(os.path.relpath(srcpath, self.__repopath)))
+        return list(files.items())
+
+    def _copytree(self, srcpath, destpath, ignore):
+        _copytree(self._log, srcpath, destpath, ignore)
+
+    def _copyfiles(self, files):
+        """
+        Copy a list of source and destination filenames. The destination
+        folders are created once.
+        """
+        _makedirs(files)
+        for srcpath, destpath in files:
+            starttime = time.time()
+            _copyfile(srcpath, destpath)
+            self._log(srcpath, destpath, time.time() - starttime)
+
+    def _copyfile(self, srcpath, destpath):
+        if not os.path.exists(os.path.dirname(destpath)):
+            os.makedirs(os.path.dirname(destpath))
+        _copyfile(srcpath, destpath)
+
+    def _write(self, filename, content):
+        # Create folder structure if it doesn't exists
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        _unlink(filename)
+        with open(filename, 'w') as outfile:
+            outfile.write(content)
+
+    def _restorefile(self, srcpath, destpath):
+        """
+        Write a file restored from the build cache. Unchanged files are not
+        written again.
+        """
+        if os.path.exists(destpath) and filecmp.cmp(srcpath, destpath, shallow=False):
+            return
+        if not os.path.exists(os.path.dirname(destpath)):
+            os.makedirs(os.path.dirname(destpath))
+        _unlink(destpath)
+        shutil.copyfile(srcpath, destpath)
+
+    def _log(self, srcpath, destpath, total, size=None, member=None):
+        return self.__buildlog.log(self.__module, srcpath, destpath, total, size, member)
+
+    def _start_recording(self):
+        """
+        Record the rendered templates and the appended metadata of the
+        build step for the build cache.
+        """
+        self._rendered = {}
+        self._metadata = []
 
     @staticmethod
     def ignore_files(*files):
@@ -180,7 +414,7 @@ class Environment:
                 path = os.path.join(os.path.dirname(parent), template)
                 return os.path.normpath(path).replace('\\','/')
 
-        environment = RelEnvironment(loader=jinja2.FileSystemLoader(self.__repopath),
+        environment = RelEnvironment(loader=_FileSystemLoader(self.__repopath, self.template_files),
                                      extensions=['jinja2.ext.do'],
                                      undefined=jinja2.StrictUndefined)
 
@@ -212,6 +446,10 @@ class Environment:
         If dest is empty the same name as src is used (relocated to
         the output path).
         """
+        with lbuild.profiler.span("template", self.modulepath(src), self.__module):
+            self.__template(src, dest, substitutions, filters)
+
+    def __template(self, src, dest, substitutions, filters):
         starttime = time.time()
 
         if dest is None:
@@ -223,11 +461,16 @@ class Environment:
             else:
                 dest = src
 
+        srcpath = os.path.normpath(self.modulepath(src))
         src = self.repopath(src)
         if src.startswith(".."):
             raise BlobException("Cannot access template outside of repository!\n"
                                 "'{}'".format(src))
 
+        if not self._render_templates:
+            self._log(srcpath, self.outpath(dest), time.time() - starttime)
+            return
+
         if substitutions is None:
             substitutions = {}
 
@@ -251,29 +494,25 @@ class Environment:
                                                  error))
         except jinja2.exceptions.UndefinedError as error:
             raise BlobTemplateException("Error in template '{}':\n"
-                                        " {}: {}".format(self.modulepath(src),
+                                        " {}: {}".format(srcpath,
                                                          error.__class__.__name__,
                                                          error))
         except BlobException as error:
             raise BlobException("Error in template '{}': \n"
-                                "{}".format(self.modulepath(src), error))
+                                "{}".format(srcpath, error))
         except Exception as error:
             raise BlobForwardException("Error in template '{}': \n"
-                                       "{}".format(self.modulepath(src), error),
+                                       "{}".format(srcpath, error),
                                        error)
 
         outfile_name = self.outpath(dest)
-
-        # Create folder structure if it doesn't exists
-        if not os.path.exists(os.path.dirname(outfile_name)):
-            os.makedirs(os.path.dirname(outfile_name))
-
-        with open(outfile_name, 'w') as outfile:
-            outfile.write(output)
+        self._write(outfile_name, output)
+        if self._rendered is not None:
+            self._rendered[outfile_name] = output
 
         endtime = time.time()
         total = endtime - starttime
-        self.__buildlog.log(self.__module, self.modulepath(src), outfile_name, total)
+        self._log(srcpath, outfile_name, total)
 
     def modulepath(self, *path):
         """Relocate given path to the path of the module file."""
@@ -316,6 +555,8 @@ class Environment:
         post-build step to generate additional files/data.
         """
         self.__buildlog.metadata[key].append(value)
+        if self._metadata is not None:
+            self._metadata.append((key, value, False))
 
     def append_metadata_unique(self, key, value):
         """
@@ -325,6 +566,8 @@ class Environment:
         """
         if value not in self.__buildlog.metadata[key]:
             self.__buildlog.metadata[key].append(value)
+        if self._metadata is not None:
+            self._metadata.append((key, value, True))
 
     def assert_new_option(self, key):
         """Query whether an option exists."""
@@ -366,3 +609,328 @@ class Environment:
 
     def __len__(self):
         return len(self.options)
+
+
+class DryRunEnvironment(Environment):
+    """
+    Environment which records the planned operations without writing any
+    file into the output path.
+
+    The operations are logged with the size of their source file. Templates
+    are only rendered, and their render time recorded, if requested.
+    Files written by a module without using the environment are not
+    prevented.
+    """
+
+    def __init__(self, options, modules, module, outpath, buildlog, render_templates=False):
+        Environment.__init__(self, options, modules, module, outpath, buildlog)
+        self._render_templates = render_templates
+
+    def _copytree(self, srcpath, destpath, ignore):
+        self._copyfiles(_walktree(srcpath, destpath, ignore))
+
+    def _copyfiles(self, files):
+        for srcpath, destpath in files:
+            self._log(srcpath, destpath, 0)
+
+    def _copyfile(self, srcpath, destpath):
+        pass
+
+    def _write(self, filename, content):
+        pass
+
+    def _log(self, srcpath, destpath, total, size=None, member=None):
+        return Environment._log(self, srcpath, destpath, total, os.path.getsize(srcpath), member)
+
+
+class OutputStage:
+    """
+    Collect the outputs of a build and move them into the output path at
+    once at the end of the build.
+
+    The files are staged in a hidden folder inside the output path, which
+    keeps them on the same filesystem and allows moving them with a rename.
+    Small generated files are kept in memory until the commit. Nothing is
+    changed in the output path if the build fails.
+
+    Each file is replaced atomically. The files are moved one after the
+    other, but only after all of them have been staged.
+    """
+
+    # Generated files up to this size are kept in memory
+    MEMORY_LIMIT = 64 * 1024
+
+    def __init__(self, outpath):
+        self.outpath = outpath
+
+        # Destination filename -> (Staged filename, content kept in memory)
+        self._files = {}
+        self._folder = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def _get_staged_filename(self):
+        if self._folder is None:
+            os.makedirs(self.outpath, exist_ok=True)
+            self._folder = tempfile.mkdtemp(prefix=".lbuild_stage_", dir=self.outpath)
+        self._count += 1
+        return os.path.join(self._folder, str(self._count))
+
+    def copy(self, sourcepath, destpath, force=False):
+        """
+        Stage a copy of the file. Up to date files are not copied again,
+        unless forced.
+        """
+        if not force and not _is_outdated(sourcepath, destpath):
+            return
+        with self._lock:
+            stagedpath = self._get_staged_filename()
+            shutil.copy2(sourcepath, stagedpath)
+            self._files[destpath] = (stagedpath, None)
+
+    def write(self, destpath, content):
+        with self._lock:
+            if len(content) <= self.MEMORY_LIMIT:
+                self._files[destpath] = (None, content)
+            else:
+                stagedpath = self._get_staged_filename()
+                with open(stagedpath, 'w') as outfile:
+                    outfile.write(content)
+                self._files[destpath] = (stagedpath, None)
+
+    def commit(self):
+        """
+        Move all staged files into the output path.
+        """
+        with self._lock:
+            files = []
+            for destpath, (stagedpath, content) in sorted(self._files.items()):
+                if stagedpath is None:
+                    stagedpath = self._get_staged_filename()
+                    with open(stagedpath, 'w') as outfile:
+                        outfile.write(content)
+                files.append((stagedpath, destpath))
+
+            for folder in sorted(set(os.path.dirname(destpath) for _, destpath in files)):
+                os.makedirs(folder, exist_ok=True)
+
+            for stagedpath, destpath in files:
+                try:
+                    os.replace(stagedpath, destpath)
+                except OSError as error:
+                    if error.errno != errno.EXDEV:
+                        raise
+                    # Absolute destination on a different filesystem
+                    _unlink(destpath)
+                    shutil.move(stagedpath, destpath)
+            self._clear()
+
+    def discard(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+        self._files.clear()
+
+
+class StagedEnvironment(Environment):
+    """
+    Environment which writes the outputs into an `OutputStage` instead of
+    the output path.
+    """
+
+    def __init__(self, options, modules, module, outpath, buildlog, stage):
+        Environment.__init__(self, options, modules, module, outpath, buildlog)
+        self._stage = stage
+
+    def _copytree(self, srcpath, destpath, ignore):
+        self._copyfiles(_walktree(srcpath, destpath, ignore))
+
+    def _copyfiles(self, files):
+        for srcpath, destpath in files:
+            starttime = time.time()
+            self._stage.copy(srcpath, destpath)
+            self._log(srcpath, destpath, time.time() - starttime)
+
+    def _copyfile(self, srcpath, destpath):
+        self._stage.copy(srcpath, destpath)
+
+    def _write(self, filename, content):
+        self._stage.write(filename, content)
+
+    def _restorefile(self, srcpath, destpath):
+        if os.path.exists(destpath) and filecmp.cmp(srcpath, destpath, shallow=False):
+            return
+        self._stage.copy(srcpath, destpath, force=True)
+
+
+class ArchiveEnvironment(Environment):
+    """
+    Environment which adds the outputs to an `OutputArchive` instead of
+    writing them into the output path.
+
+    The operations are logged with the name of their archive member.
+    """
+
+    def __init__(self, options, modules, module, outpath, buildlog, archive):
+        Environment.__init__(self, options, modules, module, outpath, buildlog)
+        self._archive = archive
+
+    def _copytree(self, srcpath, destpath, ignore):
+        self._copyfiles(_walktree(srcpath, destpath, ignore))
+
+    def _copyfiles(self, files):
+        for srcpath, destpath in files:
+            starttime = time.time()
+            self._archive.add_file(srcpath, destpath)
+            self._log(srcpath, destpath, time.time() - starttime)
+
+    def _copyfile(self, srcpath, destpath):
+        self._archive.add_file(srcpath, destpath)
+
+    def _write(self, filename, content):
+        self._archive.add_content(filename, content)
+
+    def _restorefile(self, srcpath, destpath):
+        self._archive.add_file(srcpath, destpath)
+
+    def _log(self, srcpath, destpath, total, size=None, member=None):
+        return Environment._log(self, srcpath, destpath, total, size,
+                                self._archive.get_member(destpath))
+
+
+class ContentStore:
+    """
+    Folder with the content of output files, keyed by the SHA-256 of the
+    content.
+
+    The output files are hardlinks to the files in the store. Identical
+    files of multiple output paths therefore use the disk space only once.
+    The files in the store are read-only, this applies to the hardlinks
+    as well. Outputs on a different filesystem than the store are copied.
+
+    Files are never removed from the store.
+    """
+
+    def __init__(self, path=None):
+        self.path = lbuild.utils.get_user_cache_folder("store") if path is None else path
+
+        # Source filename -> (mtime, SHA-256 of the content)
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _get_filename(self, digest, executable):
+        # The permissions are shared by all hardlinks, executable files are
+        # stored separately
+        name = digest + "-x" if executable else digest
+        return os.path.join(self.path, digest[:2], name)
+
+    def _add(self, filename, write, executable):
+        if not os.path.exists(filename):
+            folder = os.path.dirname(filename)
+            os.makedirs(folder, exist_ok=True)
+            fd, tempname = tempfile.mkstemp(prefix=".tmp_", dir=folder)
+            try:
+                with os.fdopen(fd, "wb") as outfile:
+                    write(outfile)
+                os.chmod(tempname, 0o555 if executable else 0o444)
+                os.replace(tempname, filename)
+            except BaseException:
+                os.remove(tempname)
+                raise
+        return filename
+
+    def add_file(self, sourcepath):
+        """
+        Add a copy of the file.
+
+        Returns:
+            Filename within the store.
+        """
+        status = os.stat(sourcepath)
+        with self._lock:
+            entry = self._hashes.get(sourcepath, None)
+        if entry is None or entry[0] != status.st_mtime:
+            digest = hashlib.sha256()
+            with open(sourcepath, "rb") as infile:
+                for block in iter(lambda: infile.read(1 << 16), b""):
+                    digest.update(block)
+            entry = (status.st_mtime, digest.hexdigest())
+            with self._lock:
+                self._hashes[sourcepath] = entry
+
+        def write(outfile):
+            with open(sourcepath, "rb") as infile:
+                shutil.copyfileobj(infile, outfile)
+
+        executable = bool(status.st_mode & stat.S_IXUSR)
+        return self._add(self._get_filename(entry[1], executable), write, executable)
+
+    def add_content(self, content):
+        """
+        Add a generated file.
+
+        Returns:
+            Filename within the store.
+        """
+        content = content.encode("utf-8")
+        digest = hashlib.sha256(content).hexdigest()
+        return self._add(self._get_filename(digest, False),
+                         lambda outfile: outfile.write(content), False)
+
+    @staticmethod
+    def link(storedpath, destpath):
+        """
+        Replace the destination with a hardlink to the stored file.
+        """
+        if os.path.exists(destpath) and os.path.samefile(storedpath, destpath):
+            return
+
+        folder = os.path.dirname(destpath)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        tempname = os.path.join(folder, ".lbuild_link_{}_{}".format(
+            os.getpid(), threading.get_ident()))
+        try:
+            os.link(storedpath, tempname)
+        except OSError:
+            # Different filesystem or no hardlink support
+            shutil.copyfile(storedpath, tempname)
+        os.replace(tempname, destpath)
+
+
+class StoreEnvironment(Environment):
+    """
+    Environment which places the outputs into a `ContentStore` and
+    hardlinks them into the output path.
+    """
+
+    def __init__(self, options, modules, module, outpath, buildlog, store):
+        Environment.__init__(self, options, modules, module, outpath, buildlog)
+        self._store = store
+
+    def _copytree(self, srcpath, destpath, ignore):
+        self._copyfiles(list(_walktree(srcpath, destpath, ignore)))
+
+    def _copyfiles(self, files):
+        _makedirs(files)
+        for srcpath, destpath in files:
+            starttime = time.time()
+            self._copyfile(srcpath, destpath)
+            self._log(srcpath, destpath, time.time() - starttime)
+
+    def _copyfile(self, srcpath, destpath):
+        if _is_outdated(srcpath, destpath):
+            self._store.link(self._store.add_file(srcpath), destpath)
+
+    def _write(self, filename, content):
+        self._store.link(self._store.add_content(content), filename)
+
+    def _restorefile(self, srcpath, destpath):
+        self._store.link(self._store.add_file(srcpath), destpath)
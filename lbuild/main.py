@@ -8,15 +8,39 @@
 # 2-clause BSD license. See the file `LICENSE.txt` for the full license
 # governing this code.
 
+import os
 import sys
+import json
+import time
 import argparse
 import textwrap
 import traceback
 
+import lbuild.plan
+import lbuild.archive
+import lbuild.buildcache
 import lbuild.parser
 import lbuild.logger
+import lbuild.server
+import lbuild.watch
 import lbuild.module
+import lbuild.profiler
 import lbuild.vcs.common
+import lbuild.vcs.snapshot
+
+
+DEFAULT_CONFIG = "project.xml"
+
+
+def write_buildlog(configfilename, log):
+    logfilename = lbuild.plan.get_buildlog_filename(configfilename)
+    with open(logfilename, "wb") as logfile:
+        logfile.write(log.to_xml(to_string=True))
+
+
+def load_configuration(args, configfilename):
+    cache = lbuild.config.ConfigurationCache() if args.config_cache else None
+    return lbuild.config.Configuration.parse_configuration(configfilename, cache=cache)
 
 
 def get_modules(parser, repo_options, config_options, selected_module_names=None):
@@ -32,6 +56,17 @@ def get_modules(parser, repo_options, config_options, selected_module_names=None
     return build_modules, module_options
 
 
+def get_build_cache(args, config):
+    """
+    Path of the build cache from the command line or the configuration.
+    """
+    if not args.use_build_cache:
+        return None
+    if args.build_cache is not None:
+        return args.build_cache
+    return config.buildcache
+
+
 def is_repository_option(option_name):
     parts = option_name.split(":")
     if len(parts) < 2:
@@ -42,15 +77,34 @@ def is_repository_option(option_name):
         return False
 
 
+def add_vcs_arguments(parser):
+    parser.add_argument("-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=lbuild.vcs.common.DEFAULT_JOBS,
+        help="Number of repositories processed in parallel (default: %(default)s).")
+    parser.add_argument("--object-store",
+        metavar="PATH",
+        dest="object_store",
+        nargs="?",
+        const=lbuild.vcs.common.DEFAULT_OBJECT_STORE,
+        default=None,
+        help="Share the git objects with the repositories of other cache "
+             "folders through a user level object store (default: "
+             "'$XDG_CACHE_HOME/lbuild/git'). Only objects not in the store "
+             "are transferred.")
+
+
 class InitAction:
 
     def register(self, argument_parser):
         parser = argument_parser.add_parser("init",
             help="Load remote repositories into the cache folder.")
+        add_vcs_arguments(parser)
         parser.set_defaults(execute_action=self.perform)
 
     def perform(self, args, config):
-        lbuild.vcs.common.initialize(config)
+        lbuild.vcs.common.initialize(config, args.jobs, print, args.object_store)
         return ""
 
 
@@ -59,21 +113,60 @@ class UpdateAction:
     def register(self, argument_parser):
         parser = argument_parser.add_parser("update",
             help="Update the content of remote repositories in the cache folder.")
+        add_vcs_arguments(parser)
         parser.set_defaults(execute_action=self.perform)
 
     def perform(self, args, config):
-        lbuild.vcs.common.update(config)
+        lbuild.vcs.common.update(config, args.jobs, print, args.object_store)
         return ""
 
 
+class SnapshotAction:
+
+    def register(self, argument_parser):
+        parser = argument_parser.add_parser("snapshot",
+            help="Pack the checked out repositories and caches of the cache "
+                 "folder into an archive for offline use.")
+        parser.add_argument("archive",
+            metavar="ARCHIVE",
+            help="Archive file ('.tar', '.tar.gz', '.tar.bz2' or '.tar.xz').")
+        parser.set_defaults(execute_action=self.perform)
+
+    def perform(self, args, config):
+        manifest = lbuild.vcs.snapshot.create(config, args.archive)
+        return "\n".join("{}: {}".format(path, entry["head"])
+                         for path, entry in sorted(manifest["repositories"].items()))
+
+
+class RestoreAction:
+
+    def register(self, argument_parser):
+        parser = argument_parser.add_parser("restore",
+            help="Unpack a snapshot archive into the cache folder. The "
+                 "restored repositories are not cloned by 'init'.")
+        parser.add_argument("archive",
+            metavar="ARCHIVE",
+            help="Archive file created by 'snapshot'.")
+        parser.set_defaults(execute_action=self.perform)
+
+    def perform(self, args, config):
+        manifest = lbuild.vcs.snapshot.restore(config, args.archive)
+        return "\n".join("{}: {}".format(path, entry["head"])
+                         for path, entry in sorted(manifest["repositories"].items()))
+
+
 class ManipulationActionBase:
     """
     Base class for actions that interact directly with the parser repositories.
     """
 
     def prepare_repositories(self, args, config):
-        parser = lbuild.parser.Parser()
-        parser.load_repositories(config, args.repositories)
+        if args.cache is not None:
+            # Reuse the parsed repositories of a previous command
+            parser = args.cache.get_parser(config, args.repositories)
+        else:
+            parser = lbuild.parser.Parser()
+            parser.load_repositories(config, args.repositories)
 
         commandline_options = config.format_commandline_options(args.options)
         repo_options = parser.merge_repository_options(config.options, commandline_options)
@@ -121,7 +214,7 @@ class DiscoverModuleAction(ManipulationActionBase):
 
     def register(self, argument_parser):
         parser = argument_parser.add_parser("discover-module",
-            aliases=['option'],
+            aliases=['module'],
             help="Print the description of one module.")
         parser.add_argument("-m", "--module-name",
             dest="module_name",
@@ -272,21 +365,272 @@ class BuildAction(ManipulationActionBase):
             help="Do not create a build log. This log contains all files being "
                  "generated, their source files and the module which generated "
                  "the file.")
-        parser.set_defaults(execute_action=self.prepare_repositories)
+        parser.add_argument("--watch",
+            dest="watch",
+            action="store_true",
+            default=False,
+            help="Keep running and rebuild when the configuration, a repository "
+                 "or module file, or a used template or source file changes. "
+                 "Only modules using a changed template or source file are "
+                 "built again.")
+        parser.add_argument("-j", "--jobs",
+            dest="jobs",
+            type=int,
+            default=1,
+            help="Number of worker processes used when building multiple "
+                 "configurations (default: %(default)s).")
+        parser.add_argument("--staged",
+            dest="staged",
+            action="store_true",
+            default=False,
+            help="Collect all generated files and move them into the output "
+                 "path at the end of a successful build. A failed build leaves "
+                 "the output path unchanged.")
+        parser.add_argument("--dry-run",
+            dest="dry_run",
+            action="store_true",
+            default=False,
+            help="Execute the build steps of the modules without writing any "
+                 "file into the output path. Prints a build log of the "
+                 "planned operations with the size of their source files.")
+        parser.add_argument("--render-templates",
+            dest="render_templates",
+            action="store_true",
+            default=False,
+            help="Render the templates during a dry run to record their "
+                 "render time.")
+        parser.add_argument("--output-archive",
+            dest="output_archive",
+            default=None,
+            metavar="ARCHIVE",
+            help="Write the generated files into an archive ('.zip', '.tar', "
+                 "'.tar.gz', '.tar.bz2', '.tar.xz' or '.tar.zst') instead of "
+                 "the output path. The member names are relative to the output "
+                 "path. The archive is reproducible.")
+        parser.add_argument("--build-cache",
+            dest="build_cache",
+            metavar="PATH",
+            default=None,
+            help="Restore the outputs of unchanged modules from a shared build "
+                 "cache folder and add the outputs of the other modules. "
+                 "Overrides the '<build-cache>' of the configuration.")
+        parser.add_argument("--no-build-cache",
+            dest="use_build_cache",
+            action="store_false",
+            default=True,
+            help="Do not use the build cache of the configuration.")
+        parser.add_argument("--content-store",
+            dest="content_store",
+            metavar="PATH",
+            nargs="?",
+            const="",
+            default=None,
+            help="Place the generated files into a content store shared by "
+                 "all output paths and hardlink them into the output path "
+                 "(default: '$XDG_CACHE_HOME/lbuild/store'). Identical files "
+                 "use the disk space only once. The hardlinked files are "
+                 "read-only.")
+        parser.set_defaults(execute_action=self.dispatch, multiple_configs=True)
+
+    def dispatch(self, args, config):
+        if args.dry_run and (args.watch or len(args.configs) > 1):
+            raise lbuild.exception.BlobArgumentException(
+                "A dry run is only supported for a single configuration without watch mode")
+        if args.output_archive is not None:
+            if args.watch or args.staged or args.dry_run or len(args.configs) > 1:
+                raise lbuild.exception.BlobArgumentException(
+                    "An output archive is only supported for a single configuration "
+                    "without watch mode, staging or dry run")
+            lbuild.archive.check_format(args.output_archive)
+        if args.content_store is not None and (args.staged or args.output_archive is not None):
+            raise lbuild.exception.BlobArgumentException(
+                "A content store can not be combined with staging or an output archive")
+        if len(args.configs) > 1:
+            return self.build_batch(args, config)
+        return self.prepare_repositories(args, config)
+
+    def build_batch(self, args, config):
+        """
+        Build multiple configurations sharing the parsed repositories.
+
+        Each configuration is generated into a separate folder inside the
+        output path, named after the configuration file.
+        """
+        if args.watch:
+            raise lbuild.exception.BlobArgumentException(
+                "Watch mode is only supported for a single configuration")
+
+        configurations = [config]
+        for configfilename in args.configs[1:]:
+            configurations.append(load_configuration(args, configfilename))
+
+        outpaths = []
+        for configfilename in args.configs:
+            name = os.path.splitext(os.path.basename(configfilename))[0]
+            outpaths.append(os.path.join(args.path, name))
+        if len(set(outpaths)) != len(outpaths):
+            raise lbuild.exception.BlobArgumentException(
+                "The names of the configuration files must be unique")
+
+        for configuration in configurations:
+            configuration.selected_modules.extend(args.modules)
+            configuration.buildcache = get_build_cache(args, configuration)
+
+        logs = lbuild.parser.build_configurations(configurations,
+                                                  outpaths,
+                                                  args.options,
+                                                  args.repositories,
+                                                  args.jobs,
+                                                  args.staged,
+                                                  args.content_store)
+        if args.buildlog:
+            for configfilename, log in zip(args.configs, logs):
+                write_buildlog(configfilename, log)
+        return ""
 
     def perform(self, args, parser, config, repo_options):
+        if args.dry_run:
+            return self.dry_run(args, parser, config, repo_options)
+
+        build_operations = self.build(args, parser, config, repo_options)
+        if args.watch:
+            self.watch(args, parser, config, build_operations)
+        return ""
+
+    @staticmethod
+    def build(args, parser, config, repo_options, previous=None):
         log = lbuild.buildlog.BuildLog()
 
-        config.selected_modules.extend(args.modules)
-        build_modules, module_options = get_modules(parser, repo_options, config.options, config.selected_modules)
-        parser.build_modules(args.path, build_modules, repo_options, module_options, log)
+        selected_modules = config.selected_modules + args.modules
+        build_modules, module_options = get_modules(parser, repo_options, config.options, selected_modules)
+        build_operations = parser.build_modules(args.path, build_modules, repo_options,
+                                                module_options, log, previous,
+                                                staged=args.staged,
+                                                archive=args.output_archive,
+                                                build_cache=get_build_cache(args, config),
+                                                content_store=args.content_store)
 
         if args.buildlog:
-            configfilename = args.config
-            logfilename = configfilename + ".log"
-            with open(logfilename, "wb") as logfile:
-                logfile.write(log.to_xml(to_string=True))
-        return ""
+            write_buildlog(args.config, log)
+        return build_operations
+
+    @staticmethod
+    def dry_run(args, parser, config, repo_options):
+        log = lbuild.buildlog.BuildLog()
+
+        selected_modules = config.selected_modules + args.modules
+        build_modules, module_options = get_modules(parser, repo_options, config.options, selected_modules)
+        parser.build_modules(args.path, build_modules, repo_options, module_options, log,
+                             dry_run=True, render_templates=args.render_templates)
+
+        # The build log of the previous build is kept
+        return log.to_xml(to_string=True).decode("utf-8")
+
+    def watch(self, args, parser, config, build_operations):
+        cache = args.cache if args.cache is not None else lbuild.server.RepositoryCache()
+        cache.add(config, args.repositories, parser)
+
+        watcher = lbuild.watch.create_watcher()
+        failed = False
+        print("Watching for changes...")
+        try:
+            while True:
+                filenames = lbuild.watch.get_watched_files(config, parser, build_operations)
+                changed = watcher.wait(filenames)
+
+                previous = None
+                if not failed and not lbuild.watch.requires_full_build(config, parser, changed):
+                    affected = lbuild.watch.get_affected_modules(build_operations, changed)
+                    previous = {name: operations for name, operations in build_operations.items()
+                                if name not in affected}
+
+                starttime = time.time()
+                try:
+                    config = load_configuration(args, args.config)
+                    parser = cache.get_parser(config, args.repositories)
+
+                    commandline_options = config.format_commandline_options(args.options)
+                    repo_options = parser.merge_repository_options(config.options,
+                                                                   commandline_options)
+                    build_operations = self.build(args, parser, config, repo_options, previous)
+                    cache.update()
+                except lbuild.exception.BlobException as error:
+                    sys.stderr.write("\nERROR: {}\n".format(error))
+                    # Output files might be incomplete, build all modules
+                    # after the next change.
+                    failed = True
+                    continue
+
+                failed = False
+                rebuilt = [name for name in build_operations if name not in (previous or {})]
+                print("Built {} of {} modules in {:.3f} s".format(len(rebuilt),
+                                                              len(build_operations),
+                                                              time.time() - starttime))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+
+class PlanAction:
+
+    def register(self, argument_parser):
+        parser = argument_parser.add_parser("plan",
+            help="Compare the configuration with a previous configuration or "
+                 "build and list the changed options, the affected modules and "
+                 "their outputs without building the library.")
+        parser.add_argument("--from",
+            metavar="CONFIG",
+            dest="old_config",
+            help="Previous configuration. Uses the configuration recorded in "
+                 "the build log if not given.")
+        parser.add_argument("--to",
+            metavar="CONFIG",
+            dest="new_config",
+            help="New configuration (default: the configuration given with "
+                 "'--config').")
+        parser.add_argument("--buildlog",
+            metavar="LOG",
+            dest="buildlog",
+            help="Build log of the previous build (default: the build log "
+                 "written by 'build' for the new configuration).")
+        parser.add_argument("--json",
+            dest="json",
+            action="store_true",
+            default=False,
+            help="Print the plan as JSON.")
+        parser.set_defaults(execute_action=self.perform, load_config=False)
+
+    @staticmethod
+    def _load_parser(args, config):
+        parser = lbuild.parser.Parser()
+        parser.load_repositories(config, args.repositories)
+        return parser
+
+    def perform(self, args, config):
+        newfilename = args.config if args.new_config is None else args.new_config
+        new_config = load_configuration(args, newfilename)
+        old_config = None
+        if args.old_config is not None:
+            old_config = load_configuration(args, args.old_config)
+        buildlog = args.buildlog
+        if buildlog is None:
+            buildlog = lbuild.plan.get_buildlog_filename(newfilename)
+
+        with self._load_parser(args, new_config) as parser:
+            old_parser = None
+            if old_config is not None and old_config.repositories != new_config.repositories:
+                old_parser = self._load_parser(args, old_config)
+            try:
+                plan = lbuild.plan.plan(parser, new_config, old_config, buildlog,
+                                        args.options, old_parser)
+            finally:
+                if old_parser is not None:
+                    old_parser.close()
+
+        if args.json:
+            return json.dumps(plan.to_dict(), indent=2)
+        return plan.format()
 
 
 class CleanAction(ManipulationActionBase):
@@ -316,6 +660,55 @@ class CleanAction(ManipulationActionBase):
         return ""
 
 
+class PruneCacheAction:
+
+    def register(self, argument_parser):
+        parser = argument_parser.add_parser("prune-cache",
+            help="Remove the least recently used entries of the build cache "
+                 "until it is smaller than the given size.")
+        parser.add_argument("--max-size",
+            dest="max_size",
+            required=True,
+            help="Maximum size of the build cache, e.g. '500M' or '10G'.")
+        parser.add_argument("--build-cache",
+            dest="build_cache",
+            metavar="PATH",
+            default=None,
+            help="Build cache folder. Default is the '<build-cache>' of the "
+                 "configuration.")
+        parser.set_defaults(execute_action=self.perform, load_config=False)
+
+    def perform(self, args, config):
+        path = args.build_cache
+        if path is None:
+            path = load_configuration(args, args.config).buildcache
+            if path is None:
+                raise lbuild.exception.BlobArgumentException(
+                    "The configuration does not define a build cache")
+
+        max_size = lbuild.buildcache.parse_size(args.max_size)
+        entries, size = lbuild.buildcache.BuildCache(path).evict(max_size)
+        return "Removed {} entries ({} bytes) from '{}'".format(entries, size, path)
+
+
+class ServeAction:
+
+    def register(self, argument_parser):
+        parser = argument_parser.add_parser("serve",
+            help="Start a server which keeps the parsed repositories and "
+                 "prepared modules in memory. Use the '--connect' argument to "
+                 "forward commands to the server.")
+        parser.add_argument("--socket",
+            dest="socket",
+            default=lbuild.server.DEFAULT_SOCKET,
+            help="Path of the Unix domain socket (default: '%(default)s').")
+        parser.set_defaults(execute_action=self.perform, load_config=False)
+
+    def perform(self, args, config):
+        lbuild.server.serve(args.socket)
+        return ""
+
+
 def prepare_argument_parser():
     """
     Set up the argument parser for the different commands.
@@ -334,11 +727,14 @@ def prepare_argument_parser():
              "The loading of repository files from a VCS is only supported through "
              "the library configuration file.")
     argument_parser.add_argument('-c', '--config',
-        dest='config',
-        default='project.xml',
+        metavar='CONFIG',
+        dest='configs',
+        action='append',
+        default=[],
         help="Project/library configuration file. "
              "Specifies the used repositories, modules and options "
-             "(default: '%(default)s').")
+             "(default: '{}'). The build command accepts multiple "
+             "configuration files.".format(DEFAULT_CONFIG))
     argument_parser.add_argument('-p', '--path',
         dest='path',
         default='.',
@@ -358,6 +754,46 @@ def prepare_argument_parser():
         action='count',
         default=0,
         dest='verbose')
+    argument_parser.add_argument('--profile',
+        dest='profile',
+        action='store_true',
+        default=False,
+        help="Print the time spent in each phase of the build together with "
+             "the slowest modules and templates.")
+    argument_parser.add_argument('--profile-json',
+        metavar='FILE',
+        dest='profile_json',
+        help="Write the profiling results as JSON into the given file.")
+    argument_parser.add_argument('--profile-top',
+        metavar='N',
+        dest='profile_top',
+        type=int,
+        default=10,
+        help="Number of modules and templates listed in the profiling "
+             "results (default: %(default)s).")
+    argument_parser.add_argument('--profile-memory',
+        dest='profile_memory',
+        action='store_true',
+        default=False,
+        help="Trace memory allocations and print the memory used in each "
+             "phase of the build together with the modules and templates "
+             "allocating the most memory. Slows down the build considerably.")
+    argument_parser.add_argument('--trace',
+        metavar='FILE',
+        dest='trace',
+        help="Write a Chrome trace event file (viewable with Perfetto or "
+             "chrome://tracing) of all phases and module functions.")
+    argument_parser.add_argument('--no-config-cache',
+        dest='config_cache',
+        action='store_false',
+        default=True,
+        help="Always parse and validate the configuration files instead of "
+             "using the configuration cache in '$XDG_CACHE_HOME/lbuild/config'.")
+    argument_parser.add_argument('--connect',
+        metavar='SOCKET',
+        dest='connect',
+        help="Forward the command to a server started with 'lbuild serve'.")
+    argument_parser.set_defaults(cache=None, load_config=True, multiple_configs=False)
 
     subparsers = argument_parser.add_subparsers(title="Actions",
         dest="action")
@@ -365,6 +801,8 @@ def prepare_argument_parser():
     actions = [
         InitAction(),
         UpdateAction(),
+        SnapshotAction(),
+        RestoreAction(),
         DiscoverRepositoryAction(),
         DiscoverModulesAction(),
         DiscoverModuleAction(),
@@ -373,7 +811,10 @@ def prepare_argument_parser():
         DiscoverOptionAction(),
         DiscoverOptionValuesAction(),
         BuildAction(),
+        PlanAction(),
         CleanAction(),
+        PruneCacheAction(),
+        ServeAction(),
     ]
     for action in actions:
         action.register(subparsers)
@@ -384,23 +825,105 @@ def prepare_argument_parser():
 def run(args):
     lbuild.logger.configure_logger(args.verbose)
 
-    config = lbuild.config.Configuration.parse_configuration(args.config)
-    try:
-        command = args.execute_action
-    except AttributeError:
-        raise lbuild.exception.BlobArgumentException("No command specified")
-    return command(args, config)
+    profiler = None
+    if args.profile or args.profile_json is not None:
+        profiler = lbuild.profiler.Profiler()
+        lbuild.profiler.enable(profiler)
+
+    memory = None
+    if args.profile_memory:
+        memory = lbuild.profiler.MemoryProfiler()
+        memory.start()
+        lbuild.profiler.enable(memory)
 
+    tracer = None
+    if args.trace is not None:
+        tracer = lbuild.profiler.Tracer()
+        lbuild.profiler.enable(tracer)
 
-def main():
+    try:
+        try:
+            command = args.execute_action
+        except AttributeError:
+            raise lbuild.exception.BlobArgumentException("No command specified")
+
+        if len(args.configs) == 0:
+            args.configs = [DEFAULT_CONFIG]
+        elif len(args.configs) > 1 and not args.multiple_configs:
+            raise lbuild.exception.BlobArgumentException(
+                "Multiple configurations are only supported by the build command")
+        args.config = args.configs[0]
+
+        config = None
+        if args.load_config:
+            config = load_configuration(args, args.config)
+        return command(args, config)
+    finally:
+        if profiler is not None:
+            lbuild.profiler.disable(profiler)
+        if memory is not None:
+            lbuild.profiler.disable(memory)
+            memory.stop()
+        if tracer is not None:
+            lbuild.profiler.disable(tracer)
+            with open(args.trace, "w") as tracefile:
+                tracefile.write(tracer.to_json())
+        write_profile(args, profiler, memory)
+
+
+def write_profile(args, profiler, memory):
+    if args.profile:
+        sys.stderr.write(profiler.format(args.profile_top) + "\n")
+    if memory is not None:
+        sys.stderr.write(memory.format(args.profile_top) + "\n")
+
+    if args.profile_json is not None:
+        profile = profiler.to_dict(args.profile_top)
+        if memory is not None:
+            profile["memory"] = memory.to_dict(args.profile_top)
+        with open(args.profile_json, "w") as profilefile:
+            json.dump(profile, profilefile, indent=2)
+
+
+def remove_connect_argument(argv):
+    """
+    Remove the '--connect' argument before forwarding the command line to
+    the server.
+    """
+    result = []
+    skip = False
+    for argument in argv:
+        if skip:
+            skip = False
+        elif argument == "--connect":
+            skip = True
+        elif not argument.startswith("--connect="):
+            result.append(argument)
+    return result
+
+
+def main(argv=None, cache=None):
     """
     Main entry point of lbuild.
+
+    Args:
+        argv: Command line arguments without the program name. Defaults
+            to `sys.argv[1:]`.
+        cache: Repository cache of a server process (see `lbuild.server`).
     """
     try:
         argument_parser = prepare_argument_parser()
 
-        commandline_arguments = sys.argv[1:]
+        commandline_arguments = sys.argv[1:] if argv is None else argv
         args = argument_parser.parse_args(commandline_arguments)
+        args.cache = cache
+
+        if args.connect is not None:
+            status = lbuild.server.forward(args.connect,
+                                           remove_connect_argument(commandline_arguments),
+                                           sys.stdout,
+                                           sys.stderr)
+            sys.exit(status)
 
         output = run(args)
         print(output)
@@ -17,6 +17,7 @@ import textwrap
 import lbuild.utils
 import lbuild.filter
 import lbuild.option
+import lbuild.profiler
 import lbuild.repository
 
 from . import exception
@@ -169,40 +170,89 @@ class OptionNameResolver:
     Option name resolver for module options.
     """
 
-    def __init__(self, repository, module, repo_options, module_options):
+    def __init__(self, repository, module, repo_options, module_options, accessed=None):
+        """
+        Args:
+            accessed (set): If given, the full names of all options which
+                are read are added to the set.
+        """
         self.repository = repository
         self.module = module
         self.repo_options = repo_options
         self.module_options = module_options
+        self.accessed = accessed
+
+        # Option name as used in the module -> (Full name, Option())
+        #
+        # Filled with all spellings of the repository options and the
+        # options of the module itself. Other names are added when they
+        # are resolved for the first time.
+        self._lookup = {}
+        self._fill_lookup()
+
+    def _fill_lookup(self):
+        for fullname, option in self.repo_options.items():
+            self._lookup[fullname] = (fullname, option)
+            repo, _, name = fullname.partition(":")
+            if repo == self.repository.name:
+                self._lookup[":" + name] = (fullname, option)
+
+        module_parts = self.module.fullname.split(":")
+        for name in self.module.options:
+            fullname = "{}:{}".format(self.module.fullname, name)
+            option = self.module_options.get(fullname, None)
+            if option is None:
+                continue
+
+            self._lookup[name] = (fullname, option)
+            # Every part of the module name may be left empty
+            for omitted in itertools.product((False, True), repeat=len(module_parts)):
+                parts = ["" if omit else part for omit, part in zip(omitted, module_parts)]
+                parts.append(name)
+                self._lookup[":".join(parts)] = (fullname, option)
+
+    def _resolve(self, key):
+        option_parts = key.split(":")
+        depth = len(option_parts)
+        if depth < 2:
+            fullname = "{}:{}".format(self.module.fullname, key)
+            return fullname, self.module_options[fullname]
+        elif depth == 2:
+            # Repository option
+            repo, option = option_parts
+            fullname = key
+            if repo == "":
+                fullname = "%s:%s" % (self.repository.name, option)
+
+            return fullname, self.repo_options[fullname]
+        else:
+            option_name = option_parts[-1]
+            partial_module_name = option_parts[:-1]
+
+            name = self.module.fill_partial_name(partial_module_name)
+            name.append(option_name)
+            fullname = ":".join(name)
+            return fullname, self.module_options[fullname]
 
     def __getitem__(self, key: str):
         try:
-            option_parts = key.split(":")
-            depth = len(option_parts)
-            if depth < 2:
-                key = "{}:{}".format(self.module.fullname, key)
-                return self.module_options[key].value
-            if depth == 2:
-                # Repository option
-                repo, option = option_parts
-                if repo == "":
-                    key = "%s:%s" % (self.repository.name, option)
-
-                return self.repo_options[key].value
-            else:
-                option_name = option_parts[-1]
-                partial_module_name = option_parts[:-1]
-
-                name = self.module.fill_partial_name(partial_module_name)
-                name.append(option_name)
-                key = ":".join(name)
-                return self.module_options[key].value
-        except KeyError:
+            entry = self._lookup.get(key, None)
+            if entry is None:
+                entry = self._resolve(key)
+                self._lookup[key] = entry
+
+            fullname, option = entry
+            value = option.value
+        except KeyError as error:
             raise BlobException("Unknown option name '{}' in "
-                                "module '{}'".format(key, self.module.fullname))
+                                "module '{}'".format(error.args[0], self.module.fullname))
         except AttributeError as error:
             raise BlobForwardException("Invalid option '{}'".format(key), error)
 
+        if self.accessed is not None:
+            self.accessed.add(fullname)
+        return value
+
     def __contains__(self, key):
         try:
             _ = self.__getitem__(key)
@@ -364,13 +414,15 @@ class Module:
                 'PreBuildException': lbuild.exception.BlobPreBuildException,
             }
 
-            LOGGER.debug("Parse module_filename '%s'", module_filename)
-            local = lbuild.utils.load_module_from_file(module_filename, local)
-
             module = Module(repository,
                             module_filename,
                             modulepath)
 
+            LOGGER.debug("Parse module_filename '%s'", module_filename)
+            with lbuild.profiler.span("module", "load", module):
+                local = lbuild.utils.load_module_from_file(module_filename, local)
+            repository.namespaces[local['__name__']] = module_filename
+
             # Get the required global functions
             module.functions = Repository.get_global_functions(
                 local,
@@ -424,6 +476,12 @@ class Module:
         # options are configurable through the project configuration file.
         self.options = {}
 
+        # Full names of the repository options read in the prepare step
+        self.prepare_accessed_options = set()
+        # Full names of the repository and module options read in the
+        # pre-build, build and post-build steps
+        self.build_accessed_options = set()
+
     @property
     def description(self):
         try:
@@ -575,7 +633,8 @@ class Module:
 
     def init(self):
         # Execute init() function from module to get module name
-        lbuild.utils.with_forward_exception(self, lambda: self.functions['init'](ModuleInitFacade(self)))
+        with lbuild.profiler.span("module", "init", self):
+            lbuild.utils.with_forward_exception(self, lambda: self.functions['init'](ModuleInitFacade(self)))
 
         if self.name is None:
             raise BlobException("The init(module) function must set a module name! " \
@@ -605,7 +664,7 @@ class Module:
                                         os.path.join(self.path, self.filename)))
         self.repository.modules[fullname] = self
 
-    def prepare(self, repo_options):
+    def prepare(self, repo_options, accessed=None):
         """
         Prepare module.
 
@@ -613,17 +672,25 @@ class Module:
 
         Args:
             repo_options (dict): Repository options.
+            accessed (set): If given, the full names of all repository
+                options read by the module and its submodules are added
+                to the set.
 
         Returns:
             list: Available modules. May be an empty list if the module is
                 not selectable for the given repository options.
         """
         available_modules = {}
+        self.prepare_accessed_options = set()
         name_resolver = lbuild.repository.OptionNameResolver(self.repository,
-                                                             repo_options)
-        is_available = lbuild.utils.with_forward_exception(self,
-                lambda: self.functions["prepare"](ModuleFacade(self),
-                                                  name_resolver))
+                                                             repo_options,
+                                                             self.prepare_accessed_options)
+        with lbuild.profiler.span("module", "prepare", self):
+            is_available = lbuild.utils.with_forward_exception(self,
+                    lambda: self.functions["prepare"](ModuleFacade(self),
+                                                      name_resolver))
+        if accessed is not None:
+            accessed.update(self.prepare_accessed_options)
 
         if is_available is None:
             raise BlobException("The prepare() function for module '{}' must "
@@ -655,7 +722,7 @@ class Module:
                 module.parent = "{}:{}".format(self._parent, self._name)
             else:
                 module.parent = "{}:{}".format(self.repository.name, self._name)
-            available_modules.update(module.prepare(repo_options))
+            available_modules.update(module.prepare(repo_options, accessed))
 
         return available_modules
 
@@ -663,17 +730,20 @@ class Module:
         pre_build = self.functions.get("pre_build", None)
         if pre_build is not None:
             LOGGER.info("Prepare for build %s", self.fullname)
-            lbuild.utils.with_forward_exception(self, lambda: pre_build(env))
+            with lbuild.profiler.span("module", "pre_build", self):
+                lbuild.utils.with_forward_exception(self, lambda: pre_build(env))
 
     def build(self, env):
         LOGGER.info("Build %s", self.fullname)
-        lbuild.utils.with_forward_exception(self, lambda: self.functions["build"](env))
+        with lbuild.profiler.span("module", "build", self):
+            lbuild.utils.with_forward_exception(self, lambda: self.functions["build"](env))
 
     def post_build(self, env, buildlog):
         post_build = self.functions.get("post_build", None)
         if post_build is not None:
             LOGGER.info("Post-Build %s", self.fullname)
-            lbuild.utils.with_forward_exception(self, lambda: post_build(env, buildlog))
+            with lbuild.profiler.span("module", "post_build", self):
+                lbuild.utils.with_forward_exception(self, lambda: post_build(env, buildlog))
 
     def __lt__(self, other):
         """
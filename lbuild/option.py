@@ -16,6 +16,28 @@ import lbuild.filter
 from .exception import BlobException
 
 
+def store_values(options):
+    """
+    Store the current values of the given options.
+
+    Returns:
+        list: Pairs of option and value which can be passed to
+            `restore_values()`.
+    """
+    return [(option, option._value) for option in options]
+
+
+def restore_values(values):
+    """
+    Restore option values previously stored with `store_values()`.
+
+    The values are restored without conversion, so this also works for
+    enumeration options whose values differ from their names.
+    """
+    for option, value in values:
+        option._value = value
+
+
 class Option:
     """
     Base class for repository and module options.
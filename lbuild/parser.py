@@ -7,12 +7,21 @@
 # 2-clause BSD license. See the file `LICENSE.txt` for the full license
 # governing this code.
 
+import os
 import sys
 import random
+import hashlib
+import weakref
 import logging
 import collections
+import multiprocessing
 
 import lbuild.module
+import lbuild.option
+import lbuild.buildlog
+import lbuild.profiler
+import lbuild.archive
+import lbuild.buildcache
 import lbuild.environment
 
 from .exception import BlobException
@@ -42,6 +51,54 @@ class Runner:
         self.module.post_build(self.env, buildlog)
 
 
+class PreparedModules:
+    """
+    Modules available for one set of repository options.
+    """
+
+    def __init__(self, repositories, repo_options):
+        # Full names of the repository options read in the prepare step.
+        # The modules can be reused for all option sets with the same
+        # values for these options.
+        self.accessed_options = set()
+
+        self.available_modules = {}
+        for repo in repositories.values():
+            modules = repo.prepare_repository(repo_options, self.accessed_options)
+            self.available_modules.update(modules)
+
+        # Update the list of modules. Must be done after the prepare loop,
+        # because submodules are only added there.
+        self.modules = {}
+        self.repository_modules = {}
+        for repo in repositories.values():
+            self.repository_modules[repo] = repo.modules
+            for module in repo.modules.values():
+                self.modules[module.fullname] = module
+
+        self.option_values = lbuild.option.store_values(
+            option for module in self.modules.values() for option in module.options.values())
+
+    def restore(self):
+        """
+        Make the modules the current modules of their repositories and reset
+        the module options to their default values.
+        """
+        for repo, modules in self.repository_modules.items():
+            repo.modules = modules
+        lbuild.option.restore_values(self.option_values)
+
+
+def get_options_digest(repo_options, names):
+    """
+    Calculate a digest of the values of the given repository options.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        digest.update(repr((name, repo_options[name].value)).encode("utf-8"))
+    return digest.hexdigest()
+
+
 class Parser:
 
     def __init__(self):
@@ -58,6 +115,44 @@ class Parser:
         # Module name -> Module()
         self.available_modules = {}
 
+        # Values of the repository options directly after parsing the
+        # repositories. Restored before merging the configuration options.
+        self._repo_option_defaults = []
+
+        # Result of all previous prepare steps. Allows to switch between
+        # different sets of repository options without executing the
+        # `prepare` functions again.
+        #
+        # Names of the repository options read in the prepare step ->
+        # Digest of their values -> PreparedModules()
+        self._prepared_modules = {}
+
+        # Release the Python modules created for the repository and module
+        # files when the parser is discarded without calling close().
+        self._finalizer = weakref.finalize(self,
+                                           Parser._release_repositories,
+                                           self.repositories)
+
+    @staticmethod
+    def _release_repositories(repositories):
+        for repo in repositories.values():
+            repo.release()
+
+    def close(self):
+        """
+        Release the Python modules created when executing the repository
+        and module files.
+
+        The parser and its modules must not be used afterwards.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def load_repositories(self,
                           configuration: config.Configuration,
                           repofilenames=None):
@@ -75,13 +170,17 @@ class Parser:
         Executes the 'prepare' function to populate the repository
         structure.
         """
-        repo = repository.Repository.parse_repository(repofilename)
+        with lbuild.profiler.phase("repository"), \
+                lbuild.profiler.span("repository", repofilename):
+            repo = repository.Repository.parse_repository(repofilename)
 
         if repo.name in self.repositories:
             raise BlobException("Repository name '{}' is ambiguous. "
                                 "Name must be unique.".format(repo.name))
         else:
             self.repositories[repo.name] = repo
+            self._repo_option_defaults.extend(lbuild.option.store_values(repo.options.values()))
+            self._prepared_modules.clear()
         return repo
 
     @staticmethod
@@ -109,6 +208,14 @@ class Parser:
                                 "repository.".format(option_name))
 
     def merge_repository_options(self, config_options, cmd_options=None):
+        with lbuild.profiler.phase("options"):
+            return self._merge_repository_options(config_options, cmd_options)
+
+    def _merge_repository_options(self, config_options, cmd_options=None):
+        # Start from the default values, options set by a previous call
+        # must not leak into this one.
+        lbuild.option.restore_values(self._repo_option_defaults)
+
         repo_options_by_full_name = {}
         repo_options_by_option_name = {}
 
@@ -140,25 +247,41 @@ class Parser:
                                                    option.name, option.value)
         return repo_options_by_full_name
 
+    def _find_prepared_modules(self, repo_options):
+        for names, prepared_modules in self._prepared_modules.items():
+            prepared = prepared_modules.get(get_options_digest(repo_options, names), None)
+            if prepared is not None:
+                return prepared
+        return None
+
     def prepare_repositories(self,
                              repo_options):
         """
         Prepare and select modules which are available given the set of
         repository repo_options.
 
+        The prepared modules are kept. Calling this function again with the
+        same values for all repository options read during the prepare step
+        returns the previous modules with their module options reset to the
+        default values.
+
         Returns:
             dict: Available modules, key is the qualified module name.
         """
         self.verify_options_are_defined(repo_options)
-        for repo in self.repositories.values():
-            modules = repo.prepare_repository(repo_options)
-            self.available_modules.update(modules)
 
-        # Update the list of modules. Must be done after the prepare loop,
-        # because submodules are only added there.
-        for repo in self.repositories.values():
-            for module in repo.modules.values():
-                self.modules[module.fullname] = module
+        prepared = self._find_prepared_modules(repo_options)
+        if prepared is None:
+            with lbuild.profiler.phase("prepare"):
+                prepared = PreparedModules(self.repositories, repo_options)
+            names = frozenset(prepared.accessed_options)
+            self._prepared_modules.setdefault(names, {})[get_options_digest(repo_options, names)] = prepared
+        else:
+            LOGGER.debug("Reuse prepared modules")
+            prepared.restore()
+
+        self.available_modules = prepared.available_modules
+        self.modules = prepared.modules
 
         if len(self.available_modules) == 0:
             raise BlobBuildException("No module found with the selected repository options!")
@@ -179,6 +302,11 @@ class Parser:
         Returns:
             list: Required modules for the given list of modules.
         """
+        with lbuild.profiler.phase("dependencies"):
+            return Parser._resolve_dependencies(modules, requested_modules, depth)
+
+    @staticmethod
+    def _resolve_dependencies(modules, requested_modules, depth):
         for module in modules.values():
             module.resolve_dependencies(modules)
 
@@ -221,6 +349,11 @@ class Parser:
             dict: Mapping of the full qualified option names to the option
             objects.
         """
+        with lbuild.profiler.phase("options"):
+            return Parser._merge_module_options(build_modules, config_options)
+
+    @staticmethod
+    def _merge_module_options(build_modules, config_options):
         canidates = {}
         options = {}
         for module in build_modules:
@@ -277,66 +410,207 @@ class Parser:
                                     "or on the command line.".format(fullname))
 
     @staticmethod
-    def build_modules(outpath, build_modules, repo_options, module_options, buildlog):
+    def build_modules(outpath, build_modules, repo_options, module_options, buildlog,
+                      previous=None, dry_run=False, render_templates=False, staged=False,
+                      archive=None, build_cache=None, content_store=None):
         """
         Go through all to build and call their 'build' function.
+
+        Args:
+            previous (dict): Operations of the build step of a previous build
+                into the same output path, key is the full module name. The
+                build step of these modules is skipped and their operations
+                are added to the build log instead. The pre- and post-build
+                steps are always executed.
+            dry_run (bool): Only record the planned operations together with
+                the size of their source files, nothing is written into the
+                output path.
+            render_templates (bool): Render the templates during a dry run
+                to record their render time.
+            staged (bool): Collect all outputs in an `OutputStage` and move
+                them into the output path after all modules have been built
+                successfully. A failed build leaves the output path
+                untouched.
+            archive (str): Filename of an archive into which the outputs are
+                written instead of the output path. The member names are the
+                paths relative to the output path. The archive is written
+                after all modules have been built successfully.
+            build_cache (str): Path of a shared build cache (see
+                `lbuild.buildcache`). The outputs of the build step of a
+                module are restored from the cache if its inputs are
+                unchanged, otherwise the outputs are added to the cache.
+                Not used by a dry run.
+            content_store (str): Path of a `ContentStore`, an empty string
+                selects the default store. The outputs are added to the
+                store and hardlinked into the output path. Not used
+                together with staging or an archive.
+
+        Returns:
+            dict: Operations of the build step of every module, key is the
+            full module name.
         """
         Parser.verify_options_are_defined(module_options)
+        buildlog.log_configuration(repo_options, build_modules, module_options)
         all_modules = {m.fullname: m for m in build_modules}
+        stage = lbuild.environment.OutputStage(outpath) if staged and not dry_run else None
+        if archive is not None and not dry_run:
+            archive = lbuild.archive.OutputArchive(archive, outpath)
+        else:
+            archive = None
+        store = None
+        if content_store is not None and not dry_run:
+            store = lbuild.environment.ContentStore(content_store or None)
+        cache = None
+        if build_cache is not None and not dry_run:
+            cache = lbuild.buildcache.BuildCache(build_cache).start(outpath, build_modules,
+                                                                    repo_options, module_options)
 
         groups = collections.defaultdict(list)
         for module in build_modules:
+            if previous is None or module.fullname not in previous:
+                # Options read by a skipped build step stay valid
+                module.build_accessed_options = set()
             option_resolver = lbuild.module.OptionNameResolver(module.repository,
                                                                module,
                                                                repo_options,
-                                                               module_options)
+                                                               module_options,
+                                                               module.build_accessed_options)
             module_resolver = lbuild.module.ModuleNameResolver(module.repository,
                                                                module,
                                                                all_modules)
-            env = lbuild.environment.Environment(option_resolver,
-                                                 module_resolver,
-                                                 module,
-                                                 outpath,
-                                                 buildlog)
+            if dry_run:
+                env = lbuild.environment.DryRunEnvironment(option_resolver,
+                                                           module_resolver,
+                                                           module,
+                                                           outpath,
+                                                           buildlog,
+                                                           render_templates)
+            elif archive is not None:
+                env = lbuild.environment.ArchiveEnvironment(option_resolver,
+                                                            module_resolver,
+                                                            module,
+                                                            outpath,
+                                                            buildlog,
+                                                            archive)
+            elif stage is not None:
+                env = lbuild.environment.StagedEnvironment(option_resolver,
+                                                           module_resolver,
+                                                           module,
+                                                           outpath,
+                                                           buildlog,
+                                                           stage)
+            elif store is not None:
+                env = lbuild.environment.StoreEnvironment(option_resolver,
+                                                          module_resolver,
+                                                          module,
+                                                          outpath,
+                                                          buildlog,
+                                                          store)
+            else:
+                env = lbuild.environment.Environment(option_resolver,
+                                                     module_resolver,
+                                                     module,
+                                                     outpath,
+                                                     buildlog)
 
             depth = len(module.fullname.split(":"))
             groups[depth].append(Runner(module, env))
 
+        try:
+            build_operations = Parser._run_build_steps(groups, buildlog, previous, cache)
+        except BaseException:
+            if stage is not None:
+                stage.discard()
+            if archive is not None:
+                archive.discard()
+            raise
+
+        if stage is not None:
+            with lbuild.profiler.phase("commit"):
+                stage.commit()
+        if archive is not None:
+            with lbuild.profiler.phase("archive"):
+                archive.write()
+
+        for module in build_modules:
+            buildlog.log_accessed_options(module)
+
+        return build_operations
+
+    @staticmethod
+    def _run_build_steps(groups, buildlog, previous, cache=None):
         exceptions = []
         # Enforce that the submodules are always build before their
         # parent modules.
-        for index in sorted(groups, reverse=True):
-            group = groups[index]
-            random.shuffle(group)
+        with lbuild.profiler.phase("pre_build"):
+            for index in sorted(groups, reverse=True):
+                group = groups[index]
+                random.shuffle(group)
 
-            for runner in group:
-                try:
-                    runner.pre_build()
-                except lbuild.exception.BlobPreBuildException as error:
-                    exceptions.append(error)
+                for runner in group:
+                    try:
+                        runner.pre_build()
+                    except lbuild.exception.BlobPreBuildException as error:
+                        exceptions.append(error)
 
         if len(exceptions) > 0:
             raise lbuild.exception.BlobAggregateException(exceptions)
 
-        for index in sorted(groups, reverse=True):
-            group = groups[index]
-            random.shuffle(group)
+        build_operations = {}
+        with lbuild.profiler.phase("build"):
+            for index in sorted(groups, reverse=True):
+                group = groups[index]
+                random.shuffle(group)
+
+                for runner in group:
+                    fullname = runner.module.fullname
+                    operations = None if previous is None else previous.get(fullname, None)
+                    if operations is not None:
+                        LOGGER.info("Reuse previous build of %s", fullname)
+                        for operation in operations:
+                            buildlog.log_operation(operation)
+                    elif cache is not None:
+                        operations = cache.restore(runner.module, runner.env, buildlog)
+
+                    if operations is None:
+                        start = len(buildlog.operations)
+                        if cache is not None:
+                            runner.env._start_recording()
+                        runner.build()
+                        operations = buildlog.operations[start:]
+                        if cache is not None:
+                            cache.store(runner.module, runner.env, operations)
+                    build_operations[fullname] = operations
+
+        with lbuild.profiler.phase("post_build"):
+            for index in sorted(groups, reverse=True):
+                group = groups[index]
+                random.shuffle(group)
+
+                for runner in group:
+                    runner.post_build(buildlog)
+
+        return build_operations
 
-            for runner in group:
-                runner.build()
+    def configure_and_build_library(self, configfile, outpath, cmd_options=None):
+        configuration = config.Configuration.parse_configuration(configfile)
+        return self.build_configuration(configuration, outpath, cmd_options)
 
-        for index in sorted(groups, reverse=True):
-            group = groups[index]
-            random.shuffle(group)
+    def build_configuration(self, configuration, outpath, cmd_options=None, staged=False,
+                            content_store=None):
+        """
+        Build the library for an already parsed configuration.
 
-            for runner in group:
-                runner.post_build(buildlog)
+        The repositories of the configuration must have been loaded before.
+        Can be called multiple times with different configurations, the
+        `prepare` step is only executed once per set of repository option
+        values. The build cache of the configuration is used if set.
 
-    def configure_and_build_library(self, configfile, outpath, cmd_options=None):
+        Returns:
+            BuildLog: Log of the generated files.
+        """
         cmd_options = [] if cmd_options is None else cmd_options
 
-        configuration = config.Configuration.parse_configuration(configfile)
-
         commandline_options = config.Configuration.format_commandline_options(cmd_options)
         repo_options = self.merge_repository_options(configuration.options, commandline_options)
 
@@ -346,5 +620,125 @@ class Parser:
         module_options = self.merge_module_options(build_modules, configuration.options + commandline_options)
 
         log = lbuild.buildlog.BuildLog()
-        self.build_modules(outpath, build_modules, repo_options, module_options, log)
+        self.build_modules(outpath, build_modules, repo_options, module_options, log,
+                           staged=staged, build_cache=configuration.buildcache,
+                           content_store=content_store)
         return log
+
+
+def _format_error(error):
+    if isinstance(error, lbuild.exception.BlobAggregateException):
+        return "\n".join(_format_error(exception) for exception in error.exceptions)
+    elif isinstance(error, lbuild.exception.BlobForwardException):
+        return "In '{}': {}: {}".format(error.module,
+                                        error.exception.__class__.__name__,
+                                        error.exception)
+    return str(error)
+
+
+def _build_configuration(parser, configuration, outpath, cmd_options, staged, content_store):
+    try:
+        return parser.build_configuration(configuration, outpath, cmd_options, staged,
+                                          content_store), None
+    except BlobException as error:
+        return None, BlobException("While building '{}':\n{}".format(configuration.filename,
+                                                                     _format_error(error)))
+
+
+# Builds of the currently running `build_configurations()` call. Inherited by
+# the forked worker processes, which avoids transferring the parsed
+# repositories to the workers.
+_batch_builds = None
+
+
+def _build_configuration_worker(index):
+    log, error = _build_configuration(*_batch_builds[index])
+    if error is not None:
+        return None, str(error)
+    return (log.operations, dict(log.metadata), log.accessed_options, log.configuration), None
+
+
+def _build_parallel(builds, jobs):
+    global _batch_builds
+
+    results = []
+    _batch_builds = builds
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(jobs, len(builds))) as pool:
+            for result, error in pool.map(_build_configuration_worker, range(len(builds))):
+                if error is not None:
+                    results.append((None, BlobException(error)))
+                    continue
+
+                operations, metadata, accessed_options, configuration = result
+                log = lbuild.buildlog.BuildLog()
+                for operation in operations:
+                    log.log_operation(operation)
+                log.metadata.update(metadata)
+                log.accessed_options.update(accessed_options)
+                log.configuration = configuration
+                results.append((log, None))
+    finally:
+        _batch_builds = None
+    return results
+
+
+def build_configurations(configurations, outpaths, cmd_options=None, repofilenames=None, jobs=1,
+                         staged=False, content_store=None):
+    """
+    Build the libraries for multiple configurations.
+
+    Each repository file is parsed only once for all configurations using
+    the same set of repositories, and the `prepare` step is only executed
+    once per set of repository option values.
+
+    Args:
+        configurations (list): Configuration objects or filenames.
+        outpaths (list): Output path for each configuration.
+        cmd_options (list): Additional options applied to all configurations.
+        repofilenames (list): Additional repository files.
+        jobs (int): Number of worker processes. The workers are forked
+            after the repositories have been parsed. Builds run sequentially
+            if forking processes is not supported.
+        staged (bool): Move the outputs of each configuration into its
+            output path only after a successful build (see
+            `Parser.build_modules()`).
+        content_store (str): Path of a `ContentStore` shared by all
+            configurations. Identical outputs are hardlinked.
+
+    Returns:
+        list: BuildLog for each configuration.
+    """
+    configurations = [config.Configuration.parse_configuration(configuration)
+                      if isinstance(configuration, str) else configuration
+                      for configuration in configurations]
+
+    # Tuple of repository filenames -> Parser()
+    parsers = {}
+    try:
+        builds = []
+        for configuration, outpath in zip(configurations, outpaths):
+            key = tuple([os.path.realpath(filename) for filename in
+                         utils.listify(repofilenames or [])] + configuration.repositories)
+            parser = parsers.get(key, None)
+            if parser is None:
+                parser = Parser()
+                parsers[key] = parser
+                parser.load_repositories(configuration, repofilenames)
+            builds.append((parser, configuration, outpath, cmd_options, staged, content_store))
+
+        if jobs > 1 and len(builds) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            results = _build_parallel(builds, jobs)
+        else:
+            if jobs > 1:
+                LOGGER.warning("Parallel builds not supported on this platform!")
+            results = [_build_configuration(*build) for build in builds]
+    finally:
+        for parser in parsers.values():
+            parser.close()
+
+    errors = [error for _, error in results if error is not None]
+    if errors:
+        raise lbuild.exception.BlobAggregateException(errors)
+    return [log for log, _ in results]
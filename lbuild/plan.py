@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+"""
+Compare two configurations without building them.
+
+The option values and the modules of both configurations are resolved
+with the `prepare` step only, no `pre_build`, `build` or `post_build`
+function is executed. The outputs of the modules are taken from the build
+log of a previous build.
+"""
+
+import os
+import collections
+
+import lxml.etree
+
+import lbuild.config
+import lbuild.module
+import lbuild.buildlog
+from .exception import BlobException
+
+
+class State:
+    """
+    Resolved configuration of a build.
+
+    Attributes:
+        options (dict): Full option name -> Value as string. Contains the
+            repository and the module options.
+        modules (dict): Full module name -> List of the full names of the
+            dependencies.
+        outputs (dict): Full module name -> List of the generated files.
+            `None` if the outputs are unknown.
+    """
+
+    def __init__(self, options, modules, outputs=None):
+        self.options = options
+        self.modules = modules
+        self.outputs = outputs
+
+    @staticmethod
+    def from_buildlog(filename):
+        """
+        Load the state recorded in the build log of a previous build.
+        """
+        try:
+            rootnode = lxml.etree.parse(filename).getroot()
+        except (OSError, lxml.etree.XMLSyntaxError) as error:
+            raise BlobException("Unable to read build log '{}': {}".format(filename, error))
+
+        outputs = collections.defaultdict(list)
+        for operationnode in rootnode.iterfind("operation"):
+            outputs[operationnode.findtext("module")].append(operationnode.findtext("destination"))
+
+        confignode = rootnode.find("configuration")
+        if confignode is None:
+            return State(None, None, dict(outputs))
+
+        options = {node.get("name"): node.text for node in confignode.iterfind("option")}
+        modules = {node.get("name"): [dependency.text for dependency in node.iterfind("dependency")]
+                   for node in confignode.iterfind("module")}
+        return State(options, modules, dict(outputs))
+
+
+def get_state(parser, configuration, cmd_options=None):
+    """
+    Resolve the options and modules of a configuration.
+
+    Only the `prepare` step of the modules is executed.
+
+    Args:
+        parser: Parser with the loaded repositories of the configuration.
+        configuration: Configuration object.
+        cmd_options: Additional options in the format of the command line.
+    """
+    commandline_options = lbuild.config.Configuration.format_commandline_options(cmd_options or [])
+    repo_options = parser.merge_repository_options(configuration.options, commandline_options)
+
+    modules = parser.prepare_repositories(repo_options)
+    selected_modules = lbuild.module.resolve_modules(modules, configuration.selected_modules)
+    build_modules = parser.resolve_dependencies(modules, selected_modules)
+    module_options = parser.merge_module_options(build_modules,
+                                                 configuration.options + commandline_options)
+
+    # Same format as `BuildLog.log_configuration()`
+    log = lbuild.buildlog.BuildLog()
+    log.log_configuration(repo_options, build_modules, module_options)
+    return State(*log.configuration)
+
+
+def _get_option_owner(name):
+    """
+    Repository name for repository options, otherwise the full module name.
+    """
+    return name.rsplit(":", 1)[0]
+
+
+class Plan:
+    """
+    Differences between two states.
+    """
+
+    def __init__(self, old, new):
+        if old.options is None:
+            raise BlobException("The build log contains no configuration. Build the "
+                                "library again or compare with a configuration file.")
+        self.old = old
+        self.new = new
+
+        names = set(old.options) | set(new.options)
+        changed = sorted(name for name in names
+                         if old.options.get(name, None) != new.options.get(name, None))
+        self.changed_repo_options = [name for name in changed if name.count(":") == 1]
+        self.changed_module_options = [name for name in changed if name.count(":") > 1]
+
+        self.added_modules = sorted(set(new.modules) - set(old.modules))
+        self.removed_modules = sorted(set(old.modules) - set(new.modules))
+        self.affected_modules = self._get_affected_modules()
+
+        # The outputs of the new configuration are unknown without building
+        # it, therefore only the outputs of the previous build are listed.
+        self.changed_outputs = []
+        self.removed_outputs = []
+        if old.outputs is not None:
+            for modulename, outputs in old.outputs.items():
+                if modulename in self.removed_modules:
+                    self.removed_outputs.extend(outputs)
+                elif modulename in self.affected_modules:
+                    self.changed_outputs.extend(outputs)
+            self.removed_outputs.sort()
+            self.changed_outputs.sort()
+
+    def _get_affected_modules(self):
+        """
+        Modules of the new state whose inputs have changed.
+
+        A module is affected if one of its options or of the options of its
+        repository has changed, if its dependencies have changed, or if one
+        of its dependencies is affected.
+        """
+        changed = set()
+        repositories = set(_get_option_owner(name) for name in self.changed_repo_options)
+        owners = set(_get_option_owner(name) for name in self.changed_module_options)
+        for modulename, dependencies in self.new.modules.items():
+            if modulename in self.added_modules:
+                continue
+            if (modulename in owners or
+                    modulename.split(":", 1)[0] in repositories or
+                    dependencies != self.old.modules[modulename]):
+                changed.add(modulename)
+
+        # Propagate the changes to the dependent modules
+        dependents = collections.defaultdict(set)
+        for modulename, dependencies in self.new.modules.items():
+            for dependency in dependencies:
+                dependents[dependency].add(modulename)
+
+        affected = set()
+        pending = list(changed)
+        while pending:
+            modulename = pending.pop()
+            for dependent in dependents[modulename]:
+                if dependent not in affected and dependent not in changed:
+                    affected.add(dependent)
+                    pending.append(dependent)
+        return sorted(affected | changed)
+
+    @property
+    def is_empty(self):
+        return not (self.changed_repo_options or self.changed_module_options or
+                    self.added_modules or self.removed_modules or self.affected_modules)
+
+    def to_dict(self):
+        return {
+            "repository_options": self.changed_repo_options,
+            "module_options": self.changed_module_options,
+            "modules": {
+                "added": self.added_modules,
+                "removed": self.removed_modules,
+                "affected": self.affected_modules,
+            },
+            "outputs": None if self.old.outputs is None else {
+                "changed": self.changed_outputs,
+                "removed": self.removed_outputs,
+            },
+        }
+
+    def _format_option(self, name):
+        return "{}: {} -> {}".format(name,
+                                     self.old.options.get(name, None),
+                                     self.new.options.get(name, None))
+
+    def format(self):
+        if self.is_empty:
+            return "No changes."
+
+        ostream = []
+
+        def add_section(title, entries, prefix="  "):
+            if entries:
+                ostream.append(title)
+                ostream.extend(prefix + entry for entry in entries)
+
+        add_section("Changed repository options:",
+                    [self._format_option(name) for name in self.changed_repo_options])
+        add_section("Changed module options:",
+                    [self._format_option(name) for name in self.changed_module_options])
+        add_section("Added modules:", self.added_modules, "  + ")
+        add_section("Removed modules:", self.removed_modules, "  - ")
+        add_section("Affected modules:", self.affected_modules)
+        if self.old.outputs is not None:
+            add_section("Changed outputs:", self.changed_outputs, "  ~ ")
+            add_section("Removed outputs:", self.removed_outputs, "  - ")
+            if self.added_modules:
+                ostream.append("The outputs of the added modules are known after the build.")
+        return "\n".join(ostream)
+
+
+def get_buildlog_filename(configfilename):
+    """
+    Filename of the build log written by `lbuild build`.
+    """
+    return configfilename + ".log"
+
+
+def plan(parser, new_config, old_config=None, buildlog=None, cmd_options=None, old_parser=None):
+    """
+    Compare a configuration with a previous configuration or build.
+
+    Args:
+        parser: Parser with the loaded repositories of the configuration.
+        new_config: Configuration object.
+        old_config: Previous Configuration object. If `None` the
+            configuration recorded in the build log is used.
+        buildlog: Filename of the build log of the previous build. Used to
+            determine the generated files. Optional if `old_config` is
+            given.
+        cmd_options: Additional options applied to both configurations.
+        old_parser: Parser with the loaded repositories of the previous
+            configuration, if they differ from the current repositories.
+
+    Returns:
+        Plan object.
+    """
+    if buildlog is not None and os.path.exists(buildlog):
+        recorded = State.from_buildlog(buildlog)
+    elif old_config is None:
+        raise BlobException("No previous build log '{}' found. Specify the previous "
+                            "configuration instead.".format(buildlog))
+    else:
+        recorded = None
+
+    if old_config is not None:
+        old = get_state(parser if old_parser is None else old_parser, old_config, cmd_options)
+        old.outputs = None if recorded is None else recorded.outputs
+    else:
+        old = recorded
+    new = get_state(parser, new_config, cmd_options)
+    return Plan(old, new)
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import json
+import time
+import logging
+import threading
+import tracemalloc
+import contextlib
+import collections
+
+LOGGER = logging.getLogger('lbuild.profiler')
+
+# Phases in the order in which they are executed during a build.
+PHASES = [
+    "config",
+    "repository",
+    "prepare",
+    "dependencies",
+    "options",
+    "pre_build",
+    "build",
+    "post_build",
+]
+
+# List of the active profilers. The parser, the modules and the environment
+# report the phases of a build and all calls into user code to these
+# profilers. Without a registered profiler the reporting is a no-op.
+_profilers = []
+
+
+def enable(profiler):
+    """
+    Register a profiler to receive all following phase and span events.
+    """
+    _profilers.append(profiler)
+
+
+def disable(profiler):
+    """
+    Remove a previously registered profiler.
+    """
+    _profilers.remove(profiler)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Mark a phase of the build process (e.g. "prepare" or "build").
+    """
+    if not _profilers:
+        yield
+        return
+
+    with contextlib.ExitStack() as stack:
+        for profiler in list(_profilers):
+            stack.enter_context(profiler.phase(name))
+        yield
+
+
+@contextlib.contextmanager
+def span(category, name, module=None):
+    """
+    Mark a single unit of work inside a phase.
+
+    Args:
+        category: Kind of work, e.g. "module", "template", "copy" or
+            "repository".
+        name: Name of the unit. For the "module" category this is the name
+            of the called module function, otherwise a filename.
+        module: Module object on whose behalf the work is done. May be `None`.
+    """
+    if not _profilers:
+        yield
+        return
+
+    with contextlib.ExitStack() as stack:
+        for profiler in list(_profilers):
+            stack.enter_context(profiler.span(category, name, module))
+        yield
+
+
+def get_module_name(module):
+    """
+    Get a printable name for a module.
+
+    The full name of a module is only available after the module has been
+    prepared. Use the filename for modules which have not been registered.
+    """
+    if module.fullname is not None:
+        return module.fullname
+    elif module.filename is not None:
+        return module.filename
+    return str(module.name)
+
+
+class Statistic:
+    """
+    Accumulated wall time and number of calls.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def add(self, time):
+        self.count += 1
+        self.time += time
+
+    def to_dict(self):
+        return {
+            "calls": self.count,
+            "time": self.time,
+        }
+
+
+class MemoryStatistic:
+    """
+    Memory allocated during a phase or span.
+
+    `retained` is the amount of memory still allocated at the end of the
+    phase, `peak` the maximum amount of additional memory used during the
+    phase. Both are given in bytes relative to the start of the phase.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.retained = 0
+        self.peak = 0
+
+    def add(self, retained, peak=0):
+        self.count += 1
+        self.retained += retained
+        self.peak = max(self.peak, peak)
+
+    def to_dict(self):
+        return {
+            "calls": self.count,
+            "retained": self.retained,
+            "peak": self.peak,
+        }
+
+
+class Profiler:
+    """
+    Collects wall time and call counts per build phase, module and template.
+    """
+
+    def __init__(self):
+        # Phase name -> Statistic()
+        self.phases = collections.OrderedDict()
+        # Module -> Function name -> Statistic()
+        self.modules = collections.OrderedDict()
+        # Template filename -> Statistic()
+        self.templates = collections.OrderedDict()
+        # Category -> Statistic()
+        self.categories = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - starttime
+            self.phases.setdefault(name, Statistic()).add(total)
+
+    @contextlib.contextmanager
+    def span(self, category, name, module=None):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - starttime
+            self.categories.setdefault(category, Statistic()).add(total)
+            if category == "module":
+                functions = self.modules.setdefault(module, collections.OrderedDict())
+                functions.setdefault(name, Statistic()).add(total)
+            elif category == "template":
+                self.templates.setdefault(name, Statistic()).add(total)
+
+    def get_phases(self):
+        """
+        Get the phases in execution order.
+
+        Unknown phases are appended in the order they have been recorded.
+        """
+        names = [name for name in PHASES if name in self.phases]
+        names.extend(name for name in self.phases if name not in PHASES)
+        return [(name, self.phases[name]) for name in names]
+
+    def get_slowest_modules(self, count=None):
+        """
+        Get the modules sorted by the total time spent in their functions.
+
+        Returns:
+            list: Tuples of the module name, the accumulated statistic and
+                a dictionary with the statistic per module function.
+        """
+        modules = []
+        for module, functions in self.modules.items():
+            total = Statistic()
+            for statistic in functions.values():
+                total.count += statistic.count
+                total.time += statistic.time
+            modules.append((get_module_name(module), total, functions))
+
+        modules.sort(key=lambda entry: entry[1].time, reverse=True)
+        return modules[:count]
+
+    def get_slowest_templates(self, count=None):
+        templates = sorted(self.templates.items(),
+                           key=lambda entry: entry[1].time,
+                           reverse=True)
+        return templates[:count]
+
+    def to_dict(self, count=None):
+        """
+        Convert the collected data into a JSON compatible dictionary.
+
+        All times are given in seconds.
+        """
+        phases = []
+        for name, statistic in self.get_phases():
+            entry = {"name": name}
+            entry.update(statistic.to_dict())
+            phases.append(entry)
+
+        modules = []
+        for name, statistic, functions in self.get_slowest_modules(count):
+            entry = {"name": name}
+            entry.update(statistic.to_dict())
+            entry["functions"] = {function: value.to_dict() for function, value in functions.items()}
+            modules.append(entry)
+
+        templates = []
+        for name, statistic in self.get_slowest_templates(count):
+            entry = {"name": name}
+            entry.update(statistic.to_dict())
+            templates.append(entry)
+
+        return {
+            "phases": phases,
+            "modules": modules,
+            "templates": templates,
+        }
+
+    def to_json(self, count=None):
+        return json.dumps(self.to_dict(count), indent=2)
+
+    @staticmethod
+    def _format_table(title, rows):
+        width = max([len(title)] + [len(name) for name, _ in rows])
+        output = ["{:<{width}}  {:>7}  {:>12}".format(title, "Calls", "Time [ms]", width=width)]
+        output.append("-" * (width + 23))
+        for name, statistic in rows:
+            output.append("{:<{width}}  {:>7}  {:>12.3f}".format(name,
+                                                                 statistic.count,
+                                                                 statistic.time * 1000,
+                                                                 width=width))
+        return output
+
+    def format(self, count=10):
+        """
+        Create a human readable report of the collected data.
+
+        Args:
+            count: Number of modules and templates to show.
+        """
+        output = self._format_table("Phase", self.get_phases())
+
+        modules = [(name, statistic) for name, statistic, _ in self.get_slowest_modules(count)]
+        if modules:
+            output.append("")
+            output.extend(self._format_table("Module", modules))
+
+        templates = self.get_slowest_templates(count)
+        if templates:
+            output.append("")
+            output.extend(self._format_table("Template", templates))
+
+        return "\n".join(output)
+
+
+class Tracer:
+    """
+    Records the phases and spans of a build as Chrome trace events.
+
+    The generated JSON file uses the "Trace Event Format" and can be viewed
+    with Perfetto or chrome://tracing.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+
+        self._starttime = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def _add_event(self, name, category, starttime, args):
+        endtime = time.perf_counter()
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (starttime - self._starttime) * 1e6,
+            "dur": (endtime - starttime) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self.__lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_event(name, "phase", starttime, {})
+
+    @contextlib.contextmanager
+    def span(self, category, name, module=None):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            args = {}
+            if module is not None:
+                args["module"] = get_module_name(module)
+            if category == "module":
+                # Show the module name directly in the timeline instead of
+                # the name of the function.
+                args["function"] = name
+                name = "{}: {}".format(name, args.get("module"))
+            self._add_event(name, category, starttime, args)
+
+    def to_dict(self):
+        with self.__lock:
+            events = list(self.events)
+            for ident, name in self.threads.items():
+                events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": ident,
+                    "args": {"name": name},
+                })
+
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+class MemoryProfiler:
+    """
+    Collects the memory usage per build phase, module and template.
+
+    Uses `tracemalloc` to trace all memory allocations of the Python
+    interpreter. Tracing slows down the build considerably, the absolute
+    timings of other profilers are therefore not meaningful while the memory
+    profiler is active.
+    """
+
+    def __init__(self):
+        # Phase name -> MemoryStatistic()
+        self.phases = collections.OrderedDict()
+        # Module -> MemoryStatistic()
+        self.modules = collections.OrderedDict()
+        # Template filename -> MemoryStatistic()
+        self.templates = collections.OrderedDict()
+
+        # Memory allocated per source file at the end of the build
+        self.snapshot = None
+        self._stop_tracing = False
+
+        # Peak memory of the currently active phases and spans. Every phase
+        # and span resets the peak value of tracemalloc to measure its own
+        # peak value, the enclosing ones are updated before the reset.
+        self._peaks = []
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._stop_tracing = True
+
+    def stop(self):
+        self.snapshot = tracemalloc.take_snapshot()
+        if self._stop_tracing:
+            tracemalloc.stop()
+            self._stop_tracing = False
+
+    def _update_peaks(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self._peaks = [max(value, peak) for value in self._peaks]
+        return current
+
+    @contextlib.contextmanager
+    def _measure(self, statistic):
+        """
+        Add the retained and the peak memory of the enclosed block to the
+        given statistic.
+
+        `tracemalloc.reset_peak()` is only available since Python 3.9. With
+        older versions the peak value covers everything since the start of
+        the memory tracing.
+        """
+        start = self._update_peaks()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self._peaks.append(start)
+        try:
+            yield
+        finally:
+            current = self._update_peaks()
+            peak = self._peaks.pop()
+            if statistic is not None:
+                statistic.add(current - start, peak - start)
+
+    def phase(self, name):
+        return self._measure(self.phases.setdefault(name, MemoryStatistic()))
+
+    def span(self, category, name, module=None):
+        if category == "module":
+            statistic = self.modules.setdefault(module, MemoryStatistic())
+        elif category == "template":
+            statistic = self.templates.setdefault(name, MemoryStatistic())
+        else:
+            statistic = None
+        return self._measure(statistic)
+
+    def get_phases(self):
+        names = [name for name in PHASES if name in self.phases]
+        names.extend(name for name in self.phases if name not in PHASES)
+        return [(name, self.phases[name]) for name in names]
+
+    def get_top_modules(self, count=None):
+        modules = [(get_module_name(module), statistic)
+                   for module, statistic in self.modules.items()]
+        modules.sort(key=lambda entry: entry[1].retained, reverse=True)
+        return modules[:count]
+
+    def get_top_templates(self, count=None):
+        templates = sorted(self.templates.items(),
+                           key=lambda entry: entry[1].retained,
+                           reverse=True)
+        return templates[:count]
+
+    def get_top_files(self, count=None):
+        """
+        Get the source files which hold the most memory at the end of the
+        build.
+
+        Returns:
+            list: Tuples of the filename, the allocated size in bytes and the
+                number of allocated blocks.
+        """
+        if self.snapshot is None:
+            return []
+
+        files = []
+        for statistic in self.snapshot.statistics("filename")[:count]:
+            frame = statistic.traceback[0]
+            files.append((frame.filename, statistic.size, statistic.count))
+        return files
+
+    def to_dict(self, count=None):
+        """
+        Convert the collected data into a JSON compatible dictionary.
+
+        All sizes are given in bytes.
+        """
+        def convert(entries):
+            result = []
+            for name, statistic in entries:
+                entry = {"name": name}
+                entry.update(statistic.to_dict())
+                result.append(entry)
+            return result
+
+        return {
+            "phases": convert(self.get_phases()),
+            "modules": convert(self.get_top_modules(count)),
+            "templates": convert(self.get_top_templates(count)),
+            "files": [{"name": name, "size": size, "blocks": blocks}
+                      for name, size, blocks in self.get_top_files(count)],
+        }
+
+    @staticmethod
+    def _format_table(title, rows):
+        width = max([len(title)] + [len(row[0]) for row in rows])
+        output = ["{:<{width}}  {:>7}  {:>14}  {:>14}".format(title, "Calls",
+                                                             "Retained [kB]", "Peak [kB]",
+                                                             width=width)]
+        output.append("-" * (width + 41))
+        for name, statistic in rows:
+            output.append("{:<{width}}  {:>7}  {:>14.1f}  {:>14.1f}".format(name,
+                                                                           statistic.count,
+                                                                           statistic.retained / 1024,
+                                                                           statistic.peak / 1024,
+                                                                           width=width))
+        return output
+
+    def format(self, count=10):
+        """
+        Create a human readable report of the collected data.
+
+        Args:
+            count: Number of modules, templates and files to show.
+        """
+        output = self._format_table("Phase", self.get_phases())
+
+        modules = self.get_top_modules(count)
+        if modules:
+            output.append("")
+            output.extend(self._format_table("Module", modules))
+
+        templates = self.get_top_templates(count)
+        if templates:
+            output.append("")
+            output.extend(self._format_table("Template", templates))
+
+        files = self.get_top_files(count)
+        if files:
+            width = max([len("File")] + [len(name) for name, _, _ in files])
+            output.append("")
+            output.append("{:<{width}}  {:>7}  {:>14}".format("File", "Blocks", "Size [kB]",
+                                                              width=width))
+            output.append("-" * (width + 25))
+            for name, size, blocks in files:
+                output.append("{:<{width}}  {:>7}  {:>14.1f}".format(name, blocks, size / 1024,
+                                                                     width=width))
+
+        return "\n".join(output)
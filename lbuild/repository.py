@@ -58,16 +58,19 @@ class OptionNameResolver:
     Option name resolver for repository options.
     """
 
-    def __init__(self, repository, options):
+    def __init__(self, repository, options, accessed=None):
         """
 
         Args:
             repository: Default repository. This name is used when the repository
                 name is left empty (e.g. ":option").
             options:
+            accessed (set): If given, the full names of all options which
+                are read are added to the set.
         """
         self.repository = repository
         self.options = options
+        self.accessed = accessed
 
     def __getitem__(self, key):
         parts = key.split(":")
@@ -79,10 +82,14 @@ class OptionNameResolver:
             key = "%s:%s" % (self.repository.name, option)
 
         try:
-            return self.options[key].value
+            value = self.options[key].value
         except KeyError:
             raise BlobException("Unknown option name '{}'".format(key))
 
+        if self.accessed is not None:
+            self.accessed.add(key)
+        return value
+
     def __repr__(self):
         return repr(self.options)
 
@@ -192,6 +199,9 @@ class Repository:
         # List of module filenames which are later transfered into
         # module objects
         self.module_files = []
+        # Module files added during the `init` step. Files added in the
+        # `prepare` step depend on the repository options.
+        self._init_module_files = []
 
         # List of available module objects (modules that returned True in
         # the `prepare` step).
@@ -200,6 +210,10 @@ class Repository:
         # Name -> Option()
         self.options = {}
 
+        # Python module name -> Filename of the executed repository or
+        # module file. See `release()`.
+        self.namespaces = {}
+
     def relocate_relative_path(self, path):
         """
         Relocate relative paths to the path of the repository
@@ -264,6 +278,7 @@ class Repository:
 
             local = lbuild.utils.with_forward_exception(repo,
                     lambda: lbuild.utils.load_module_from_file(repofilename, local))
+            repo.namespaces[local['__name__']] = repofilename
             repo.functions = Repository.get_global_functions(local, ['init', 'prepare'])
 
             # Execution init() function. In this function options are added.
@@ -273,6 +288,7 @@ class Repository:
             if repo.name is None:
                 raise BlobException("The init(repo) function must set a repository name! "
                                     "Please write the 'name' attribute.")
+            repo._init_module_files = list(repo.module_files)
         except FileNotFoundError as error:
             raise BlobException("Repository configuration file not found '{}'.".format(repofilename))
         except KeyError as error:
@@ -282,19 +298,45 @@ class Repository:
                                                  error))
         return repo
 
-    def prepare_repository(self, options):
+    def prepare_repository(self, options, accessed=None):
+        """
+        Execute the `prepare` function of the repository and parse and
+        prepare all modules.
+
+        May be called multiple times with different options. The modules
+        of the previous call are discarded.
+
+        Args:
+            options (dict): Repository options.
+            accessed (set): If given, the full names of all repository
+                options read by the repository and the modules are added
+                to the set.
+        """
+        self.module_files = list(self._init_module_files)
+        self.modules = {}
+
         lbuild.utils.with_forward_exception(self,
                 lambda: self.functions["prepare"](RepositoryFacade(self),
                                                   OptionNameResolver(self,
-                                                                     options)))
+                                                                     options,
+                                                                     accessed)))
 
         modules = {}
         # Parse the modules inside this repository
         for modulefile in self.module_files:
             module = lbuild.module.Module.parse_module_file(self, modulefile)
-            modules.update(module.prepare(options))
+            modules.update(module.prepare(options, accessed))
         return modules
 
+    def release(self):
+        """
+        Remove the Python modules of the repository and module files from
+        `sys.modules`.
+        """
+        for name in self.namespaces:
+            utils.unload_module(name)
+        self.namespaces = {}
+
     def remove_modules_without_parent(self):
         for name, module in self.modules.items():
             print(name, module.parent)
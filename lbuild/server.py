@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import contextlib
+import socketserver
+
+import lbuild.parser
+import lbuild.utils
+
+from .exception import BlobException
+
+LOGGER = logging.getLogger('lbuild.server')
+
+DEFAULT_SOCKET = ".lbuild_server.sock"
+
+
+class CacheEntry:
+    """
+    Parsed repositories for one set of repository files.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+
+        # Filename -> (mtime, size) of all executed repository and module files
+        self.stamps = {}
+        self.update()
+
+    @staticmethod
+    def _get_stamp(filename):
+        try:
+            stat = os.stat(filename)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def _get_filenames(self):
+        for repo in self.parser.repositories.values():
+            for filename in repo.namespaces.values():
+                yield filename
+
+    def update(self):
+        """
+        Record the state of the files which have been executed since the
+        last update.
+        """
+        for filename in self._get_filenames():
+            if filename not in self.stamps:
+                self.stamps[filename] = self._get_stamp(filename)
+
+    def is_valid(self):
+        """
+        Check that none of the executed files have been changed.
+
+        New module files (e.g. found by `find_modules_recursive()`) are only
+        detected if a repository or module file has been changed as well.
+        """
+        for filename, stamp in self.stamps.items():
+            if self._get_stamp(filename) != stamp:
+                LOGGER.info("File '%s' changed", filename)
+                return False
+        return True
+
+
+class RepositoryCache:
+    """
+    Keeps parsed repositories and prepared modules between requests.
+
+    The parsers are identified by the list of repository files. Each parser
+    keeps the prepared modules for every set of repository option values
+    (see `Parser.prepare_repositories()`).
+    """
+
+    def __init__(self):
+        # Tuple of repository filenames -> CacheEntry()
+        self.entries = {}
+
+    @staticmethod
+    def _get_key(config, repofilenames):
+        filenames = [os.path.realpath(filename) for filename in
+                     lbuild.utils.listify(repofilenames or [])]
+        filenames.extend(config.repositories)
+        return tuple(filenames)
+
+    def add(self, config, repofilenames, parser):
+        """
+        Add a parser which has already loaded the repositories.
+        """
+        key = self._get_key(config, repofilenames)
+        previous = self.entries.get(key, None)
+        if previous is not None and previous.parser is not parser:
+            previous.parser.close()
+        self.entries[key] = CacheEntry(parser)
+
+    def get_parser(self, config, repofilenames=None):
+        key = self._get_key(config, repofilenames)
+
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            if entry.is_valid():
+                LOGGER.debug("Reuse parsed repositories")
+                return entry.parser
+            entry.parser.close()
+            del self.entries[key]
+
+        parser = lbuild.parser.Parser()
+        try:
+            parser.load_repositories(config, repofilenames)
+        except:
+            parser.close()
+            raise
+        self.entries[key] = CacheEntry(parser)
+        return parser
+
+    def update(self):
+        """
+        Record the state of all files executed during the last request.
+        """
+        for entry in self.entries.values():
+            entry.update()
+
+    def clear(self):
+        for entry in self.entries.values():
+            entry.parser.close()
+        self.entries = {}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Execute a single command line received from a client.
+
+    The request is a single line of JSON containing the arguments and the
+    working directory of the client. The response contains the exit code
+    and the output of the command.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            response = self.server.execute(request["argv"], request["cwd"])
+        except (ValueError, KeyError) as error:
+            response = {"status": 2, "stdout": "", "stderr": "Invalid request: {}\n".format(error)}
+
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Server(socketserver.UnixStreamServer):
+    """
+    Server executing lbuild commands with warm repository state.
+
+    Requests are handled one after another, because each command changes
+    the working directory and redirects the standard output.
+    """
+
+    def __init__(self, socketpath):
+        self.socketpath = socketpath
+        self.cache = RepositoryCache()
+        socketserver.UnixStreamServer.__init__(self, socketpath, RequestHandler)
+
+    def execute(self, argv, cwd):
+        import lbuild.main
+
+        LOGGER.debug("Execute '%s' in '%s'", " ".join(argv), cwd)
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+
+        previous_cwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            # `contextlib.redirect_stderr()` requires Python 3.5
+            previous_stderr = sys.stderr
+            sys.stderr = stderr
+            try:
+                with contextlib.redirect_stdout(stdout):
+                    lbuild.main.main(argv, cache=self.cache)
+            except SystemExit as error:
+                if isinstance(error.code, int):
+                    status = error.code
+                elif error.code is not None:
+                    stderr.write("{}\n".format(error.code))
+                    status = 1
+            except Exception as error:
+                stderr.write("\nERROR: {}\n".format(error))
+                status = 1
+            finally:
+                sys.stderr = previous_stderr
+            self.cache.update()
+        finally:
+            os.chdir(previous_cwd)
+
+        return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.cache.clear()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socketpath)
+
+
+def serve(socketpath):
+    """
+    Run the server until it is interrupted.
+    """
+    if os.path.exists(socketpath):
+        # Remove stale socket files of servers which have not been shut
+        # down properly.
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socketpath)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socketpath)
+        else:
+            raise BlobException("Server already running at '{}'".format(socketpath))
+
+    # Terminate through an exception to remove the socket file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with Server(socketpath) as server:
+        LOGGER.info("Listening on '%s'", socketpath)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def forward(socketpath, argv, stdout, stderr):
+    """
+    Forward a command line to a running server.
+
+    Returns:
+        int: Exit code of the command.
+    """
+    request = {"argv": argv, "cwd": os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socketpath)
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with client.makefile("rb") as response_file:
+                response = json.loads(response_file.readline().decode("utf-8"))
+    except (OSError, ValueError) as error:
+        raise BlobException("Could not connect to server at '{}': {}".format(socketpath, error))
+
+    stdout.write(response["stdout"])
+    stderr.write(response["stderr"])
+    return response["status"]
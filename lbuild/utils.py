@@ -8,6 +8,7 @@
 # 2-clause BSD license. See the file `LICENSE.txt` for the full license
 # governing this code.
 
+import os
 import sys
 import uuid
 import importlib.util
@@ -21,6 +22,18 @@ def listify(node):
     return [node, ] if (not isinstance(node, list)) else node
 
 
+def get_user_cache_folder(*parts):
+    """
+    User level cache folder of lbuild.
+
+    Uses `$XDG_CACHE_HOME/lbuild` (default `~/.cache/lbuild`).
+    """
+    cachehome = os.environ.get("XDG_CACHE_HOME", "")
+    if cachehome == "":
+        cachehome = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cachehome, "lbuild", *parts)
+
+
 def load_module_from_file(filename, local, modulename=None):
     """
     Load a python module from a local file.
@@ -59,6 +72,16 @@ def load_module_from_file(filename, local, modulename=None):
     return module.__dict__
 
 
+def unload_module(modulename):
+    """
+    Remove a module loaded by `load_module_from_file` from `sys.modules`.
+
+    The module namespace is freed once no other references to it (e.g.
+    functions defined in the module) exist anymore.
+    """
+    sys.modules.pop(modulename, None)
+
+
 def with_forward_exception(module, function):
     """
     Run a function a store exceptions as forward exceptions.
@@ -9,5 +9,6 @@
 # governing this code.
 
 from . import common
+from . import snapshot
 
-__all__ = ["common"]
+__all__ = ["common", "snapshot"]
@@ -9,10 +9,12 @@
 # governing this code.
 
 import enum
+import time
 import logging
+import concurrent.futures
 
 import lbuild.config
-from ..exception import BlobException
+from ..exception import BlobException, BlobAggregateException
 
 LOGGER = logging.getLogger('lbuild.vcs')
 
@@ -22,27 +24,105 @@ class Action(enum.Enum):
     update = 1
 
 
-def _parse_vcs(config: lbuild.config.Configuration,
-               action):
-    LOGGER.debug("Initialize VCS repositories")
+# Maximum number of repositories initialized or updated in parallel
+DEFAULT_JOBS = 4
+
+# Value of `object_store` selecting the default user level object store
+DEFAULT_OBJECT_STORE = ""
 
+
+def _get_repositories(config: lbuild.config.Configuration, object_store=None):
+    repositories = []
     for vcs in config.vcs:
         for tag, repoconfig in vcs.items():
             if tag == "git":
                 LOGGER.debug("Found Git repository")
 
                 from . import git
-                repo = git.Repository(config.cachefolder, repoconfig)
+                store = None
+                if object_store == DEFAULT_OBJECT_STORE:
+                    store = git.ObjectStore()
+                elif object_store is not None:
+                    store = git.ObjectStore(object_store)
+                repositories.append(git.Repository(config.cachefolder, repoconfig, store))
             else:
                 raise BlobException("Unsupported VCS type '{}'".format(tag))
+    return repositories
+
+
+def _perform(repo, action):
+    starttime = time.time()
+    if action == Action.init:
+        repo.initialize()
+    elif action == Action.update:
+        repo.update()
+    return time.time() - starttime
+
+
+def _parse_vcs(config: lbuild.config.Configuration,
+               action,
+               jobs=None,
+               progress=None,
+               object_store=None):
+    """
+    Initialize or update all repositories.
+
+    The repositories are processed in parallel by a pool of threads, the
+    work is done by git subprocesses.
+
+    Args:
+        jobs: Maximum number of repositories processed in parallel.
+        progress: Function called with a message after each repository
+            has been processed.
+        object_store: Path of the object store shared between cache
+            folders (see `git.ObjectStore`). `DEFAULT_OBJECT_STORE`
+            selects the default user level folder, `None` disables the
+            store.
+    """
+    LOGGER.debug("Initialize VCS repositories")
+
+    repositories = _get_repositories(config, object_store)
+    if action == Action.init:
+        # Repositories restored from a snapshot are already checked out
+        from . import snapshot
+        manifest = snapshot.read_manifest(config.cachefolder)
+        restored = [repo for repo in repositories if snapshot.is_restored(config, repo, manifest)]
+        for repo in restored:
+            LOGGER.debug("Repository '%s' restored from snapshot", repo.name)
+            if progress is not None:
+                progress("{}: restored from snapshot".format(repo.name))
+        repositories = [repo for repo in repositories if repo not in restored]
+
+    if len(repositories) == 0:
+        return
+
+    jobs = DEFAULT_JOBS if jobs is None else jobs
+    jobs = max(1, min(jobs, len(repositories)))
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_perform, repo, action): repo for repo in repositories}
+        for index, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            repo = futures[future]
+            try:
+                duration = future.result()
+                message = "{} in {:.1f} s".format("initialized" if action == Action.init else "updated",
+                                                  duration)
+            except Exception as error:
+                errors.append(BlobException("Failed to {} repository '{}': {}"
+                                            .format(action.name, repo.name, error)))
+                message = "failed"
+
+            if progress is not None:
+                progress("[{}/{}] {}: {}".format(index, len(repositories), repo.name, message))
+
+    if errors:
+        raise BlobAggregateException(errors)
+
 
-            if action == Action.init:
-                repo.initialize()
-            elif action == Action.update:
-                repo.update()
+def initialize(configfile, jobs=None, progress=None, object_store=None):
+    _parse_vcs(configfile, Action.init, jobs, progress, object_store)
 
-def initialize(configfile):
-    _parse_vcs(configfile, Action.init)
 
-def update(configfile):
-    _parse_vcs(configfile, Action.update)
+def update(configfile, jobs=None, progress=None, object_store=None):
+    _parse_vcs(configfile, Action.update, jobs, progress, object_store)
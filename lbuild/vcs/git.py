@@ -9,62 +9,365 @@
 # governing this code.
 
 import os
+import re
+import json
+import hashlib
 import logging
+import threading
+import contextlib
 
 import git
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, only threads of the same process are
+    # serialized
+    fcntl = None
+
+import lbuild.utils
+from ..exception import BlobException
+
 LOGGER = logging.getLogger('lbuild.vcs.git')
 
+# Folder within the cache folder containing the state stamps of the
+# repositories
+STATE_FOLDER = ".lbuild_state"
+
+
+def get_default_object_store():
+    """
+    User level folder for the shared object store.
+
+    Uses `$XDG_CACHE_HOME/lbuild/git` (default `~/.cache/lbuild/git`).
+    """
+    return lbuild.utils.get_user_cache_folder("git")
+
+
+class ObjectStore:
+    """
+    Bare mirrors of remote repositories shared between all cache folders.
+
+    The repositories in the cache folders borrow the objects from the
+    mirrors through git alternates (`git clone --reference`). Objects are
+    therefore only transferred once per machine and not once per project.
+    Objects are never pruned from the mirrors, which would break the
+    repositories borrowing from them. The automatic garbage collection is
+    therefore disabled in the mirrors.
+
+    The store is shared by all lbuild processes of the user. The access to
+    a mirror is serialized by a lock file next to it (`<mirror>.lock`).
+    """
+
+    # Serializes the access to the same mirror from multiple threads.
+    # Mirror path -> Lock()
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = get_default_object_store() if path is None else path
+
+    def get_mirror_path(self, url):
+        name = re.sub(r"[^\w.-]", "_", os.path.basename(url.rstrip("/")))
+        if name.endswith(".git"):
+            name = name[:-4]
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.path, "{}-{}.git".format(name, digest))
+
+    def _get_lock(self, mirror):
+        with self._locks_lock:
+            return self._locks.setdefault(mirror, threading.Lock())
+
+    @contextlib.contextmanager
+    def _lock(self, mirror):
+        """
+        Lock the mirror against other threads and processes.
+        """
+        with self._get_lock(mirror):
+            os.makedirs(self.path, exist_ok=True)
+            with open(mirror + ".lock", "a") as lockfile:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                # The lock is released by closing the file
+                yield
+
+    @staticmethod
+    def _disable_gc(repo):
+        """
+        Never prune objects from the mirror, even if they are no longer
+        referenced after a forced update of its refs.
+        """
+        with repo.config_writer() as writer:
+            writer.set_value("gc", "auto", "0")
+            writer.set_value("gc", "pruneExpire", "never")
+
+    def update(self, url):
+        """
+        Create or update the mirror of the given remote repository.
+
+        Returns:
+            Path of the mirror.
+        """
+        mirror = self.get_mirror_path(url)
+        with self._lock(mirror):
+            if os.path.exists(mirror):
+                LOGGER.debug("Update object store '%s'", mirror)
+                repo = git.Repo(mirror)
+                # Mirrors created by older versions of lbuild
+                self._disable_gc(repo)
+                repo.git.fetch("origin")
+            else:
+                LOGGER.info("Add '%s' to the object store", url)
+                repo = git.Repo.clone_from(url, mirror, mirror=True)
+                self._disable_gc(repo)
+        return mirror
+
 
 class Repository:
 
-    def __init__(self, cachefolder, config):
+    def __init__(self, cachefolder, config, object_store=None):
+        """
+        Args:
+            cachefolder: Folder in which the repository is checked out.
+            config: Repository configuration from the project configuration.
+            object_store: ObjectStore() used to share the git objects with
+                the repositories of other cache folders. Optional.
+        """
         self.cachefolder = cachefolder
+        self.object_store = object_store
 
         self.name = config["name"]
         self.url = config["url"]
         self.branch = config["branch"]
         self.commit = config.get("commit", None)
 
+        # Number of commits fetched from the history of the branch
+        depth = config.get("depth", None)
+        self.depth = None if depth is None else int(depth)
+        # Fetch only the given commit
+        self.single_commit = config.get("single-commit", "false") in ["true", "1"]
+        # Path patterns (in .gitignore format) of the files checked out
+        sparse = config.get("sparse", None)
+        self.sparse = [] if sparse is None else lbuild.utils.listify(sparse["path"])
+
+        if self.single_commit and (self.commit is None or len(self.commit) != 40):
+            raise BlobException("Repository '{}': Fetching a single commit requires "
+                                "the full 40 character commit hash.".format(self.name))
+
         self.localpath = os.path.join(cachefolder, self.name)
         self._repo = None
 
+    @property
+    def fetch_url(self):
+        """
+        Use the file:// protocol for local repositories. Otherwise git
+        ignores the depth of the clone.
+        """
+        if (self.depth is not None or self.single_commit) and os.path.isdir(self.url):
+            return "file://" + os.path.abspath(self.url)
+        return self.url
+
+    def _clone(self):
+        options = {}
+        if self.depth is not None:
+            options["depth"] = self.depth
+        if self.object_store is not None:
+            options["reference"] = self.object_store.update(self.url)
+        if self.sparse:
+            options["no_checkout"] = True
+
+        repo = git.Repo.clone_from(self.fetch_url,
+                                   self.localpath,
+                                   branch=self.branch,
+                                   **options)
+        if self.sparse:
+            self._set_sparse_checkout(repo)
+            repo.git.checkout(self.branch)
+        return repo
+
+    def _fetch_single_commit(self):
+        """
+        Initialize an empty repository and fetch only the pinned commit
+        without any history.
+        """
+        repo = git.Repo.init(self.localpath)
+        repo.create_remote("origin", self.fetch_url)
+        if self.object_store is not None:
+            mirror = self.object_store.update(self.url)
+            alternates = os.path.join(repo.git_dir, "objects", "info", "alternates")
+            with open(alternates, "w") as alternatesfile:
+                alternatesfile.write(os.path.abspath(os.path.join(mirror, "objects")) + "\n")
+        if self.sparse:
+            self._set_sparse_checkout(repo)
+
+        repo.git.fetch("origin", self.commit, depth=1)
+        repo.git.checkout("-B", "past_branch", self.commit)
+        return repo
+
+    def _set_sparse_checkout(self, repo):
+        LOGGER.debug("Restrict checkout to '%s'", "', '".join(self.sparse))
+        repo.git.sparse_checkout("set", "--no-cone", *self.sparse)
+
     def get_repository(self):
         if self._repo is None:
             if os.path.exists(self.localpath):
                 LOGGER.debug("Found existing repository in %s", self.localpath)
                 self._repo = git.Repo(self.localpath)
+            elif self.single_commit:
+                LOGGER.info("Fetch commit '%s' into %s", self.commit, self.localpath)
+                self._repo = self._fetch_single_commit()
             else:
                 LOGGER.info("Initialize new repository in %s", self.localpath)
-                self._repo = git.Repo.clone_from(self.url,
-                                                 self.localpath,
-                                                 branch=self.branch)
+                self._repo = self._clone()
         return self._repo
 
     def initialize(self):
         repo = self.get_repository()
+        if self.sparse:
+            self._set_sparse_checkout(repo)
+
         if self.commit is not None:
+            self._ensure_commit(repo, self.commit)
             self.switch_to_commit(repo, self.commit)
         else:
             self.switch_to_branch(repo, self.branch)
 
         for submodule in repo.submodules:
             submodule.update(init=True, recursive=True)
+        self.write_state(repo)
+
+    @property
+    def statefile(self):
+        """
+        State stamp of the repository, stored in the cache folder.
+        """
+        localpath = os.path.abspath(self.localpath)
+        digest = hashlib.sha1(localpath.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cachefolder, STATE_FOLDER,
+                            "{}-{}.json".format(os.path.basename(localpath), digest))
+
+    def _get_config_state(self):
+        return {
+            "url": self.url,
+            "branch": self.branch,
+            "commit": self.commit,
+            "depth": self.depth,
+            "single-commit": self.single_commit,
+            "sparse": self.sparse,
+        }
+
+    def read_state(self):
+        try:
+            with open(self.statefile) as statefile:
+                return json.load(statefile)
+        except (OSError, ValueError):
+            return None
+
+    def write_state(self, repo):
+        """
+        Record the configuration and the checked out commits of the
+        repository and its submodules.
+        """
+        state = {
+            "config": self._get_config_state(),
+            "head": repo.head.commit.hexsha,
+            "submodules": {submodule.path: submodule.hexsha for submodule in repo.submodules},
+        }
+        os.makedirs(os.path.dirname(self.statefile), exist_ok=True)
+        with open(self.statefile, "w") as statefile:
+            json.dump(state, statefile, indent=2, sort_keys=True)
+
+    def is_up_to_date(self):
+        """
+        Check if the repository is pinned to a commit which is already
+        checked out.
+
+        Only the local state is inspected. The checked out commits of the
+        repository and its submodules must match the state stamp written by
+        the last `initialize()` or `update()`.
+        """
+        if self.commit is None or not os.path.exists(self.localpath):
+            return False
+        state = self.read_state()
+        if state is None or state.get("config") != self._get_config_state():
+            return False
+
+        try:
+            repo = self.get_repository()
+            head = repo.head.commit.hexsha
+            if not head.startswith(self.commit) or head != state["head"]:
+                return False
+
+            submodules = state["submodules"]
+            if len(submodules) != len(repo.submodules):
+                return False
+            for submodule in repo.submodules:
+                if submodules.get(submodule.path, None) != submodule.hexsha:
+                    return False
+                if submodule.module().head.commit.hexsha != submodule.hexsha:
+                    return False
+        except (ValueError, KeyError, git.GitError):
+            return False
+        return True
+
+    def _ensure_commit(self, repo, commit):
+        """
+        Fetch the commit if it is not available locally.
+        """
+        try:
+            repo.commit(commit)
+            return
+        except (ValueError, git.BadName):
+            pass
+
+        if not os.path.exists(os.path.join(repo.git_dir, "shallow")):
+            LOGGER.debug("Fetch origin to find commit '%s'", commit)
+            repo.git.fetch("origin")
+        elif len(commit) == 40:
+            LOGGER.debug("Fetch commit '%s'", commit)
+            repo.git.fetch("origin", commit, depth=1)
+        else:
+            # Abbreviated hashes can not be fetched directly
+            LOGGER.debug("Fetch complete history to find commit '%s'", commit)
+            repo.git.fetch("origin", unshallow=True)
 
     def update(self):
+        if self.is_up_to_date():
+            # A pinned commit can not change, no need to contact the remote
+            LOGGER.debug("Repository '%s' is up to date", self.name)
+            return
+
         repo = self.get_repository()
-        LOGGER.debug("Pull from origin")
-        origin = repo.remotes.origin
-        origin.pull()
+        if self.object_store is not None and self._uses_object_store(repo):
+            # Fetch new objects into the shared store first, the pull then
+            # finds them through the alternates
+            self.object_store.update(self.url)
+
+        if self.commit is not None:
+            # There is no branch to pull, fetch the pinned commit instead
+            self._ensure_commit(repo, self.commit)
+            self.switch_to_commit(repo, self.commit)
+        else:
+            LOGGER.debug("Pull from origin")
+            origin = repo.remotes.origin
+            if self.depth is not None:
+                origin.pull(depth=self.depth)
+            else:
+                origin.pull()
 
         for submodule in repo.submodules:
             submodule.update(recursive=True)
+        self.write_state(repo)
+
+    @staticmethod
+    def _uses_object_store(repo):
+        return os.path.exists(os.path.join(repo.git_dir, "objects", "info", "alternates"))
 
     @staticmethod
     def switch_to_commit(repo, commit):
         if not repo.head.commit.hexsha.startswith(commit):
             LOGGER.debug("Switch to commit '%s'", commit)
-            past_branch = repo.create_head("past_branch", commit)
+            past_branch = repo.create_head("past_branch", commit, force=True)
             repo.head.reference = past_branch
             repo.head.reset(index=True, working_tree=True)
             repo.heads.past_branch.checkout()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+"""
+Offline snapshots of the repositories in the cache folder.
+
+A snapshot is a compressed tar archive with the checked out repositories
+(including their `.git` folders), the caches stored in the cache folder and
+a manifest of the checked out commits. Restoring a snapshot only unpacks
+the archive, git is not required.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import tarfile
+import logging
+import tempfile
+
+import lbuild.config
+from ..exception import BlobException
+
+LOGGER = logging.getLogger('lbuild.vcs.snapshot')
+
+# Name of the manifest within the archive and the cache folder
+MANIFEST = ".lbuild_snapshot.json"
+
+# Folders within the cache folder which are added to a snapshot in addition
+# to the repositories
+CACHE_FOLDERS = [".lbuild_state"]
+
+COMPRESSION = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tar.xz": "xz",
+}
+
+
+def _get_compression(filename):
+    for suffix, compression in COMPRESSION.items():
+        if filename.endswith(suffix):
+            return compression
+    return "gz"
+
+
+def _get_relative_path(config, localpath):
+    cachefolder = os.path.realpath(config.cachefolder)
+    path = os.path.relpath(os.path.realpath(localpath), cachefolder)
+    if path == os.curdir or path.startswith(os.pardir + os.sep) or path == os.pardir:
+        raise BlobException("Repository '{}' is not located in the cache folder '{}'. "
+                            "Only repositories in the cache folder can be added to "
+                            "a snapshot.".format(localpath, config.cachefolder))
+    return path
+
+
+def read_manifest(cachefolder):
+    """
+    Read the manifest of a snapshot restored into the cache folder.
+
+    Returns:
+        dict: Manifest or `None` if no snapshot has been restored.
+    """
+    try:
+        with open(os.path.join(cachefolder, MANIFEST)) as manifestfile:
+            return json.load(manifestfile)
+    except (OSError, ValueError):
+        return None
+
+
+def is_restored(config, repo, manifest):
+    """
+    Check if the repository has been restored from a snapshot and matches
+    its configuration.
+    """
+    if manifest is None or not os.path.exists(repo.localpath):
+        return False
+    try:
+        entry = manifest["repositories"][_get_relative_path(config, repo.localpath)]
+    except (KeyError, BlobException):
+        return False
+
+    if entry["url"] != repo.url or entry["branch"] != repo.branch:
+        return False
+    if repo.commit is not None and not entry["head"].startswith(repo.commit):
+        return False
+    return True
+
+
+def _get_git_repositories(gitrepo):
+    """
+    The repository and all its checked out submodules.
+    """
+    repositories = [gitrepo]
+    for submodule in gitrepo.submodules:
+        if submodule.module_exists():
+            repositories.extend(_get_git_repositories(submodule.module()))
+    return repositories
+
+
+def _get_alternates(gitrepo):
+    return os.path.join(gitrepo.git_dir, "objects", "info", "alternates")
+
+
+def _uses_alternates(gitrepo):
+    return any(os.path.exists(_get_alternates(repo)) for repo in _get_git_repositories(gitrepo))
+
+
+def _dissociate(gitrepo):
+    """
+    Copy the objects borrowed through git alternates (e.g. from the shared
+    object store) into the repository and its submodules. The alternates
+    point to folders which do not exist where the snapshot is restored.
+    """
+    for repo in _get_git_repositories(gitrepo):
+        alternates = _get_alternates(repo)
+        if os.path.exists(alternates):
+            repo.git.repack("-a", "-d")
+            os.remove(alternates)
+
+
+def create(config: lbuild.config.Configuration, filename):
+    """
+    Pack all initialized repositories and caches of the cache folder into
+    an archive.
+
+    The compression is selected by the file extension ('.tar', '.tar.gz',
+    '.tar.bz2', '.tar.xz'), the default is gzip.
+
+    Repositories using objects of the shared object store are copied into
+    a temporary folder and made self-contained there. The cache folder is
+    not changed.
+
+    Returns:
+        dict: Manifest of the snapshot.
+    """
+    with tempfile.TemporaryDirectory(prefix="lbuild_snapshot_") as stagingpath:
+        return _create(config, filename, stagingpath)
+
+
+def _create(config, filename, stagingpath):
+    # GitPython is only required to create a snapshot, not to restore it
+    import git
+    from . import common
+
+    manifest = {"repositories": {}}
+    # Name within the archive -> Path of the added file or folder
+    members = {}
+    for repo in common._get_repositories(config):
+        if not os.path.exists(repo.localpath):
+            raise BlobException("Repository '{}' is not initialized, run "
+                                "'lbuild init' first.".format(repo.name))
+        path = _get_relative_path(config, repo.localpath)
+        gitrepo = repo.get_repository()
+        manifest["repositories"][path] = {
+            "name": repo.name,
+            "url": repo.url,
+            "branch": repo.branch,
+            "commit": repo.commit,
+            "head": gitrepo.head.commit.hexsha,
+            "submodules": {submodule.path: submodule.hexsha for submodule in gitrepo.submodules},
+        }
+        members[path] = repo.localpath
+        if _uses_alternates(gitrepo):
+            LOGGER.info("Copy shared objects into a copy of '%s'", repo.name)
+            members[path] = os.path.join(stagingpath, path)
+            shutil.copytree(repo.localpath, members[path], symlinks=True)
+            _dissociate(git.Repo(members[path]))
+
+    for folder in CACHE_FOLDERS:
+        if os.path.exists(os.path.join(config.cachefolder, folder)):
+            members[folder] = os.path.join(config.cachefolder, folder)
+
+    LOGGER.info("Create snapshot '%s'", filename)
+    with tarfile.open(filename, "w:" + _get_compression(filename)) as archive:
+        # The manifest is only written into the cache folder by `restore()`
+        content = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(content)
+        info.mtime = time.time()
+        archive.addfile(info, io.BytesIO(content))
+        for member, sourcepath in sorted(members.items()):
+            LOGGER.debug("Add '%s' to the snapshot", member)
+            archive.add(sourcepath, arcname=member)
+    return manifest
+
+
+def _check_members(archive):
+    for member in archive.getmembers():
+        path = os.path.normpath(member.name)
+        if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise BlobException("Invalid path '{}' in snapshot".format(member.name))
+        if member.issym() or member.islnk():
+            target = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+            if os.path.isabs(member.linkname) or target.startswith(os.pardir):
+                raise BlobException("Invalid link '{}' in snapshot".format(member.name))
+        if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+            raise BlobException("Invalid file type of '{}' in snapshot".format(member.name))
+
+
+def restore(config: lbuild.config.Configuration, filename):
+    """
+    Unpack a snapshot into the cache folder.
+
+    Existing files are overwritten. `lbuild init` afterwards only clones
+    repositories which are not part of the snapshot.
+
+    Returns:
+        dict: Manifest of the snapshot.
+    """
+    LOGGER.info("Restore snapshot '%s'", filename)
+    try:
+        with tarfile.open(filename, "r:*") as archive:
+            _check_members(archive)
+            os.makedirs(config.cachefolder, exist_ok=True)
+            # Use the safe extraction filter of newer Python versions as well
+            options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+            archive.extractall(config.cachefolder, **options)
+    except (OSError, tarfile.TarError) as error:
+        raise BlobException("Unable to restore snapshot '{}': {}".format(filename, error))
+
+    manifest = read_manifest(config.cachefolder)
+    if manifest is None:
+        raise BlobException("Snapshot '{}' contains no manifest".format(filename))
+    return manifest
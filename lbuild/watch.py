@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+
+LOGGER = logging.getLogger('lbuild.watch')
+
+# Events from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+# Time to wait for further events after the first change has been detected.
+# Editors often write a file in multiple steps.
+DEBOUNCE_TIME = 0.05
+
+
+class InotifyWatcher:
+    """
+    Wait for file changes using the Linux inotify interface.
+
+    The directories of the files are watched instead of the files itself to
+    detect files which are replaced by editors through a rename.
+    """
+
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # Watch descriptor -> Directory
+        self._directories = {}
+        # Directory -> Watch descriptor
+        self._watches = {}
+
+    def _add_watch(self, directory):
+        if directory in self._watches:
+            return
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+        if descriptor < 0:
+            LOGGER.debug("Unable to watch '%s'", directory)
+            return
+        self._directories[descriptor] = directory
+        self._watches[directory] = descriptor
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buffer):
+            descriptor, _, _, length = IN_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += IN_EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            directory = self._directories.get(descriptor, None)
+            if directory is not None and name:
+                yield os.path.join(directory, os.fsdecode(name))
+
+    def _poll(self, timeout):
+        return len(select.select([self._fd], [], [], timeout)[0]) > 0
+
+    def wait(self, filenames, timeout=None):
+        """
+        Wait until at least one of the given files is changed, created or
+        removed.
+
+        Returns:
+            set: Changed files. Empty if the timeout expired.
+        """
+        filenames = set(os.path.realpath(filename) for filename in filenames)
+        for directory in set(os.path.dirname(filename) for filename in filenames):
+            self._add_watch(directory)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._poll(remaining):
+                return changed
+            changed.update(filename for filename in self._read_events() if filename in filenames)
+
+        while self._poll(DEBOUNCE_TIME):
+            changed.update(filename for filename in self._read_events() if filename in filenames)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Wait for file changes by comparing the modification time and size of
+    the files at regular intervals.
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+
+    @staticmethod
+    def _get_stamp(filename):
+        try:
+            stat = os.stat(filename)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def wait(self, filenames, timeout=None):
+        """
+        See `InotifyWatcher.wait()`.
+        """
+        stamps = {os.path.realpath(filename): None for filename in filenames}
+        for filename in stamps:
+            stamps[filename] = self._get_stamp(filename)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set(filename for filename, stamp in stamps.items()
+                          if self._get_stamp(filename) != stamp)
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def create_watcher():
+    """
+    Use inotify if available, otherwise fall back to polling.
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as error:
+        LOGGER.debug("inotify not available (%s), use polling", error)
+        return PollingWatcher()
+
+
+def get_watched_files(config, parser, build_operations):
+    """
+    Collect all files which influence the output of a build.
+
+    Args:
+        config: Project configuration. Contains all files of the
+            `<extends>` chain.
+        parser: Parser with the loaded repositories.
+        build_operations: Operations of the build step, key is the full
+            module name (see `Parser.build_modules()`).
+
+    Returns:
+        set: Absolute filenames.
+    """
+    filenames = set(config.files)
+    for repo in parser.repositories.values():
+        filenames.update(repo.namespaces.values())
+    for operations in build_operations.values():
+        filenames.update(operation.filename_in for operation in operations)
+    return set(os.path.realpath(filename) for filename in filenames)
+
+
+def get_affected_modules(build_operations, changed):
+    """
+    Find the modules which have used one of the changed files in their
+    build step.
+
+    Files which are used indirectly, e.g. through an include from within a
+    template, are not detected.
+
+    Returns:
+        set: Full module names.
+    """
+    affected = set()
+    for modulename, operations in build_operations.items():
+        for operation in operations:
+            if os.path.realpath(operation.filename_in) in changed:
+                affected.add(modulename)
+                break
+    return affected
+
+
+def requires_full_build(config, parser, changed):
+    """
+    Check if a configuration, repository or module file has been changed.
+    """
+    filenames = set(config.files)
+    for repo in parser.repositories.values():
+        filenames.update(os.path.realpath(filename) for filename in repo.namespaces.values())
+    return len(filenames & changed) > 0
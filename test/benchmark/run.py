@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+"""
+Benchmark lbuild with synthetic repositories of different sizes.
+
+Usage (from the root folder of the project):
+
+    python3 -m test.benchmark.run --modules 100 1000 --output benchmark.json
+
+The results of two runs can be compared by loading the generated JSON files.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import lbuild
+
+from .synthetic import SyntheticRepository
+
+
+def run_benchmark(repository, repeat=1):
+    """
+    Generate the repository and build it.
+
+    Returns:
+        dict: Parameters of the repository, the total time and the time per
+            phase of the fastest run.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        repofile, configfile = repository.generate(os.path.join(tempdir, "repository"))
+
+        for _ in range(repeat):
+            outpath = os.path.join(tempdir, "output")
+            shutil.rmtree(outpath, ignore_errors=True)
+
+            profiler = lbuild.profiler.Profiler()
+            lbuild.profiler.enable(profiler)
+            try:
+                starttime = time.perf_counter()
+                with lbuild.parser.Parser() as parser:
+                    parser.parse_repository(repofile)
+                    parser.configure_and_build_library(configfile, outpath)
+                total = time.perf_counter() - starttime
+            finally:
+                lbuild.profiler.disable(profiler)
+
+            results.append({
+                "parameters": repository.parameters,
+                "time": total,
+                "phases": profiler.to_dict()["phases"],
+            })
+
+    return min(results, key=lambda result: result["time"])
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Benchmark lbuild with synthetic repositories.")
+    argument_parser.add_argument("--modules",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Number of modules (default: %(default)s).")
+    argument_parser.add_argument("--depth",
+        type=int,
+        default=1,
+        help="Depth of the submodules below each top-level module "
+             "(default: %(default)s).")
+    argument_parser.add_argument("--fanout",
+        type=int,
+        default=2,
+        help="Number of dependencies of each top-level module (default: %(default)s).")
+    argument_parser.add_argument("--options",
+        type=int,
+        default=2,
+        help="Number of options per module (default: %(default)s).")
+    argument_parser.add_argument("--template-lines",
+        dest="template_lines",
+        type=int,
+        default=50,
+        help="Number of lines of each template (default: %(default)s).")
+    argument_parser.add_argument("--copied-files",
+        dest="copied_files",
+        type=int,
+        default=2,
+        help="Number of files copied by each module (default: %(default)s).")
+    argument_parser.add_argument("--repeat",
+        type=int,
+        default=1,
+        help="Number of runs per size. The fastest run is stored (default: %(default)s).")
+    argument_parser.add_argument("-o", "--output",
+        help="Write the results as JSON into the given file.")
+    args = argument_parser.parse_args()
+
+    results = []
+    for modules in args.modules:
+        repository = SyntheticRepository(modules=modules,
+                                         depth=args.depth,
+                                         fanout=args.fanout,
+                                         options=args.options,
+                                         template_lines=args.template_lines,
+                                         copied_files=args.copied_files)
+        result = run_benchmark(repository, args.repeat)
+        results.append(result)
+
+        phases = ", ".join("{}={:.3f}s".format(phase["name"], phase["time"])
+                           for phase in result["phases"])
+        print("{:>6} modules: {:.3f}s ({})".format(modules, result["time"], phases))
+
+    if args.output is not None:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
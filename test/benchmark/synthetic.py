@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+
+REPOSITORY_NAME = "synthetic"
+
+REPOSITORY_TEMPLATE = """\
+def init(repo):
+    repo.name = "{name}"
+    repo.add_option(StringOption(name="target", description="", default="hosted"))
+
+def prepare(repo, options):
+    repo.find_modules_recursive(".", modulefile="module.lb")
+"""
+
+MODULE_TEMPLATE = """\
+def init(module):
+    module.name = "{name}"
+
+def prepare(module, options):
+{dependencies}{options}{submodules}    return True
+
+def build(env):
+    env.outbasepath = "{outpath}"
+{template}{copy}"""
+
+CONFIG_TEMPLATE = """\
+<?xml version='1.0' encoding='UTF-8'?>
+<library>
+  <repositories>
+    <repository>
+      <path>repo.lb</path>
+    </repository>
+  </repositories>
+
+  <options>
+  </options>
+
+  <modules>
+    <module>{name}:**</module>
+  </modules>
+</library>
+"""
+
+
+class SyntheticRepository:
+    """
+    Generator for lbuild repositories of a configurable size.
+
+    The modules are arranged as a number of top-level modules, each with a
+    chain of nested submodules. Every top-level module depends on the
+    previous top-level modules.
+    """
+
+    def __init__(self,
+                 modules=100,
+                 depth=1,
+                 fanout=2,
+                 options=2,
+                 template_lines=50,
+                 copied_files=2):
+        """
+        Args:
+            modules: Total number of modules including all submodules.
+            depth: Number of nested submodules below each top-level module.
+            fanout: Number of dependencies of each top-level module.
+            options: Number of options per module.
+            template_lines: Number of lines of the template of each module.
+                No template is generated if set to zero.
+            copied_files: Number of files each module copies into the
+                output folder.
+        """
+        self.modules = modules
+        self.depth = depth
+        self.fanout = fanout
+        self.options = options
+        self.template_lines = template_lines
+        self.copied_files = copied_files
+
+    @property
+    def parameters(self):
+        return {
+            "modules": self.modules,
+            "depth": self.depth,
+            "fanout": self.fanout,
+            "options": self.options,
+            "template_lines": self.template_lines,
+            "copied_files": self.copied_files,
+        }
+
+    def _write(self, filename, content):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as outfile:
+            outfile.write(content)
+
+    def _generate_template(self):
+        lines = []
+        for index in range(self.template_lines):
+            if self.options > 0:
+                option = "option{}".format(index % self.options)
+                lines.append("int value_{} = {{{{ options[\"{}\"] }}}};".format(index, option))
+            else:
+                lines.append("int value_{} = {};".format(index, index))
+        return "\n".join(lines) + "\n"
+
+    def _generate_module(self, path, name, relpath, dependencies, submodule):
+        """
+        Write the module file together with its template and source files.
+
+        Returns:
+            Filename of the module file relative to `path`.
+        """
+        body = {
+            "name": name,
+            "dependencies": "",
+            "options": "",
+            "submodules": "",
+            "outpath": relpath,
+            "template": "",
+            "copy": "",
+        }
+        if dependencies:
+            body["dependencies"] = "    module.depends({})\n".format(
+                ", ".join("\"{}\"".format(dependency) for dependency in dependencies))
+        for index in range(self.options):
+            body["options"] += ("    module.add_option(NumericOption(name=\"option{0}\", "
+                                "description=\"\", default={0}))\n".format(index))
+        if submodule is not None:
+            body["submodules"] = "    module.add_submodule(\"{}\")\n".format(submodule)
+
+        if self.template_lines > 0:
+            body["template"] = "    env.template(\"template.cpp.in\")\n"
+            self._write(os.path.join(path, "template.cpp.in"), self._generate_template())
+        if self.copied_files > 0:
+            body["copy"] = "    env.copy(\"src\")\n"
+            for index in range(self.copied_files):
+                self._write(os.path.join(path, "src", "file{}.h".format(index)),
+                            "// {} file {}\n".format(relpath, index))
+
+        # Only the top-level modules are found by the repository, submodules
+        # are added by their parent module.
+        filename = "submodule.lb" if "/" in relpath else "module.lb"
+        self._write(os.path.join(path, filename), MODULE_TEMPLATE.format(**body))
+        return filename
+
+    def generate(self, path):
+        """
+        Generate the repository and a matching project configuration.
+
+        Returns:
+            Tuple of the repository and the configuration filename.
+        """
+        repofile = os.path.join(path, "repo.lb")
+        self._write(repofile, REPOSITORY_TEMPLATE.format(name=REPOSITORY_NAME))
+
+        count = 0
+        index = 0
+        while count < self.modules:
+            name = "module{}".format(index)
+            dependencies = ["{}:module{}".format(REPOSITORY_NAME, index - offset)
+                            for offset in range(1, self.fanout + 1) if index - offset >= 0]
+
+            chain = [name]
+            while len(chain) <= self.depth and count + len(chain) < self.modules:
+                chain.append("sub{}".format(len(chain)))
+
+            # Generate the chain starting with the innermost submodule, each
+            # module adds the next deeper submodule.
+            submodule = None
+            for level in reversed(range(len(chain))):
+                relpath = "/".join(chain[:level + 1])
+                filename = self._generate_module(os.path.join(path, *chain[:level + 1]),
+                                                 chain[level],
+                                                 relpath,
+                                                 dependencies if level == 0 else [],
+                                                 submodule)
+                submodule = os.path.join(chain[level], filename)
+
+            count += len(chain)
+            index += 1
+
+        configfile = os.path.join(path, "project.xml")
+        self._write(configfile, CONFIG_TEMPLATE.format(name=REPOSITORY_NAME))
+
+        return repofile, configfile
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import sys
+import glob
+import unittest
+import unittest.mock
+import testfixtures
+
+import lxml.etree
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+from test.benchmark.synthetic import SyntheticRepository
+
+
+class BuildCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = testfixtures.TempDirectory()
+        self.repofile, self.configfile = SyntheticRepository(modules=4).generate(self.tempdir.path)
+        self.cachepath = self.tempdir.getpath("cache")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _run(self, *arguments):
+        argument_parser = lbuild.main.prepare_argument_parser()
+        args = argument_parser.parse_args(["--no-config-cache", "-c", self.configfile] +
+                                          list(arguments))
+        return lbuild.main.run(args)
+
+    def _build(self, outpath):
+        """
+        Returns:
+            Full names of the modules whose build step has been executed.
+        """
+        built = []
+        build = lbuild.module.Module.build
+
+        def record(module, env):
+            built.append(module.fullname)
+            return build(module, env)
+
+        with unittest.mock.patch.object(lbuild.module.Module, "build", autospec=True,
+                                        side_effect=record):
+            self._run("-p", self.tempdir.getpath(outpath), "build",
+                      "--build-cache", self.cachepath)
+        return sorted(built)
+
+    def _read_outputs(self, outpath):
+        files = {}
+        path = self.tempdir.getpath(outpath)
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                with open(os.path.join(root, filename), "rb") as infile:
+                    files[os.path.relpath(os.path.join(root, filename), path)] = infile.read()
+        return files
+
+    def _read_operations(self, outpath):
+        rootnode = lxml.etree.parse(self.configfile + ".log").getroot()
+        return sorted((node.findtext("module"),
+                       node.findtext("source"),
+                       os.path.relpath(node.findtext("destination"), self.tempdir.getpath(outpath)))
+                      for node in rootnode.iterfind("operation"))
+
+    def test_should_restore_outputs_from_cache(self):
+        self.assertEqual(4, len(self._build("build1")))
+        operations = self._read_operations("build1")
+
+        self.assertEqual([], self._build("build2"))
+        self.assertEqual(12, len(self._read_outputs("build2")))
+        self.assertEqual(self._read_outputs("build1"), self._read_outputs("build2"))
+        self.assertEqual(operations, self._read_operations("build2"))
+
+        # Unchanged files are not written again
+        self.assertEqual([], self._build("build2"))
+
+    def test_should_rebuild_modules_with_changed_inputs(self):
+        self._build("build1")
+
+        with open(self.tempdir.getpath("module1/src/file0.h"), "a") as sourcefile:
+            sourcefile.write("// changed\n")
+        self.assertEqual(["synthetic:module1"], self._build("build2"))
+        self.assertIn(b"// changed", self.tempdir.read("build2/module1/src/file0.h"))
+
+        # Options read by a template
+        content = open(self.configfile).read().replace(
+            "<options>\n", '<options>\n<option name="synthetic:module1:sub1:option0">7</option>\n')
+        with open(self.configfile, "w") as configfile:
+            configfile.write(content)
+        self.assertEqual(["synthetic:module1:sub1"], self._build("build2"))
+        self.assertIn(b"int value_0 = 7;", self.tempdir.read("build2/module1/sub1/template.cpp"))
+
+    def test_should_rebuild_modules_with_changed_prepare_options(self):
+        modulefile = self.tempdir.getpath("module1/module.lb")
+        content = open(modulefile).read().replace(
+            "def prepare(module, options):\n",
+            "def prepare(module, options):\n    module.target = options[\":target\"]\n")
+        with open(modulefile, "w") as outfile:
+            outfile.write(content)
+        self._build("build1")
+
+        content = open(self.configfile).read().replace(
+            "<options>\n", '<options>\n<option name="synthetic:target">other</option>\n')
+        with open(self.configfile, "w") as configfile:
+            configfile.write(content)
+        self.assertEqual(["synthetic:module1"], self._build("build2"))
+        self.assertEqual([], self._build("build3"))
+
+    def test_should_not_use_cache_for_dry_run(self):
+        self._run("-p", self.tempdir.getpath("build"), "build", "--dry-run",
+                  "--build-cache", self.cachepath)
+        self.assertFalse(os.path.exists(self.cachepath))
+
+    def test_should_evict_least_recently_used_entries(self):
+        self._build("build1")
+        entries = glob.glob(os.path.join(self.cachepath, "entries", "*", "*", "*.json"))
+        self.assertEqual(4, len(entries))
+
+        output = self._run("prune-cache", "--max-size", "1G", "--build-cache", self.cachepath)
+        self.assertIn("Removed 0 entries", output)
+
+        def get_files(folder):
+            return sorted(glob.glob(os.path.join(self.cachepath, folder, "*", "*", "*.json")
+                                    if folder == "entries" else
+                                    os.path.join(self.cachepath, folder, "*", "*")))
+
+        def get_size():
+            return sum(os.path.getsize(filename)
+                       for filename in get_files("entries") + get_files("objects"))
+
+        # The first entry is the least recently used
+        entries = sorted(entries)
+        for index, filename in enumerate(entries):
+            os.utime(filename, (index, index))
+        cache = lbuild.buildcache.BuildCache(self.cachepath)
+        self.assertEqual(1, cache.evict(get_size() - 1)[0])
+        self.assertEqual(entries[1:], get_files("entries"))
+
+        self.assertEqual((3, get_size()), cache.evict(0))
+        self.assertEqual([], get_files("entries"))
+        self.assertEqual([], get_files("objects"))
+
+    def test_should_calculate_lbuild_digest_once(self):
+        with unittest.mock.patch.object(lbuild.buildcache, "_lbuild_digest", None):
+            digest = lbuild.buildcache.get_lbuild_digest()
+            self.assertEqual(64, len(digest))
+            with unittest.mock.patch.object(lbuild.buildcache.os, "walk", side_effect=AssertionError):
+                self.assertEqual(digest, lbuild.buildcache.get_lbuild_digest())
+
+    def test_should_parse_size(self):
+        self.assertEqual(100, lbuild.buildcache.parse_size("100"))
+        self.assertEqual(1536, lbuild.buildcache.parse_size("1.5K"))
+        self.assertEqual(10 * 1024 ** 3, lbuild.buildcache.parse_size("10G"))
+        with self.assertRaises(lbuild.exception.BlobException):
+            lbuild.buildcache.parse_size("many")
+
+
+if __name__ == '__main__':
+    unittest.main()
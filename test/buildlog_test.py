@@ -76,6 +76,24 @@ class BuildLogTest(unittest.TestCase):
     <destination>out2</destination>
   </operation>
 </buildlog>
+""", log.to_xml())
+
+    def test_should_generate_xml_with_accessed_options(self):
+        log = lbuild.buildlog.BuildLog()
+
+        self.module1.prepare_accessed_options = {"repo:target"}
+        self.module1.build_accessed_options = {"repo:module1:foo", "repo:target"}
+        log.log_accessed_options(self.module1)
+
+        self.assertEqual(b"""<?xml version='1.0' encoding='UTF-8'?>
+<buildlog>
+  <options>
+    <module>repo:module1</module>
+    <prepare>repo:target</prepare>
+    <build>repo:module1:foo</build>
+    <build>repo:target</build>
+  </options>
+</buildlog>
 """, log.to_xml())
 
     def test_should_provide_operations_per_module(self):
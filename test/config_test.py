@@ -10,7 +10,10 @@
 
 import os
 import sys
+import shutil
 import unittest
+import unittest.mock
+import testfixtures
 
 # Hack to support the usage of `coverage`
 sys.path.append(os.path.abspath("."))
@@ -130,5 +133,99 @@ class ConfigTest(unittest.TestCase):
         self.assertIn("::submodule3:subsubmodule1", config.selected_modules)
         self.assertIn("::submodule3", config.selected_modules)
 
+    @testfixtures.tempdir()
+    def test_should_merge_many_options_in_order(self, tempdir):
+        def write(filename, options, modules, extends=None):
+            with open(tempdir.getpath(filename), "w") as outfile:
+                outfile.write("<library>\n")
+                if extends is not None:
+                    outfile.write("<extends>{}</extends>\n".format(extends))
+                outfile.write("<options>\n")
+                for name, value in options:
+                    outfile.write('<option name="{}">{}</option>\n'.format(name, value))
+                outfile.write("</options>\n<modules>\n")
+                for module in modules:
+                    outfile.write("<module>{}</module>\n".format(module))
+                outfile.write("</modules>\n</library>\n")
+
+        count = 2000
+        write("base.xml",
+              [("repo:option{}".format(index), index) for index in range(count)],
+              ["repo:module{}".format(index) for index in range(count)])
+        write("project.xml",
+              [("repo:option1", "child"), ("repo:option0", "child"), ("repo:option1", "last")],
+              ["repo:module1", "repo:extra", "repo:module0"],
+              extends="base.xml")
+
+        config = lbuild.config.Configuration.parse_configuration(tempdir.getpath("project.xml"))
+
+        self.assertEqual(count, len(config.options))
+        self.assertEqual(Option("repo:option2", "2"), config.options[0])
+        self.assertEqual(Option("repo:option0", "child"), config.options[-2])
+        self.assertEqual(Option("repo:option1", "last"), config.options[-1])
+
+        self.assertEqual(count + 1, len(config.selected_modules))
+        self.assertEqual("repo:module0", config.selected_modules[0])
+        self.assertEqual("repo:extra", config.selected_modules[-1])
+
+    def test_should_compile_schema_once(self):
+        self.assertIs(lbuild.config.get_schema(), lbuild.config.get_schema())
+
+    @testfixtures.tempdir()
+    def test_should_cache_configuration(self, tempdir):
+        configpath = tempdir.getpath("config")
+        shutil.copytree(self._get_path("configfile_inheritance"), configpath)
+        configfile = os.path.join(configpath, "depth_2.xml")
+        cache = lbuild.config.ConfigurationCache(tempdir.getpath("cache"))
+
+        def parse(verify=True):
+            with unittest.mock.patch.object(lbuild.config.Configuration, "load_and_verify",
+                                            wraps=lbuild.config.Configuration.load_and_verify) as load:
+                config = lbuild.config.Configuration.parse_configuration(configfile, cache=cache)
+            self.assertEqual(verify, load.called)
+            return config
+
+        config = parse()
+        cached = parse(verify=False)
+        self.assertEqual(config.options, cached.options)
+        self.assertEqual(config.selected_modules, cached.selected_modules)
+        self.assertEqual(config.repositories, cached.repositories)
+        self.assertEqual(config.files, cached.files)
+
+        # A new modification time without changed content keeps the entry
+        basefile = os.path.join(configpath, "depth_0.xml")
+        stat = os.stat(basefile)
+        os.utime(basefile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        parse(verify=False)
+
+        with open(basefile) as infile:
+            content = infile.read()
+        with open(basefile, "w") as outfile:
+            outfile.write(content.replace("Hello World!", "Changed"))
+        config = parse()
+        self.assertIn(Option("::abc", "Changed"), config.options)
+        parse(verify=False)
+
+        # Entries of other lbuild versions are not used
+        with unittest.mock.patch.object(lbuild.buildcache, "get_lbuild_digest", return_value="other"):
+            parse()
+
+    @testfixtures.tempdir()
+    def test_should_prune_unused_configuration_cache_entries(self, tempdir):
+        cache = lbuild.config.ConfigurationCache(tempdir.getpath("cache"))
+        configfile = self._get_path("configfile_inheritance/depth_0.xml")
+        config = lbuild.config.Configuration.parse_configuration(configfile)
+
+        cache.add("unused.xml", config)
+        entryfile = cache.get_entry_filename("unused.xml")
+        os.utime(entryfile, (0, 0))
+        cache.add(configfile, config)
+        self.assertFalse(os.path.exists(entryfile))
+        self.assertIsNotNone(cache.get(configfile))
+
+        self.assertEqual(0, cache.prune())
+        self.assertEqual(1, cache.prune(max_age=-1))
+        self.assertEqual([], os.listdir(tempdir.getpath("cache")))
+
 if __name__ == '__main__':
     unittest.main()
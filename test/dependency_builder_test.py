@@ -33,7 +33,7 @@ class DepedencyBuilderTest(unittest.TestCase):
         Adds the path to the generated config file.
         """
         argument_parser = lbuild.main.prepare_argument_parser()
-        commandline_arguments = ["-c{}".format(self._get_path("config.xml")), ]
+        commandline_arguments = ["--no-config-cache", "-c{}".format(self._get_path("config.xml")), ]
         commandline_arguments.extend(commands)
         args = argument_parser.parse_args(commandline_arguments)
         return args
@@ -10,15 +10,21 @@
 
 import os
 import sys
+import shutil
 import tarfile
 import warnings
+import threading
 import unittest
+import unittest.mock
 import testfixtures
 
+import git
+
 # Hack to support the usage of `coverage`
 sys.path.append(os.path.abspath("."))
 
 import lbuild
+import lbuild.vcs.git
 
 class GitTest(unittest.TestCase):
     """
@@ -59,7 +65,7 @@ class GitTest(unittest.TestCase):
         Adds the path to the generated config file.
         """
         argument_parser = lbuild.main.prepare_argument_parser()
-        commandline_arguments = ["-c{}".format(config_file), ]
+        commandline_arguments = ["--no-config-cache", "-c{}".format(config_file), ]
         commandline_arguments.extend(commands)
         args = argument_parser.parse_args(commandline_arguments)
         return args
@@ -81,6 +87,188 @@ class GitTest(unittest.TestCase):
             "folder/module2.lb",
             ], path="source")
 
+    def prepare_configuration(self, tempdir, names, url=None):
+        config = lbuild.config.Configuration()
+        config.cachefolder = tempdir.path
+        for name in names:
+            config.vcs.append({"git": {"name": tempdir.getpath(name),
+                                       "url": tempdir.getpath("repository") if url is None else url,
+                                       "branch": "master"}})
+        return config
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_initialize_repositories_in_parallel(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config = self.prepare_configuration(tempdir, ["source1", "source2", "source3"])
+
+        messages = []
+        lbuild.vcs.common.initialize(config, jobs=2, progress=messages.append)
+
+        self.assertEqual(3, len(messages))
+        for name in ["source1", "source2", "source3"]:
+            self.assertTrue(os.path.isfile(tempdir.getpath(os.path.join(name, "repo.lb"))))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_aggregate_errors_of_repositories(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config = self.prepare_configuration(tempdir, ["source1"])
+        config.vcs.extend(self.prepare_configuration(tempdir, ["missing1", "missing2"],
+                                                     url=tempdir.getpath("missing")).vcs)
+
+        with self.assertRaises(lbuild.exception.BlobAggregateException) as context:
+            lbuild.vcs.common.initialize(config)
+
+        self.assertEqual(2, len(context.exception.exceptions))
+        self.assertTrue(os.path.isfile(tempdir.getpath(os.path.join("source1", "repo.lb"))))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_share_objects_between_cache_folders(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        store = tempdir.getpath("store")
+        config = self.prepare_configuration(tempdir, ["source1", "source2"])
+
+        lbuild.vcs.common.initialize(config, object_store=store)
+        lbuild.vcs.common.update(config, object_store=store)
+
+        mirrors = [name for name in os.listdir(store) if name.endswith(".git")]
+        self.assertEqual(1, len(mirrors))
+        mirror = git.Repo(os.path.join(store, mirrors[0]))
+        self.assertEqual("0", mirror.git.config("gc.auto"))
+        self.assertEqual("never", mirror.git.config("gc.pruneExpire"))
+        for name in ["source1", "source2"]:
+            self.assertTrue(os.path.isfile(tempdir.getpath(os.path.join(name, "repo.lb"))))
+            alternates = tempdir.getpath(os.path.join(name, ".git", "objects", "info", "alternates"))
+            self.assertTrue(os.path.isfile(alternates))
+
+    @unittest.skipIf(lbuild.vcs.git.fcntl is None, "Requires fcntl")
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_lock_object_store_mirror(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        store = lbuild.vcs.git.ObjectStore(tempdir.getpath("store"))
+        url = tempdir.getpath("repository")
+        mirror = store.get_mirror_path(url)
+
+        # Lock held by another process
+        os.makedirs(store.path)
+        with open(mirror + ".lock", "a") as lockfile:
+            lbuild.vcs.git.fcntl.flock(lockfile, lbuild.vcs.git.fcntl.LOCK_EX)
+            thread = threading.Thread(target=store.update, args=(url,))
+            thread.start()
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            self.assertFalse(os.path.exists(mirror))
+        thread.join()
+        self.assertTrue(os.path.exists(mirror))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_restore_snapshot(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        config = self.prepare_configuration(tempdir, ["source1", "source2"])
+        lbuild.vcs.common.initialize(config)
+
+        archive = tempdir.getpath("snapshot.tar.gz")
+        manifest = lbuild.vcs.snapshot.create(config, archive)
+        self.assertEqual(["source1", "source2"], sorted(manifest["repositories"]))
+
+        restored = lbuild.config.Configuration()
+        restored.cachefolder = tempdir.getpath("restored")
+        restored.vcs = [{"git": dict(vcs["git"], name=os.path.join(restored.cachefolder, name))}
+                        for vcs, name in zip(config.vcs, ["source1", "source2"])]
+        self.assertEqual(manifest, lbuild.vcs.snapshot.restore(restored, archive))
+
+        messages = []
+        with unittest.mock.patch.object(git.Repo, "clone_from", side_effect=AssertionError):
+            lbuild.vcs.common.initialize(restored, progress=messages.append)
+
+        self.assertEqual(2, len(messages))
+        self.assertTrue(all(message.endswith("restored from snapshot") for message in messages))
+        for name in ["source1", "source2"]:
+            self.assertTrue(os.path.isfile(tempdir.getpath(os.path.join("restored", name, "repo.lb"))))
+            self.assertEqual(manifest["repositories"][name]["head"],
+                             git.Repo(tempdir.getpath(os.path.join("restored", name))).head.commit.hexsha)
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_copy_shared_objects_into_snapshot(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        store = tempdir.getpath("store")
+        config = self.prepare_configuration(tempdir, ["source1"])
+        lbuild.vcs.common.initialize(config, object_store=store)
+
+        def list_objects():
+            objectpath = tempdir.getpath(os.path.join("source1", ".git", "objects"))
+            return sorted(os.path.join(root, filename)
+                          for root, _, filenames in os.walk(objectpath) for filename in filenames)
+
+        # The repository in the cache folder is not changed
+        objects = list_objects()
+        archive = tempdir.getpath("snapshot.tar")
+        manifest = lbuild.vcs.snapshot.create(config, archive)
+        self.assertEqual(objects, list_objects())
+        alternates = tempdir.getpath(os.path.join("source1", ".git", "objects", "info", "alternates"))
+        self.assertTrue(os.path.exists(alternates))
+
+        restored = lbuild.config.Configuration()
+        restored.cachefolder = tempdir.getpath("restored")
+        restored.vcs = [{"git": dict(config.vcs[0]["git"],
+                                     name=os.path.join(restored.cachefolder, "source1"))}]
+        lbuild.vcs.snapshot.restore(restored, archive)
+
+        # The restored repository is usable without the object store
+        shutil.rmtree(store)
+        gitrepo = git.Repo(tempdir.getpath(os.path.join("restored", "source1")))
+        gitrepo.git.fsck("--full")
+        self.assertEqual(manifest["repositories"]["source1"]["head"], gitrepo.head.commit.hexsha)
+        self.assertEqual(len(list(git.Repo(tempdir.getpath("repository")).iter_commits("master"))),
+                         len(list(gitrepo.iter_commits())))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_clone_repositories_missing_in_snapshot(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config = self.prepare_configuration(tempdir, ["source1"])
+        lbuild.vcs.common.initialize(config)
+        lbuild.vcs.snapshot.create(config, tempdir.getpath("snapshot.tar"))
+
+        # A different branch does not match the snapshot
+        config.vcs[0]["git"]["branch"] = "develop"
+        config.vcs.extend(self.prepare_configuration(tempdir, ["source2"]).vcs)
+        messages = []
+        lbuild.vcs.common.initialize(config, progress=messages.append)
+
+        self.assertEqual(2, len(messages))
+        self.assertFalse(any(message.endswith("restored from snapshot") for message in messages))
+        self.assertTrue(os.path.isfile(tempdir.getpath(os.path.join("source1", "module4.lb"))))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_use_default_object_store(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<commit>1671afbce8453c1e6c0f4c94c6d9ede2c5f49991</commit>"
+                                                      "<single-commit>true</single-commit>")
+        args = self.prepare_arguments(config_file, ["init", "--object-store"])
+
+        with unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tempdir.getpath("cache")}):
+            lbuild.main.run(args)
+
+        self.assertEqual(1, len([name for name in os.listdir(tempdir.getpath("cache/lbuild/git"))
+                                 if name.endswith(".git")]))
+        self.assertTrue(os.path.isfile(tempdir.getpath("source/.git/objects/info/alternates")))
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "folder/",
+            "folder/module2.lb",
+            ], path="source")
+
     @testfixtures.tempdir(ignore=[".git/"])
     def test_should_initialize_repository_multiple_times(self, tempdir):
         self.prepare_git_repository(tempdir)
@@ -193,6 +381,136 @@ class GitTest(unittest.TestCase):
             "folder/module2.lb",
             ], path="source")
 
+    @staticmethod
+    def count_commits(tempdir):
+        repo = git.Repo(tempdir.getpath("source"))
+        return len(list(repo.iter_commits("HEAD")))
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_initialize_shallow_repository(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<depth>1</depth>")
+        args = self.prepare_arguments(config_file, ["init", ])
+        lbuild.main.run(args)
+
+        self.assertEqual(1, self.count_commits(tempdir))
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "module4.lb",
+            "folder/",
+            "folder/module2.lb",
+            ], path="source")
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_fetch_commit_outside_of_shallow_history(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<commit>1671afbce8453c1e6c0f4c94c6d9ede2c5f49991</commit>"
+                                                      "<depth>1</depth>")
+        args = self.prepare_arguments(config_file, ["init", ])
+        lbuild.main.run(args)
+
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "folder/",
+            "folder/module2.lb",
+            ], path="source")
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_fetch_single_commit(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<commit>1671afbce8453c1e6c0f4c94c6d9ede2c5f49991</commit>"
+                                                      "<single-commit>true</single-commit>")
+        args = self.prepare_arguments(config_file, ["init", ])
+        lbuild.main.run(args)
+
+        args = self.prepare_arguments(config_file, ["update", ])
+        lbuild.main.run(args)
+
+        self.assertEqual(1, self.count_commits(tempdir))
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "folder/",
+            "folder/module2.lb",
+            ], path="source")
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_skip_update_of_pinned_commit(self, tempdir):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<commit>1671afbce8453c1e6c0f4c94c6d9ede2c5f49991</commit>")
+        lbuild.main.run(self.prepare_arguments(config_file, ["init", ]))
+
+        config = lbuild.config.Configuration.parse_configuration(config_file)
+        repository = lbuild.vcs.common._get_repositories(config)[0]
+        self.assertTrue(os.path.exists(repository.statefile))
+        self.assertTrue(repository.is_up_to_date())
+
+        with unittest.mock.patch.object(git.Remote, "fetch", side_effect=AssertionError), \
+                unittest.mock.patch.object(git.Remote, "pull", side_effect=AssertionError), \
+                unittest.mock.patch.object(git.cmd.Git, "fetch", side_effect=AssertionError, create=True):
+            output = lbuild.main.run(self.prepare_arguments(config_file, ["update", ]))
+        self.assertEqual("", output)
+
+        # Moving the HEAD invalidates the state stamp
+        git.Repo(tempdir.getpath("source")).git.checkout("develop")
+        self.assertFalse(repository.is_up_to_date())
+        lbuild.main.run(self.prepare_arguments(config_file, ["update", ]))
+        self.assertTrue(repository.is_up_to_date())
+
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "folder/",
+            "folder/module2.lb",
+            ], path="source")
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_reject_single_commit_with_abbreviated_hash(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<commit>1671afbc</commit>"
+                                                      "<single-commit>true</single-commit>")
+        args = self.prepare_arguments(config_file, ["init", ])
+
+        with self.assertRaises(lbuild.exception.BlobException):
+            lbuild.main.run(args)
+
+    @testfixtures.tempdir(ignore=[".git/"])
+    def test_should_initialize_sparse_checkout(self, tempdir):
+        self.prepare_git_repository(tempdir)
+        config_file = self.prepare_config_file(tempdir,
+                                               branch="develop",
+                                               commit="<depth>1</depth>"
+                                                      "<sparse><path>/repo.lb</path><path>/module*.lb</path></sparse>")
+        args = self.prepare_arguments(config_file, ["init", ])
+        lbuild.main.run(args)
+
+        tempdir.compare([
+            "repo.lb",
+            "module1.lb",
+            "module3.lb",
+            "module4.lb",
+            ], path="source")
+
     @testfixtures.tempdir(ignore=[".git/"])
     def test_should_initialize_repository_with_different_commit(self, tempdir):
         self.prepare_git_repository(tempdir)
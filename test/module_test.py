@@ -66,6 +66,54 @@ class ModuleTest(unittest.TestCase):
         self.assertEqual(True, resolver[":other:xyz"])
         self.assertEqual("Hello World!", resolver["::bla:abc"])
 
+    def test_resolver_should_record_accessed_options(self):
+        repo_options = {
+            "repo1:target": lbuild.option.Option("target", "", default="hosted"),
+        }
+        module_options = {
+            "repo1:other:foo": lbuild.option.NumericOption("foo", "", default=456),
+            "repo1:other:bar": lbuild.option.NumericOption("bar", "", default=768),
+        }
+
+        accessed = set()
+        resolver = lbuild.module.OptionNameResolver(self.repo, self.module, repo_options,
+                                                    module_options, accessed)
+
+        resolver[":target"]
+        resolver["foo"]
+        resolver[":other:foo"]
+        with self.assertRaises(lbuild.exception.BlobException):
+            resolver["::unknown"]
+
+        self.assertEqual({"repo1:target", "repo1:other:foo"}, accessed)
+
+    def test_resolver_should_accept_all_spellings(self):
+        repo_options = {
+            "repo1:target": lbuild.option.Option("target", "", default="hosted"),
+        }
+        module_options = {
+            "repo1:other:foo": lbuild.option.NumericOption("foo", "", default=456),
+            "repo1:other:bla:abc": lbuild.option.Option("abc", "", default="Hello World!"),
+        }
+        self.module.options["foo"] = module_options["repo1:other:foo"]
+
+        resolver = lbuild.module.OptionNameResolver(self.repo, self.module, repo_options, module_options)
+
+        for key in ["foo", ":other:foo", "repo1::foo", "::foo", "repo1:other:foo"]:
+            self.assertEqual(456, resolver[key])
+        for key in [":target", "repo1:target"]:
+            self.assertEqual("hosted", resolver[key])
+
+        # Resolved on first access
+        for _ in range(2):
+            self.assertEqual("Hello World!", resolver["::bla:abc"])
+            self.assertEqual("Hello World!", resolver["repo1:other:bla:abc"])
+
+        with self.assertRaises(lbuild.exception.BlobException):
+            resolver["bar"]
+        with self.assertRaises(lbuild.exception.BlobException):
+            resolver["repo2:other:foo"]
+
     def test_should_create_correct_representation(self):
         repo_options = {
             "repo1:target": None,
@@ -9,8 +9,13 @@
 # governing this code.
 
 import os
+import gc
 import sys
+import jinja2
+import tarfile
+import zipfile
 import unittest
+import unittest.mock
 import testfixtures
 
 # Hack to support the usage of `coverage`
@@ -18,6 +23,8 @@ sys.path.append(os.path.abspath("."))
 
 import lbuild
 
+from test.benchmark.synthetic import SyntheticRepository
+
 
 class ParserTest(unittest.TestCase):
 
@@ -182,6 +189,219 @@ class ParserTest(unittest.TestCase):
         self.assertTrue(os.path.isfile(os.path.join(outpath, "src/other.cpp")))
         self.assertTrue(os.path.isfile(os.path.join(outpath, "test/other.cpp")))
 
+    @testfixtures.tempdir()
+    def test_should_record_operations_in_dry_run(self, tempdir):
+        build_modules, config_options, repo_options = self._get_build_modules()
+        module_options = self.parser.merge_module_options(build_modules, config_options)
+
+        log = lbuild.buildlog.BuildLog()
+        outpath = os.path.join(tempdir.path, "build")
+        self.parser.build_modules(outpath, build_modules, repo_options, module_options, log,
+                                  dry_run=True)
+
+        self.assertFalse(os.path.exists(outpath))
+        operations = {operation.filename_out: operation for operation in log}
+        self.assertIn(os.path.join(outpath, "src/other.cpp"), operations)
+        self.assertIn(os.path.join(outpath, "test/other.cpp"), operations)
+        for operation in operations.values():
+            self.assertEqual(os.path.getsize(operation.filename_in), operation.size)
+        self.assertIn(b"<size>", log.to_xml())
+
+    @testfixtures.tempdir()
+    def test_should_render_templates_in_dry_run(self, tempdir):
+        _, configfile = SyntheticRepository(modules=2).generate(tempdir.path)
+        parser = lbuild.parser.Parser()
+        config = lbuild.config.Configuration.parse_configuration(configfile)
+        parser.load_repositories(config)
+
+        repo_options = parser.merge_repository_options(config.options)
+        build_modules, module_options = lbuild.main.get_modules(parser, repo_options, config.options,
+                                                                config.selected_modules)
+        renders = []
+        for render in [False, True]:
+            log = lbuild.buildlog.BuildLog()
+            with unittest.mock.patch.object(jinja2.Template, "render", return_value="") as mock:
+                parser.build_modules(tempdir.getpath("build"), build_modules, repo_options,
+                                     module_options, log, dry_run=True, render_templates=render)
+            renders.append(mock.call_count)
+            self.assertEqual(6, len(log.operations))
+
+        self.assertFalse(os.path.exists(tempdir.getpath("build")))
+        # Two modules with one template each
+        self.assertEqual([0, 2], renders)
+
+    def _build_synthetic(self, path, outpath, **kwargs):
+        _, configfile = SyntheticRepository(modules=4).generate(path)
+        with lbuild.parser.Parser() as parser:
+            config = lbuild.config.Configuration.parse_configuration(configfile)
+            parser.load_repositories(config)
+            repo_options = parser.merge_repository_options(config.options)
+            build_modules, module_options = lbuild.main.get_modules(parser, repo_options, config.options,
+                                                                    config.selected_modules)
+            log = lbuild.buildlog.BuildLog()
+            parser.build_modules(outpath, build_modules, repo_options, module_options, log, **kwargs)
+        return log
+
+    @staticmethod
+    def _list_files(path):
+        return sorted(os.path.relpath(os.path.join(root, filename), path)
+                      for root, _, filenames in os.walk(path) for filename in filenames)
+
+    @testfixtures.tempdir()
+    def test_should_build_staged(self, tempdir):
+        self._build_synthetic(tempdir.getpath("direct"), tempdir.getpath("build/direct"))
+        # Write the template outputs through the staging folder as well
+        with unittest.mock.patch.object(lbuild.environment.OutputStage, "MEMORY_LIMIT", 100):
+            self._build_synthetic(tempdir.getpath("staged"), tempdir.getpath("build/staged"),
+                                  staged=True)
+
+        files = self._list_files(tempdir.getpath("build/direct"))
+        self.assertEqual(12, len(files))
+        self.assertEqual(files, self._list_files(tempdir.getpath("build/staged")))
+        for filename in files:
+            self.assertEqual(tempdir.read(os.path.join("build/direct", filename)),
+                             tempdir.read(os.path.join("build/staged", filename)))
+
+        # Building again only stages the outdated files
+        self._build_synthetic(tempdir.getpath("staged"), tempdir.getpath("build/staged"),
+                              staged=True)
+        self.assertEqual(files, self._list_files(tempdir.getpath("build/staged")))
+
+    @testfixtures.tempdir()
+    def test_should_not_change_output_path_of_failed_staged_build(self, tempdir):
+        outpath = tempdir.getpath("build")
+        tempdir.write("build/existing.txt", b"existing")
+
+        with unittest.mock.patch.object(lbuild.parser.Runner, "post_build",
+                                        side_effect=lbuild.exception.BlobException("failed")):
+            with self.assertRaises(lbuild.exception.BlobException):
+                self._build_synthetic(tempdir.path, outpath, staged=True)
+
+        self.assertEqual(["existing.txt"], os.listdir(outpath))
+
+    @testfixtures.tempdir()
+    def test_should_build_into_archive(self, tempdir):
+        self._build_synthetic(tempdir.getpath("direct"), tempdir.getpath("build/direct"))
+        files = [filename.replace(os.sep, "/")
+                 for filename in self._list_files(tempdir.getpath("build/direct"))]
+
+        for filename in ["lib.zip", "lib.tar.gz", "lib.tar.xz"]:
+            archive = tempdir.getpath(filename)
+            outpath = tempdir.getpath("build/archive")
+            log = self._build_synthetic(tempdir.getpath("archive"), outpath, archive=archive)
+
+            self.assertFalse(os.path.exists(outpath))
+            self.assertEqual(files, sorted(operation.member for operation in log))
+            self.assertIn(b"<member>", log.to_xml())
+
+            if filename.endswith(".zip"):
+                with zipfile.ZipFile(archive) as zip_archive:
+                    members = zip_archive.namelist()
+                    content = zip_archive.read("module1/template.cpp")
+                    self.assertEqual({(1980, 1, 1, 0, 0, 0)},
+                                     set(info.date_time for info in zip_archive.infolist()))
+            else:
+                with tarfile.open(archive) as tar_archive:
+                    members = tar_archive.getnames()
+                    content = tar_archive.extractfile("module1/template.cpp").read()
+                    self.assertEqual({lbuild.archive.DEFAULT_TIMESTAMP},
+                                     set(info.mtime for info in tar_archive.getmembers()))
+            self.assertEqual(files, members)
+            self.assertEqual(tempdir.read("build/direct/module1/template.cpp"), content)
+
+            # Building again creates the same archive
+            with open(archive, "rb") as archivefile:
+                first = archivefile.read()
+            self._build_synthetic(tempdir.getpath("archive"), outpath, archive=archive)
+            with open(archive, "rb") as archivefile:
+                self.assertEqual(first, archivefile.read())
+
+    @testfixtures.tempdir()
+    def test_should_build_into_zip_archive_without_streaming(self, tempdir):
+        self._build_synthetic(tempdir.getpath("direct"), tempdir.getpath("build/direct"))
+        files = self._list_files(tempdir.getpath("build/direct"))
+
+        archive = tempdir.getpath("lib.zip")
+        with unittest.mock.patch.object(lbuild.archive, "_ZIP_STREAMING", False):
+            self._build_synthetic(tempdir.getpath("archive"), tempdir.getpath("build/archive"),
+                                  archive=archive)
+        with zipfile.ZipFile(archive) as zip_archive:
+            self.assertEqual([filename.replace(os.sep, "/") for filename in files],
+                             zip_archive.namelist())
+            for filename in files:
+                self.assertEqual(tempdir.read(os.path.join("build/direct", filename)),
+                                 zip_archive.read(filename.replace(os.sep, "/")))
+
+    @testfixtures.tempdir()
+    def test_should_hardlink_outputs_from_content_store(self, tempdir):
+        self._build_synthetic(tempdir.getpath("direct"), tempdir.getpath("build/direct"))
+        files = self._list_files(tempdir.getpath("build/direct"))
+
+        store = tempdir.getpath("store")
+        for target in ["a", "b"]:
+            self._build_synthetic(tempdir.getpath("stored"), tempdir.getpath("build/" + target),
+                                  content_store=store)
+            self.assertEqual(files, self._list_files(tempdir.getpath("build/" + target)))
+        for filename in files:
+            self.assertEqual(tempdir.read(os.path.join("build/direct", filename)),
+                             tempdir.read(os.path.join("build/a", filename)))
+            self.assertTrue(os.path.samefile(tempdir.getpath(os.path.join("build/a", filename)),
+                                             tempdir.getpath(os.path.join("build/b", filename))))
+        # One file per distinct content, the templates of all modules are
+        # identical
+        contents = set(tempdir.read(os.path.join("build/direct", filename)) for filename in files)
+        self.assertEqual(len(contents), len(self._list_files(store)))
+        self.assertLess(len(contents), len(files))
+
+        # Building again keeps the links, changed outputs replace the
+        # read-only hardlinks
+        self._build_synthetic(tempdir.getpath("stored"), tempdir.getpath("build/a"),
+                              content_store=store)
+        self.assertTrue(os.path.samefile(tempdir.getpath("build/a/module1/template.cpp"),
+                                         tempdir.getpath("build/b/module1/template.cpp")))
+        content_store = lbuild.environment.ContentStore(store)
+        content_store.link(content_store.add_content("changed"),
+                           tempdir.getpath("build/a/module1/template.cpp"))
+        self.assertEqual(b"changed", tempdir.read("build/a/module1/template.cpp"))
+        self.assertEqual(tempdir.read("build/direct/module1/template.cpp"),
+                         tempdir.read("build/b/module1/template.cpp"))
+
+    @testfixtures.tempdir()
+    def test_should_not_change_content_store_by_plain_build(self, tempdir):
+        store = tempdir.getpath("store")
+        for target in ["a", "b"]:
+            self._build_synthetic(tempdir.getpath("stored"), tempdir.getpath("build/" + target),
+                                  content_store=store)
+        files = self._list_files(tempdir.getpath("build/b"))
+        outputs = {filename: tempdir.read(os.path.join("build/b", filename)) for filename in files}
+        stored = {filename: tempdir.read(os.path.join("store", filename))
+                  for filename in self._list_files(store)}
+
+        # Copy all files again and write different template outputs
+        for filename in files:
+            os.utime(tempdir.getpath(os.path.join("build/a", filename)), (0, 0))
+        write = lbuild.environment.Environment._write
+
+        def write_changed(env, filename, content):
+            write(env, filename, content + "// plain\n")
+
+        with unittest.mock.patch.object(lbuild.environment.Environment, "_write", autospec=True,
+                                        side_effect=write_changed):
+            self._build_synthetic(tempdir.getpath("plain"), tempdir.getpath("build/a"))
+
+        self.assertTrue(tempdir.read("build/a/module1/template.cpp").endswith(b"// plain\n"))
+        for filename in files:
+            self.assertFalse(os.path.samefile(tempdir.getpath(os.path.join("build/a", filename)),
+                                              tempdir.getpath(os.path.join("build/b", filename))))
+        self.assertEqual(outputs, {filename: tempdir.read(os.path.join("build/b", filename))
+                                   for filename in files})
+        self.assertEqual(stored, {filename: tempdir.read(os.path.join("store", filename))
+                                  for filename in self._list_files(store)})
+
+    def test_should_reject_unknown_archive_format(self):
+        with self.assertRaises(lbuild.exception.BlobException):
+            lbuild.archive.OutputArchive("lib.rar", "build")
+
     @testfixtures.tempdir()
     def test_should_build_jinja_2_modules(self, tempdir):
         self.parser.parse_repository(self._get_path("combined/repo1.lb"))
@@ -207,6 +427,9 @@ class ParserTest(unittest.TestCase):
 
         testfixtures.compare(tempdir.read("src/module3.cpp"), b"Hello World!")
 
+        self.assertEqual((["repo1:target"], []), log.accessed_options["repo1:other"])
+        self.assertEqual(([], ["repo2:module3:text"]), log.accessed_options["repo2:module3"])
+
     @testfixtures.tempdir()
     def test_should_raise_when_overwriting_file(self, tempdir):
         self.parser.parse_repository(self._get_path("overwrite_file/repo.lb"))
@@ -229,6 +452,43 @@ class ParserTest(unittest.TestCase):
         self.assertRaises(lbuild.exception.BlobBuildException,
                           lambda: self.parser.build_modules(outpath, build_modules, repo_options, module_options, log))
 
+    @testfixtures.tempdir()
+    def test_should_copy_many_files(self, tempdir):
+        self.parser.parse_repository(self._get_path("copy_many/repo.lb"))
+        build_modules, repo_options, module_options = self.prepare_modules(self.parser, [":module"])
+
+        log = lbuild.buildlog.BuildLog()
+        self.parser.build_modules(tempdir.path, build_modules, repo_options, module_options, log)
+
+        files = [os.path.join("include", "a", "b", "file.h"),
+                 os.path.join("include", "a", "b", "file.hpp"),
+                 os.path.join("include", "file.h"),
+                 os.path.join("folder", "b", "file.h"),
+                 os.path.join("folder", "b", "file.hpp"),
+                 os.path.join("all", "a", "b", "file.h"),
+                 os.path.join("all", "a", "b", "file.hpp"),
+                 os.path.join("all", "a", "file.c"),
+                 os.path.join("all", "a", "file_impl.h"),
+                 os.path.join("all", "file.h"),
+                 os.path.join("all", ".hidden.h"),
+                 os.path.join("nested", "src", "a", "b", "file.h")]
+        self.assertEqual(sorted(files), self._list_files(tempdir.path))
+        self.assertEqual(sorted(files), sorted(os.path.relpath(operation.filename_out, tempdir.path)
+                                               for operation in log.operations))
+        self.assertEqual(b"// src/a/b/file.hpp\n", tempdir.read("include/a/b/file.hpp"))
+
+    @testfixtures.tempdir()
+    def test_should_raise_when_copying_many_files_outside_of_repository(self, tempdir):
+        self.parser.parse_repository(self._get_path("copy_many/repo.lb"))
+        build_modules, repo_options, module_options = self.prepare_modules(self.parser, [":outside"])
+
+        log = lbuild.buildlog.BuildLog()
+        self.assertRaises(lbuild.exception.BlobException,
+                          lambda: self.parser.build_modules(tempdir.path, build_modules, repo_options,
+                                                            module_options, log))
+        self.assertEqual([], log.operations)
+        self.assertEqual([], os.listdir(tempdir.path))
+
     @testfixtures.tempdir()
     def test_should_raise_when_no_module_is_found(self, tempdir):
         self.parser.parse_repository(self._get_path("empty_repository/repo.lb"))
@@ -249,5 +509,138 @@ class ParserTest(unittest.TestCase):
         self.assertIsNotNone(module2.functions["pre_build"])
         self.assertIsNotNone(module2.functions["post_build"])
 
+    def test_should_release_module_namespaces(self):
+        modules_before = set(sys.modules)
+
+        with lbuild.parser.Parser() as parser:
+            parser.parse_repository(self._get_path("combined/repo1.lb"))
+            self.prepare_modules(parser)
+
+            namespaces = set(sys.modules) - modules_before
+            # One for the repository file and five module files
+            self.assertEqual(6, len(namespaces))
+
+        self.assertEqual(set(), set(sys.modules) - modules_before)
+
+    def test_should_release_module_namespaces_of_discarded_parser(self):
+        modules_before = set(sys.modules)
+
+        parser = lbuild.parser.Parser()
+        parser.parse_repository(self._get_path("combined/repo1.lb"))
+        self.prepare_modules(parser)
+        del parser
+        gc.collect()
+
+        self.assertEqual(set(), set(sys.modules) - modules_before)
+
+    def test_should_not_grow_memory_with_repeated_parsing(self):
+        def parse():
+            with lbuild.parser.Parser() as parser:
+                parser.parse_repository(self._get_path("optional_functions/repo.lb"))
+                self.prepare_modules(parser)
+
+        # Warm up all caches
+        for _ in range(10):
+            parse()
+        gc.collect()
+
+        modules_before = len(sys.modules)
+        objects_before = len(gc.get_objects())
+        for _ in range(1000):
+            parse()
+        gc.collect()
+
+        self.assertEqual(modules_before, len(sys.modules))
+        # Leaking the module namespaces would keep several objects per cycle
+        # alive (module, namespace dictionary, functions, ...)
+        self.assertLess(len(gc.get_objects()) - objects_before, 100)
+
+    def test_should_reuse_modules_prepared_with_same_accessed_options(self):
+        self.parser.parse_repository(self._get_path("combined/repo1.lb"))
+        self.parser.parse_repository(self._get_path("combined/repo2/repo2.lb"))
+
+        def prepare(target, foo):
+            options = [lbuild.config.Option(":target", target),
+                       lbuild.config.Option("repo1:foo", foo)]
+            repo_options = self.parser.merge_repository_options(options)
+            return self.parser.prepare_repositories(repo_options)
+
+        profiler = lbuild.profiler.Profiler()
+        lbuild.profiler.enable(profiler)
+        try:
+            modules = prepare("hosted", 1)
+            # 'repo1:foo' is not read in any prepare function
+            self.assertIs(modules["repo1:other"], prepare("hosted", 2)["repo1:other"])
+            self.assertEqual(1, profiler.phases["prepare"].count)
+
+            self.assertNotIn("repo1:other", prepare("other", 1))
+            self.assertEqual(2, profiler.phases["prepare"].count)
+
+            self.assertIs(modules["repo1:other"], prepare("hosted", 3)["repo1:other"])
+            self.assertEqual(2, profiler.phases["prepare"].count)
+        finally:
+            lbuild.profiler.disable(profiler)
+
+    def _generate_configurations(self, path, targets):
+        _, configfile = SyntheticRepository(modules=4).generate(path)
+        with open(configfile) as infile:
+            content = infile.read()
+
+        configfiles = []
+        for index, target in enumerate(targets):
+            filename = os.path.join(path, "project{}.xml".format(index))
+            with open(filename, "w") as outfile:
+                outfile.write(content.replace("<options>", "<options>\n"
+                                              "    <option name=\":target\">{}</option>".format(target)))
+            configfiles.append(filename)
+        return configfiles
+
+    @testfixtures.tempdir()
+    def test_should_build_multiple_configurations(self, tempdir):
+        configfiles = self._generate_configurations(tempdir.path, ["a", "b", "a"])
+        outpaths = [os.path.join(tempdir.path, "build", str(index)) for index in range(3)]
+
+        profiler = lbuild.profiler.Profiler()
+        lbuild.profiler.enable(profiler)
+        try:
+            logs = lbuild.parser.build_configurations(configfiles, outpaths)
+        finally:
+            lbuild.profiler.disable(profiler)
+
+        self.assertEqual(1, profiler.phases["repository"].count)
+        # The synthetic repository never reads the ':target' option in the
+        # prepare step
+        self.assertEqual(1, profiler.phases["prepare"].count)
+
+        self.assertEqual(3, len(logs))
+        for outpath, log in zip(outpaths, logs):
+            self.assertEqual(len(logs[0].operations), len(log.operations))
+            self.assertTrue(os.path.isfile(os.path.join(outpath, "module1", "template.cpp")))
+
+    @testfixtures.tempdir()
+    def test_should_build_multiple_configurations_in_parallel(self, tempdir):
+        configfiles = self._generate_configurations(tempdir.path, ["a", "b"])
+        outpaths = [os.path.join(tempdir.path, "build", str(index)) for index in range(2)]
+
+        logs = lbuild.parser.build_configurations(configfiles, outpaths, jobs=2)
+
+        self.assertEqual(2, len(logs))
+        for outpath, log in zip(outpaths, logs):
+            self.assertGreater(len(log.operations), 0)
+            self.assertTrue(os.path.isfile(os.path.join(outpath, "module1", "template.cpp")))
+
+    @testfixtures.tempdir()
+    def test_should_aggregate_errors_of_multiple_configurations(self, tempdir):
+        configfiles = self._generate_configurations(tempdir.path, ["a", "b"])
+        config = lbuild.config.Configuration.parse_configuration(configfiles[1])
+        config.selected_modules.append("synthetic:missing")
+
+        with self.assertRaises(lbuild.exception.BlobAggregateException) as context:
+            lbuild.parser.build_configurations([configfiles[0], config],
+                                               [os.path.join(tempdir.path, "a"),
+                                                os.path.join(tempdir.path, "b")])
+        self.assertEqual(1, len(context.exception.exceptions))
+        self.assertIn("project1.xml", str(context.exception.exceptions[0]))
+
 if __name__ == '__main__':
     unittest.main()
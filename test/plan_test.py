@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import sys
+import json
+import unittest
+import unittest.mock
+import testfixtures
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+from test.benchmark.synthetic import SyntheticRepository
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = testfixtures.TempDirectory()
+        self.repofile, self.configfile = SyntheticRepository(modules=6).generate(self.tempdir.path)
+        self.outpath = os.path.join(self.tempdir.path, "build")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _run(self, *arguments):
+        argument_parser = lbuild.main.prepare_argument_parser()
+        args = argument_parser.parse_args(["--no-config-cache",
+                                           "-c", self.configfile,
+                                           "-p", self.outpath] + list(arguments))
+        return lbuild.main.run(args)
+
+    def _write_config(self, filename, options=None, modules=None):
+        with open(self.configfile) as infile:
+            content = infile.read()
+        if options is not None:
+            content = content.replace("<options>\n", "<options>\n" + "".join(
+                '    <option name="{}">{}</option>\n'.format(name, value)
+                for name, value in options.items()))
+        if modules is not None:
+            content = content.replace("<module>synthetic:**</module>", "".join(
+                "<module>{}</module>".format(module) for module in modules))
+        filename = self.tempdir.getpath(filename)
+        with open(filename, "w") as outfile:
+            outfile.write(content)
+        return filename
+
+    def _plan(self, *arguments):
+        with unittest.mock.patch.object(lbuild.parser.Parser, "build_modules",
+                                        side_effect=AssertionError):
+            return json.loads(self._run("plan", "--json", *arguments))
+
+    def test_should_plan_against_previous_build(self):
+        self._run("build")
+        self.assertIn("<configuration>", open(self.configfile + ".log").read())
+
+        self.assertEqual([], self._plan()["modules"]["affected"])
+
+        self._write_config("project.xml", options={"synthetic:module1:option0": 5})
+        plan = self._plan()
+
+        self.assertEqual([], plan["repository_options"])
+        self.assertEqual(["synthetic:module1:option0"], plan["module_options"])
+        self.assertEqual([], plan["modules"]["added"])
+        self.assertEqual([], plan["modules"]["removed"])
+        # Submodules depend on their parent, module2 depends on module1
+        self.assertEqual(["synthetic:module1", "synthetic:module1:sub1",
+                          "synthetic:module2", "synthetic:module2:sub1"],
+                         plan["modules"]["affected"])
+
+        changed = plan["outputs"]["changed"]
+        self.assertIn(os.path.join(self.outpath, "module1", "template.cpp"), changed)
+        self.assertIn(os.path.join(self.outpath, "module2", "template.cpp"), changed)
+        self.assertNotIn(os.path.join(self.outpath, "module0", "template.cpp"), changed)
+        self.assertNotIn(os.path.join(self.outpath, "module0", "sub1", "template.cpp"), changed)
+        self.assertEqual([], plan["outputs"]["removed"])
+
+    def test_should_affect_all_modules_of_changed_repository_option(self):
+        self._run("build")
+        self._write_config("project.xml", options={":target": "other"})
+
+        plan = self._plan()
+        self.assertEqual(["synthetic:target"], plan["repository_options"])
+        self.assertEqual(6, len(plan["modules"]["affected"]))
+
+    def test_should_plan_between_configurations(self):
+        old = self._write_config("old.xml", modules=["synthetic:module0", "synthetic:module1"])
+        new = self._write_config("new.xml", modules=["synthetic:module1", "synthetic:module2"])
+
+        plan = self._plan("--from", old, "--to", new)
+        self.assertEqual(["synthetic:module2"], plan["modules"]["added"])
+        self.assertEqual([], plan["modules"]["removed"])
+        self.assertEqual([], plan["modules"]["affected"])
+        self.assertIsNone(plan["outputs"])
+
+        plan = self._plan("--from", new, "--to", old)
+        self.assertEqual(["synthetic:module2"], plan["modules"]["removed"])
+
+        output = self._run("plan", "--from", old, "--to", old)
+        self.assertEqual("No changes.", output)
+
+    def test_should_require_previous_configuration(self):
+        with self.assertRaises(lbuild.exception.BlobException):
+            self._run("plan")
+
+
+if __name__ == '__main__':
+    unittest.main()
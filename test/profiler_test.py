@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import sys
+import json
+import unittest
+import testfixtures
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def _get_path(self, filename):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            "resources", "parser", filename)
+
+    def setUp(self):
+        self.profiler = lbuild.profiler.Profiler()
+        lbuild.profiler.enable(self.profiler)
+
+    def tearDown(self):
+        lbuild.profiler.disable(self.profiler)
+
+    def _build(self, outpath):
+        parser = lbuild.parser.Parser()
+        config = lbuild.config.Configuration.parse_configuration(self._get_path("combined/test1.xml"))
+        parser.load_repositories(config)
+        config.selected_modules.append("repo2:module3")
+
+        repo_options = parser.merge_repository_options(config.options)
+        build_modules, module_options = lbuild.main.get_modules(parser,
+                                                                repo_options,
+                                                                config.options,
+                                                                config.selected_modules)
+        parser.build_modules(outpath, build_modules, repo_options, module_options,
+                             lbuild.buildlog.BuildLog())
+
+    def test_should_count_phases_and_spans(self):
+        with lbuild.profiler.phase("build"):
+            with lbuild.profiler.span("template", "a.in"):
+                pass
+            with lbuild.profiler.span("template", "a.in"):
+                pass
+        with lbuild.profiler.phase("build"):
+            pass
+
+        self.assertEqual(2, self.profiler.phases["build"].count)
+        self.assertEqual(2, self.profiler.templates["a.in"].count)
+        self.assertEqual(2, self.profiler.categories["template"].count)
+
+    def test_should_record_phases_on_exception(self):
+        with self.assertRaises(ValueError):
+            with lbuild.profiler.phase("prepare"):
+                raise ValueError()
+
+        self.assertEqual(1, self.profiler.phases["prepare"].count)
+
+    @testfixtures.tempdir()
+    def test_should_profile_build(self, tempdir):
+        self._build(tempdir.path)
+
+        phases = [name for name, _ in self.profiler.get_phases()]
+        self.assertEqual(lbuild.profiler.PHASES, phases)
+
+        self.assertEqual(1, self.profiler.phases["config"].count)
+        self.assertEqual(2, self.profiler.phases["repository"].count)
+        self.assertEqual(2, self.profiler.phases["options"].count)
+
+        modules = [name for name, _, _ in self.profiler.get_slowest_modules()]
+        self.assertIn("repo1:other", modules)
+        self.assertIn("repo2:module3", modules)
+
+    @testfixtures.tempdir()
+    def test_should_export_json(self, tempdir):
+        self._build(tempdir.path)
+
+        profile = json.loads(self.profiler.to_json(count=2))
+        self.assertEqual(len(lbuild.profiler.PHASES), len(profile["phases"]))
+        self.assertEqual(2, len(profile["modules"]))
+        self.assertIn("build", profile["modules"][0]["functions"])
+
+        self.assertEqual(1, len(profile["templates"]))
+        self.assertTrue(profile["templates"][0]["name"].endswith("module3.cpp.in"))
+
+    @testfixtures.tempdir()
+    def test_should_create_trace_events(self, tempdir):
+        tracer = lbuild.profiler.Tracer()
+        lbuild.profiler.enable(tracer)
+        try:
+            self._build(tempdir.path)
+        finally:
+            lbuild.profiler.disable(tracer)
+
+        trace = json.loads(tracer.to_json())
+        events = trace["traceEvents"]
+
+        categories = set(event.get("cat") for event in events)
+        self.assertIn("phase", categories)
+        self.assertIn("repository", categories)
+        self.assertIn("module", categories)
+        self.assertIn("template", categories)
+        self.assertIn("copy", categories)
+
+        builds = [event for event in events if event.get("args", {}).get("function") == "build"]
+        self.assertIn("repo2:module3", [event["args"]["module"] for event in builds])
+
+        self.assertIn("thread_name", [event["name"] for event in events if event["ph"] == "M"])
+
+    @testfixtures.tempdir()
+    def test_should_account_memory(self, tempdir):
+        memory = lbuild.profiler.MemoryProfiler()
+        memory.start()
+        lbuild.profiler.enable(memory)
+        try:
+            self._build(tempdir.path)
+        finally:
+            lbuild.profiler.disable(memory)
+            memory.stop()
+
+        phases = [name for name, _ in memory.get_phases()]
+        self.assertEqual(lbuild.profiler.PHASES, phases)
+        self.assertGreater(memory.phases["repository"].peak, 0)
+
+        modules = [name for name, _ in memory.get_top_modules()]
+        self.assertIn("repo2:module3", modules)
+        self.assertEqual(1, len(memory.get_top_templates()))
+
+        profile = json.loads(json.dumps(memory.to_dict(count=3)))
+        self.assertEqual(3, len(profile["files"]))
+        self.assertIn("Retained [kB]", memory.format())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1 @@
+// src/.hidden.h
@@ -0,0 +1 @@
+// src/a/b/file.h
@@ -0,0 +1 @@
+// src/a/file.c
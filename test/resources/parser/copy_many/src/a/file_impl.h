@@ -0,0 +1 @@
+// src/a/file_impl.h
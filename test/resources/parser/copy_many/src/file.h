@@ -0,0 +1 @@
+// src/file.h
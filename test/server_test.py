@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import io
+import os
+import sys
+import unittest
+import unittest.mock
+import threading
+import testfixtures
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+from test.benchmark.synthetic import SyntheticRepository
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = testfixtures.TempDirectory()
+        self.repofile, self.configfile = SyntheticRepository(modules=4).generate(self.tempdir.path)
+        self.outpath = os.path.join(self.tempdir.path, "build")
+
+        # Keep the configuration cache out of the user cache folder
+        environ = unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.tempdir.getpath("cache")})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.socketpath = os.path.join(self.tempdir.path, "lbuild.sock")
+        self.server = lbuild.server.Server(self.socketpath)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def _forward(self, *argv):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = lbuild.server.forward(self.socketpath,
+                                       ["-c", self.configfile] + list(argv),
+                                       stdout,
+                                       stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def _get_parser(self):
+        self.assertEqual(1, len(self.server.cache.entries))
+        return list(self.server.cache.entries.values())[0].parser
+
+    def test_should_build_with_warm_parser(self):
+        status, _, stderr = self._forward("-p", self.outpath, "build")
+        self.assertEqual(0, status, stderr)
+        self.assertTrue(os.path.exists(os.path.join(self.outpath, "module0", "template.cpp")))
+        parser = self._get_parser()
+
+        status, stdout, _ = self._forward("discover-modules")
+        self.assertEqual(0, status)
+        self.assertIn("synthetic:module1", stdout)
+        self.assertIs(parser, self._get_parser())
+
+    def test_should_invalidate_on_file_change(self):
+        status, _, _ = self._forward("discover-modules")
+        self.assertEqual(0, status)
+        parser = self._get_parser()
+
+        modulefile = os.path.join(self.tempdir.path, "module0", "module.lb")
+        with open(modulefile, "a") as outfile:
+            outfile.write("\n# changed\n")
+        # Make sure the time stamp changes even on coarse grained filesystems
+        stat = os.stat(modulefile)
+        os.utime(modulefile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        status, _, _ = self._forward("discover-modules")
+        self.assertEqual(0, status)
+        self.assertIsNot(parser, self._get_parser())
+
+    def test_should_report_errors(self):
+        status, _, stderr = self._forward("discover-module", "-m", ":missing")
+        self.assertEqual(1, status)
+        self.assertIn("ERROR", stderr)
+
+    def test_should_remove_connect_argument(self):
+        self.assertEqual(["-c", "a.xml", "build"],
+                         lbuild.main.remove_connect_argument(
+                             ["--connect", "a.sock", "-c", "a.xml", "--connect=b.sock", "build"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
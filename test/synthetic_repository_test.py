@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import sys
+import unittest
+import testfixtures
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+from test.benchmark.synthetic import SyntheticRepository
+from test.benchmark.run import run_benchmark
+
+
+class SyntheticRepositoryTest(unittest.TestCase):
+
+    @testfixtures.tempdir()
+    def test_should_generate_buildable_repository(self, tempdir):
+        repository = SyntheticRepository(modules=10,
+                                         depth=2,
+                                         fanout=2,
+                                         options=3,
+                                         template_lines=5,
+                                         copied_files=2)
+        repofile, configfile = repository.generate(tempdir.getpath("repository"))
+
+        with lbuild.parser.Parser() as parser:
+            parser.parse_repository(repofile)
+            log = parser.configure_and_build_library(configfile, tempdir.getpath("output"))
+
+            self.assertEqual(10, len(parser.available_modules))
+            self.assertIn("synthetic:module0:sub1:sub2", parser.available_modules)
+            self.assertIn("synthetic:module3", parser.available_modules)
+            self.assertEqual(["synthetic:module1", "synthetic:module2"],
+                             sorted(m.fullname for m in parser.available_modules["synthetic:module3"].dependencies))
+
+        # One template and two copied files per module
+        self.assertEqual(30, len(log.operations))
+        self.assertEqual(b"int value_0 = 0;\nint value_1 = 1;\nint value_2 = 2;\nint value_3 = 0;\nint value_4 = 1;",
+                         tempdir.read("output/module0/sub1/template.cpp"))
+
+    def test_should_benchmark_all_phases(self):
+        result = run_benchmark(SyntheticRepository(modules=5))
+
+        self.assertEqual(5, result["parameters"]["modules"])
+        self.assertEqual(lbuild.profiler.PHASES, [phase["name"] for phase in result["phases"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
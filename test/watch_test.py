@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Fabian Greif
+# All Rights Reserved.
+#
+# The file is part of the lbuild project and is released under the
+# 2-clause BSD license. See the file `LICENSE.txt` for the full license
+# governing this code.
+
+import os
+import sys
+import unittest
+import threading
+import testfixtures
+
+# Hack to support the usage of `coverage`
+sys.path.append(os.path.abspath("."))
+
+import lbuild
+
+from test.benchmark.synthetic import SyntheticRepository
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = testfixtures.TempDirectory()
+        self.repofile, self.configfile = SyntheticRepository(modules=4).generate(self.tempdir.path)
+        self.outpath = os.path.join(self.tempdir.path, "build")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _build(self, parser, previous=None):
+        config = lbuild.config.Configuration.parse_configuration(self.configfile)
+        if not parser.repositories:
+            parser.load_repositories(config)
+
+        repo_options = parser.merge_repository_options(config.options)
+        build_modules, module_options = lbuild.main.get_modules(parser,
+                                                                repo_options,
+                                                                config.options,
+                                                                config.selected_modules)
+        log = lbuild.buildlog.BuildLog()
+        operations = parser.build_modules(self.outpath, build_modules, repo_options,
+                                          module_options, log, previous)
+        return config, log, operations
+
+    def _modify(self, *path):
+        filename = os.path.join(self.tempdir.path, *path)
+        with open(filename, "a") as outfile:
+            outfile.write("// changed\n")
+        return os.path.realpath(filename)
+
+    def _check_watcher(self, watcher):
+        filename = os.path.join(self.tempdir.path, "module0", "template.cpp.in")
+        try:
+            self.assertEqual(set(), watcher.wait([filename], timeout=0.1))
+
+            timer = threading.Timer(0.1, self._modify, ["module0", "template.cpp.in"])
+            timer.start()
+            changed = watcher.wait([filename], timeout=5)
+            timer.join()
+        finally:
+            watcher.close()
+
+        self.assertEqual({os.path.realpath(filename)}, changed)
+
+    def test_should_detect_changes_by_polling(self):
+        self._check_watcher(lbuild.watch.PollingWatcher(interval=0.01))
+
+    def test_should_detect_changes_with_inotify(self):
+        try:
+            watcher = lbuild.watch.InotifyWatcher()
+        except (OSError, AttributeError):
+            self.skipTest("inotify not available")
+        self._check_watcher(watcher)
+
+    def test_should_collect_watched_files(self):
+        parser = lbuild.parser.Parser()
+        config, _, operations = self._build(parser)
+
+        filenames = lbuild.watch.get_watched_files(config, parser, operations)
+        self.assertIn(os.path.realpath(self.configfile), filenames)
+        self.assertIn(os.path.realpath(self.repofile), filenames)
+        self.assertIn(os.path.join(os.path.realpath(self.tempdir.path), "module1", "module.lb"), filenames)
+        self.assertIn(os.path.join(os.path.realpath(self.tempdir.path), "module1", "template.cpp.in"), filenames)
+        self.assertIn(os.path.join(os.path.realpath(self.tempdir.path), "module1", "src", "file0.h"), filenames)
+
+    def test_should_rebuild_affected_modules(self):
+        parser = lbuild.parser.Parser()
+        config, log, operations = self._build(parser)
+
+        changed = {self._modify("module1", "template.cpp.in")}
+        self.assertFalse(lbuild.watch.requires_full_build(config, parser, changed))
+        affected = lbuild.watch.get_affected_modules(operations, changed)
+        self.assertEqual({"synthetic:module1"}, affected)
+
+        previous = {name: ops for name, ops in operations.items() if name not in affected}
+        profiler = lbuild.profiler.Profiler()
+        lbuild.profiler.enable(profiler)
+        try:
+            _, rebuild_log, _ = self._build(parser, previous)
+        finally:
+            lbuild.profiler.disable(profiler)
+
+        builds = [module for module, functions in profiler.modules.items() if "build" in functions]
+        self.assertEqual(["synthetic:module1"], [lbuild.profiler.get_module_name(module) for module in builds])
+        self.assertEqual(len(log.operations), len(rebuild_log.operations))
+
+        with open(os.path.join(self.outpath, "module1", "template.cpp")) as infile:
+            self.assertTrue(infile.read().endswith("// changed"))
+
+    def test_should_require_full_build_for_module_file(self):
+        parser = lbuild.parser.Parser()
+        config, _, _ = self._build(parser)
+
+        self.assertTrue(lbuild.watch.requires_full_build(config, parser,
+                                                         {self._modify("module1", "module.lb")}))
+        self.assertTrue(lbuild.watch.requires_full_build(config, parser,
+                                                         {os.path.realpath(self.configfile)}))
+
+
+if __name__ == '__main__':
+    unittest.main()